@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import glob
+import importlib
+import os
+import sys
+
+if __name__ == '__main__':
+    tests = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tests')
+    sys.path.insert(0, tests)
+    for path in sorted(glob.glob(os.path.join(tests, "*_bench.py"))):
+        importlib.import_module(os.path.basename(path)[:-3]).bench()
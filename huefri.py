@@ -25,22 +25,36 @@ import signal
 import sys
 import os
 import threading
-import traceback
 import json
 
 import huefri
+import huefri.pairs
 from huefri.common import Config as Config
 from huefri.common import HuefriException as HuefriException
 from huefri.common import log as log
-from huefri.hue import Hue as Hue
-from huefri.tradfri import Tradfri as Tradfri
+from huefri.engine import Engine as Engine
+from huefri.server import Server as Server
+from huefri.server import ADDR as ADDR
+from huefri.server import PORT as PORT
+from huefri.supervisor import Supervisor as Supervisor
 
 def main():
 
+    if 'installations' in Config.get():
+        # many bridges and gateways, synced by worker processes
+        try:
+            Supervisor(Config.get()).run()
+        except KeyboardInterrupt:
+            log("MAIN", "Exiting on ^c.")
+        sys.exit(0)
+
+    start = time.monotonic()
     try:
-        hue = Hue.autoinit()
-        tradfri = Tradfri.autoinit(hue)
-        hue.set_tradfri(tradfri)
+        pairs = huefri.pairs.autoinit()
+        for hue, tradfri in pairs:
+            hue.start_streaming()
+            if tradfri.observe_main:
+                tradfri.start_observing()
     except HuefriException:
         # message is already printed
         sys.exit(1)
@@ -49,24 +63,27 @@ def main():
         sys.exit(1)
 
     """
-        Forever check the main light and update Hue lights.
+        Forever check the main lights and update the other hub.
+        Each hub is watched on its own, so a slow Tradfri request doesn't
+        delay the Hue sync and vice versa.
     """
+    log("MAIN", "ready to sync in %.2f s" % (time.monotonic() - start))
+    config = Config.get()
+
+    # the metrics and the states of the lights, for local tools only
+    server = config.get('server', {})
+    if server is not None:
+        try:
+            Server(server.get('addr', ADDR), server.get('port', PORT),
+                socket=server.get('socket')).start()
+        except OSError as err:
+            log("MAIN", "can't start the server: %s" % str(err))
+    engine = Engine(huefri.pairs.watchers(pairs))
     try:
-        while True:
-            try:
-                tradfri.update()
-                hue.update()
-            except pytradfri.error.RequestTimeout:
-                """ This exception is raised here and there and doesn't cause anything.
-                    So print just a short notice, not a full stacktrace.
-                """
-                log("MAIN", "Tradfri RequestTimeout().")
-            except Exception as err:
-                traceback.print_exc()
-                log("MAIN", err)
-            time.sleep(1)
+        engine.run()
     except KeyboardInterrupt:
         log("MAIN", "Exiting on ^c.")
+        pairs[0][0].adapter.report()
         sys.exit(0)
 
 if __name__ == '__main__':
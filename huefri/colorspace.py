@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+    Conversions between the color spaces of Hue and Tradfri bulbs.
+
+    The sync passes colors between the hubs as CIE xy or as a color
+    temperature, whichever the bulbs on the other side take, clamped to
+    what they can show. See Hue.update() and Tradfri.update().
+
+    All conversions work on batches: they take a sequence of colors and
+    return a sequence of colors of the same length. If NumPy is installed,
+    a batch is converted in one vectorized call and a NumPy array is
+    returned, otherwise the colors are converted one by one and a list of
+    tuples is returned.
+
+    Units are the ones of the Hue REST API:
+        hsb: hue 0-65535, sat 0-254, bri 0-254
+        rgb: r, g, b as floats 0-1
+        xy: CIE 1931 x, y
+        mired: 1 000 000 / Kelvin, 153-500
+        hex: 'rrggbb' as Tradfri uses it
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HUE_MAX = 65536
+SAT_MAX = 254
+BRI_MAX = 254
+MIRED_MIN = 153
+MIRED_MAX = 500
+
+# where RGB white ends up in xy, used also for black which has no color
+WHITE = (0.3227, 0.3290)
+
+# Triangles of colors the bulbs can show (red, green, blue corners).
+# Hue lights report their gamut type in capabilities/control/colorgamuttype.
+GAMUTS = {
+    'A': ((0.704, 0.296), (0.2151, 0.7106), (0.138, 0.08)),
+    'B': ((0.675, 0.322), (0.409, 0.518), (0.167, 0.04)),
+    'C': ((0.6915, 0.3083), (0.17, 0.7), (0.1532, 0.0475)),
+}
+
+# Wide gamut sRGB D65 -> XYZ, as recommended by Philips, and the inverse
+RGB2XYZ = (
+    (0.664511, 0.154324, 0.162028),
+    (0.283881, 0.668433, 0.047685),
+    (0.000088, 0.072310, 0.986039),
+)
+XYZ2RGB = (
+    (1.656492, -0.354851, -0.255038),
+    (-0.707196, 1.655397, 0.036152),
+    (0.051713, -0.121364, 1.011530),
+)
+
+
+#
+# Scalar conversions, used when NumPy is not available.
+#
+
+def _hsb2rgb(hue, sat, bri):
+    h = (hue % HUE_MAX) / HUE_MAX * 6
+    s = min(max(sat / SAT_MAX, 0), 1)
+    v = min(max(bri / BRI_MAX, 0), 1)
+    i = int(h) % 6
+    f = h - int(h)
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    return ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q))[i]
+
+def _rgb2hsb(r, g, b):
+    mx = max(r, g, b)
+    d = mx - min(r, g, b)
+    if d == 0:
+        h = 0
+    elif mx == r:
+        h = ((g - b) / d) % 6
+    elif mx == g:
+        h = (b - r) / d + 2
+    else:
+        h = (r - g) / d + 4
+    s = d / mx if mx else 0
+    return (round(h / 6 * HUE_MAX) % HUE_MAX, round(s * SAT_MAX), round(mx * BRI_MAX))
+
+def _gamma(c):
+    return ((c + 0.055) / 1.055) ** 2.4 if c > 0.04045 else c / 12.92
+
+def _ungamma(c):
+    return 1.055 * c ** (1 / 2.4) - 0.055 if c > 0.0031308 else 12.92 * c
+
+def _inside(p, gamut):
+    """ Is the point p inside of the gamut triangle? """
+    def cross(p, a, b):
+        return (p[0] - b[0]) * (a[1] - b[1]) - (a[0] - b[0]) * (p[1] - b[1])
+    r, g, b = gamut
+    d = (cross(p, r, g), cross(p, g, b), cross(p, b, r))
+    return not (min(d) < 0 and max(d) > 0)
+
+def _closest(p, a, b):
+    """ The point of the segment a-b closest to p. """
+    ab = (b[0] - a[0], b[1] - a[1])
+    t = ((p[0] - a[0]) * ab[0] + (p[1] - a[1]) * ab[1]) / (ab[0] ** 2 + ab[1] ** 2)
+    t = min(max(t, 0), 1)
+    return (a[0] + t * ab[0], a[1] + t * ab[1])
+
+def _clamp(x, y, gamut):
+    if _inside((x, y), gamut):
+        return (x, y)
+    r, g, b = gamut
+    return min((_closest((x, y), r, g), _closest((x, y), g, b), _closest((x, y), b, r)),
+            key=lambda c: (c[0] - x) ** 2 + (c[1] - y) ** 2)
+
+def _rgb2xy(r, g, b, gamut=None):
+    rgb = (_gamma(r), _gamma(g), _gamma(b))
+    X, Y, Z = (sum(m * c for m, c in zip(row, rgb)) for row in RGB2XYZ)
+    total = X + Y + Z
+    if total == 0:
+        return WHITE
+    if gamut is None:
+        return (X / total, Y / total)
+    return _clamp(X / total, Y / total, gamut)
+
+def _xy2rgb(x, y):
+    y = max(y, 1e-9)
+    xyz = (x / y, 1, (1 - x - y) / y)
+    rgb = [max(sum(m * c for m, c in zip(row, xyz)), 0) for row in XYZ2RGB]
+    mx = max(rgb)
+    if mx > 1:
+        rgb = [c / mx for c in rgb]
+    return tuple(min(_ungamma(c), 1) for c in rgb)
+
+def _mired2xy(mired):
+    """ Planckian locus approximation by Kim et al. """
+    t = 1e6 / min(max(mired, 40), 600)
+    if t <= 4000:
+        x = -0.2661239e9 / t ** 3 - 0.2343589e6 / t ** 2 + 0.8776956e3 / t + 0.179910
+    else:
+        x = -3.0258469e9 / t ** 3 + 2.1070379e6 / t ** 2 + 0.2226347e3 / t + 0.240390
+    if t <= 2222:
+        y = -1.1063814 * x ** 3 - 1.34811020 * x ** 2 + 2.18555832 * x - 0.20219683
+    elif t <= 4000:
+        y = -0.9549476 * x ** 3 - 1.37418593 * x ** 2 + 2.09137015 * x - 0.16748867
+    else:
+        y = 3.0817580 * x ** 3 - 5.87338670 * x ** 2 + 3.75112997 * x - 0.37001483
+    return (x, y)
+
+def _xy2mired(x, y):
+    """ McCamy's approximation """
+    n = (x - 0.3320) / (0.1858 - y)
+    cct = 449 * n ** 3 + 3525 * n ** 2 + 6823.3 * n + 5520.33
+    if cct <= 0:
+        return MIRED_MAX
+    return min(max(round(1e6 / cct), MIRED_MIN), MIRED_MAX)
+
+
+#
+# Vectorized conversions, each takes and returns a 2D array.
+#
+
+def _np_hsb2rgb(hsb):
+    h = (hsb[:, 0] % HUE_MAX) / HUE_MAX * 6
+    s = numpy.clip(hsb[:, 1] / SAT_MAX, 0, 1)
+    v = numpy.clip(hsb[:, 2] / BRI_MAX, 0, 1)
+    i = numpy.floor(h).astype(int) % 6
+    f = h - numpy.floor(h)
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    sector = [i == n for n in range(0, 6)]
+    return numpy.stack([
+        numpy.select(sector, [v, q, p, p, t, v]),
+        numpy.select(sector, [t, v, v, q, p, p]),
+        numpy.select(sector, [p, p, t, v, v, q]),
+    ], axis=1)
+
+def _np_rgb2hsb(rgb):
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    mx = rgb.max(axis=1)
+    d = mx - rgb.min(axis=1)
+    safe = numpy.where(d == 0, 1, d)
+    h = numpy.where(mx == r, ((g - b) / safe) % 6,
+            numpy.where(mx == g, (b - r) / safe + 2, (r - g) / safe + 4))
+    h = numpy.where(d == 0, 0, h)
+    s = numpy.where(mx == 0, 0, d / numpy.where(mx == 0, 1, mx))
+    return numpy.stack([
+        numpy.rint(h / 6 * HUE_MAX) % HUE_MAX,
+        numpy.rint(s * SAT_MAX),
+        numpy.rint(mx * BRI_MAX),
+    ], axis=1)
+
+def _np_clamp(xy, gamut):
+    corners = numpy.asarray(gamut)
+
+    def cross(a, b):
+        return (xy[:, 0] - b[0]) * (a[1] - b[1]) - (a[0] - b[0]) * (xy[:, 1] - b[1])
+
+    d = numpy.stack([cross(corners[0], corners[1]), cross(corners[1], corners[2]),
+            cross(corners[2], corners[0])], axis=1)
+    inside = ~((d.min(axis=1) < 0) & (d.max(axis=1) > 0))
+
+    best = xy.copy()
+    best_dist = numpy.full(len(xy), numpy.inf)
+    for a, b in ((0, 1), (1, 2), (2, 0)):
+        a, b = corners[a], corners[b]
+        ab = b - a
+        t = numpy.clip(((xy - a) @ ab) / (ab @ ab), 0, 1)
+        closest = a + t[:, None] * ab
+        dist = ((closest - xy) ** 2).sum(axis=1)
+        better = dist < best_dist
+        best[better] = closest[better]
+        best_dist[better] = dist[better]
+    return numpy.where(inside[:, None], xy, best)
+
+def _np_rgb2xy(rgb, gamut=None):
+    rgb = numpy.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = rgb @ numpy.asarray(RGB2XYZ).T
+    total = xyz.sum(axis=1)
+    safe = numpy.where(total == 0, 1, total)
+    xy = numpy.where((total == 0)[:, None], WHITE, xyz[:, :2] / safe[:, None])
+    if gamut is None:
+        return xy
+    return _np_clamp(xy, gamut)
+
+def _np_xy2rgb(xy):
+    x = xy[:, 0]
+    y = numpy.maximum(xy[:, 1], 1e-9)
+    xyz = numpy.stack([x / y, numpy.ones(len(xy)), (1 - x - y) / y], axis=1)
+    rgb = numpy.maximum(xyz @ numpy.asarray(XYZ2RGB).T, 0)
+    mx = rgb.max(axis=1)
+    rgb = numpy.where((mx > 1)[:, None], rgb / numpy.maximum(mx, 1)[:, None], rgb)
+    rgb = numpy.where(rgb > 0.0031308, 1.055 * rgb ** (1 / 2.4) - 0.055, 12.92 * rgb)
+    return numpy.minimum(rgb, 1)
+
+def _np_mired2xy(mired):
+    t = 1e6 / numpy.clip(mired[:, 0], 40, 600)
+    x = numpy.where(t <= 4000,
+            -0.2661239e9 / t ** 3 - 0.2343589e6 / t ** 2 + 0.8776956e3 / t + 0.179910,
+            -3.0258469e9 / t ** 3 + 2.1070379e6 / t ** 2 + 0.2226347e3 / t + 0.240390)
+    y = numpy.select([t <= 2222, t <= 4000], [
+            -1.1063814 * x ** 3 - 1.34811020 * x ** 2 + 2.18555832 * x - 0.20219683,
+            -0.9549476 * x ** 3 - 1.37418593 * x ** 2 + 2.09137015 * x - 0.16748867],
+            3.0817580 * x ** 3 - 5.87338670 * x ** 2 + 3.75112997 * x - 0.37001483)
+    return numpy.stack([x, y], axis=1)
+
+def _np_xy2mired(xy):
+    n = (xy[:, 0] - 0.3320) / (0.1858 - xy[:, 1])
+    cct = 449 * n ** 3 + 3525 * n ** 2 + 6823.3 * n + 5520.33
+    mired = numpy.where(cct <= 0, MIRED_MAX,
+            numpy.rint(1e6 / numpy.where(cct <= 0, 1, cct)))
+    return numpy.clip(mired, MIRED_MIN, MIRED_MAX)[:, None]
+
+
+#
+# Public batch API
+#
+
+def _gamut(gamut):
+    """ The corners of a gamut given by its name in GAMUTS, or the corners
+        themselves as Hue lights report them in capabilities/control/colorgamut.
+    """
+    return GAMUTS[gamut] if isinstance(gamut, str) else gamut
+
+def _batch(vectorized, scalar, colors, *args):
+    """ Run a conversion over all colors with NumPy, or one by one without it. """
+    if len(colors) == 0:
+        return []
+    if numpy is not None:
+        return vectorized(numpy.asarray(colors, dtype=float).reshape(len(colors), -1), *args)
+    return [scalar(*color, *args) for color in colors]
+
+def hsb2rgb(colors):
+    """ [(hue, sat, bri), ...] -> [(r, g, b), ...] """
+    return _batch(_np_hsb2rgb, _hsb2rgb, colors)
+
+def rgb2hsb(colors):
+    """ [(r, g, b), ...] -> [(hue, sat, bri), ...] """
+    return _batch(_np_rgb2hsb, _rgb2hsb, colors)
+
+def rgb2xy(colors, gamut: str = None):
+    """ [(r, g, b), ...] -> [(x, y), ...]
+
+        Parameters
+        ----------
+        gamut : str or list
+            One of GAMUTS or the corners of a gamut; if given, colors out of
+            the gamut are moved to the closest color the bulb can show.
+    """
+    return _batch(_np_rgb2xy, _rgb2xy, colors, _gamut(gamut) if gamut else None)
+
+def xy2rgb(colors):
+    """ [(x, y), ...] -> [(r, g, b), ...] at full brightness """
+    return _batch(_np_xy2rgb, _xy2rgb, colors)
+
+def clamp(colors, gamut):
+    """ Move [(x, y), ...] out of the gamut to the closest color in it.
+        The gamut is one of GAMUTS or its corners.
+    """
+    return _batch(_np_clamp, _clamp, colors, _gamut(gamut))
+
+def mired2xy(mireds):
+    """ [mired, ...] -> [(x, y), ...] """
+    if len(mireds) == 0:
+        return []
+    if numpy is not None:
+        return _np_mired2xy(numpy.asarray(mireds, dtype=float).reshape(-1, 1))
+    return [_mired2xy(m) for m in mireds]
+
+def xy2mired(colors):
+    """ [(x, y), ...] -> [mired, ...] """
+    if len(colors) == 0:
+        return []
+    if numpy is not None:
+        return _np_xy2mired(numpy.asarray(colors, dtype=float).reshape(len(colors), -1))[:, 0]
+    return [_xy2mired(*c) for c in colors]
+
+def hex2rgb(hexes):
+    """ ['rrggbb', ...] -> [(r, g, b), ...] """
+    colors = [tuple(int(h[i:i + 2], 16) / 255 for i in (0, 2, 4)) for h in hexes]
+    if numpy is not None and colors:
+        return numpy.asarray(colors, dtype=float).reshape(len(colors), 3)
+    return colors
+
+def rgb2hex(colors) -> list:
+    """ [(r, g, b), ...] -> ['rrggbb', ...] """
+    return ["%02x%02x%02x" % tuple(int(round(min(max(c, 0), 1) * 255)) for c in color)
+            for color in colors]
+
+def hex2hsb(hexes):
+    """ ['rrggbb', ...] -> [(hue, sat, bri), ...] """
+    return rgb2hsb(hex2rgb(hexes))
+
+def mired2hsb(mireds):
+    """ [mired, ...] -> [(hue, sat, bri), ...] at full brightness """
+    return rgb2hsb(xy2rgb(mired2xy(mireds)))
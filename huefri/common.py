@@ -17,12 +17,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
 import datetime
 import json
+import math
 import os
-import sys
+import threading
+import time
 
-DELTA = datetime.timedelta(seconds=5)
+from huefri import colorspace
+
+# number of recent writes to a main light remembered to recognize their echoes
+ECHOES = 16
+# how long after a write to a main light its echo can still show up, in seconds
+ECHO_EXPIRY = 2
 
 COLORS_MAP = [
         # this is for OpenHab colors
@@ -42,26 +50,132 @@ COLORS_MAP = [
             "hsb": {'on': True, 'hue': 39392, 'sat':  13}},
 ]
 
-def hex2hsb(color_hex: str, brightness: str) -> dict:
-    """ Translate hex+brightness -> hsb """
+# Lookup tables of each color map: id(colors) -> (colors, hex -> hsb, (hue, sat) -> hex)
+_color_tables = {}
+
+def _tables(colors: list) -> tuple:
+    """ Return the lookup tables of a color map, build them on the first
+        call for the map.
+    """
+    tables = _color_tables.get(id(colors))
+    if tables is None or tables[0] is not colors:
+        by_hex = {}
+        by_hue_sat = {}
+        for c in colors:
+            # for duplicates, hex2hsb uses the last entry, hsb2hex the first one
+            by_hex[c['hex']] = dict(c['hsb'])
+            by_hue_sat.setdefault((c['hsb']['hue'], c['hsb']['sat']), c['hex'])
+        tables = _color_tables[id(colors)] = (colors, by_hex, by_hue_sat)
+    return tables
+
+# Size of the grid used to find the nearest color, see _grid().
+HUE_STEPS = 256
+SAT_STEPS = 32
+HUE_MAX = 65536
+SAT_MAX = 255
+
+# id(colors) -> (colors, grid) where grid[hue step][sat step] is the nearest hex
+_nearest_grid = {}
+
+def _wheel(hue: float, sat: float) -> tuple:
+    """ Position of hue/sat on the color wheel, hue is the angle. """
+    angle = 2 * math.pi * hue / HUE_MAX
+    return (sat * math.cos(angle), sat * math.sin(angle))
+
+def _grid(colors: list) -> list:
+    """ Return the grid of nearest colors of a color map, build it on the
+        first call for the map.
+
+        The hue/sat space is split into HUE_STEPS x SAT_STEPS cells and
+        each cell holds the hex of the color closest to its center, so
+        any hue/sat is translated in constant time.
+    """
+    grid = _nearest_grid.get(id(colors))
+    if grid is None or grid[0] is not colors:
+        points = [(_wheel(c['hsb']['hue'], c['hsb']['sat']), c['hex']) for c in colors]
+        cells = []
+        for h in range(0, HUE_STEPS):
+            row = []
+            for s in range(0, SAT_STEPS):
+                x, y = _wheel((h + 0.5) * HUE_MAX / HUE_STEPS, (s + 0.5) * SAT_MAX / SAT_STEPS)
+                row.append(min(points,
+                    key=lambda c: (c[0][0] - x) ** 2 + (c[0][1] - y) ** 2)[1])
+            cells.append(row)
+        grid = _nearest_grid[id(colors)] = (colors, cells)
+    return grid[1]
 
-    color = None
-    for c in COLORS_MAP:
-        if c["hex"] == color_hex:
-            color = c["hsb"]
+def nearest_hex(hue: int, sat: int, colors: list = None) -> str:
+    """ Translate any hue/sat to the hex of the closest known color. """
+    if colors is None:
+        colors = COLORS_MAP
+    if not colors:
+        raise Exception("no colors known")
+    h = int(hue * HUE_STEPS // HUE_MAX) % HUE_STEPS
+    s = min(max(int(sat * SAT_STEPS // SAT_MAX), 0), SAT_STEPS - 1)
+    return _grid(colors)[h][s]
+
+def check_colors(colors: list):
+    """ Raise HuefriException if user-defined colors are not in the same
+        format as COLORS_MAP.
+    """
+    for c in colors:
+        if not isinstance(c.get('hex'), str) or \
+                'hue' not in c.get('hsb', {}) or 'sat' not in c['hsb']:
+            raise HuefriException("bad color in the config: %s" % str(c))
+
+def load_colors(config: dict = None) -> list:
+    """ Return the colors from the config file, or None if there are none
+        and COLORS_MAP is used. Each installation of a config has its own
+        colors, so they don't replace COLORS_MAP.
+    """
+    if config is None:
+        config = Config.get()
+    colors = config.get('colors')
+    if colors is not None:
+        check_colors(colors)
+    return colors
+
+def hex2hsb(color_hex: str, brightness: str, colors: list = None) -> dict:
+    """ Translate hex+brightness -> hsb. Colors not in the color map are
+        converted by their RGB value.
+
+        Parameters
+        ----------
+        colors : list
+            The color map, COLORS_MAP if not given.
+    """
+    if colors is None:
+        colors = COLORS_MAP
+
+    color = _tables(colors)[1].get(color_hex)
 
-    # nothing found = raise an exception
     if color is None:
-        raise Exception("unknown color hex:%s" % color_hex)
+        try:
+            hue, sat, bri = colorspace.hex2hsb([color_hex])[0]
+        except ValueError:
+            raise Exception("unknown color hex:%s" % color_hex)
+        return {'on': True, 'hue': int(hue), 'sat': int(sat), 'bri': brightness}
+
+    # a new dict every time, the table must not be changed
+    hsb = color.copy()
+    hsb['bri'] = brightness
+    return hsb
 
-    color['bri'] = brightness
-    return color
+def hsb2hex(hue: int, sat: int, colors: list = None) -> str:
+    """ Translate hue/sat -> hex, colors not in the color map are translated
+        to the closest one.
 
-def hsb2hex(hue: int, sat: int) -> str:
-    for vals in COLORS_MAP:
-        if hue == vals['hsb']['hue'] and sat == vals['hsb']['sat']:
-            return vals['hex']
-    raise Exception("unknown color h:%d, s:%d" % (hue, sat))
+        Parameters
+        ----------
+        colors : list
+            The color map, COLORS_MAP if not given.
+    """
+    if colors is None:
+        colors = COLORS_MAP
+    color_hex = _tables(colors)[2].get((hue, sat))
+    if color_hex is None:
+        return nearest_hex(hue, sat, colors)
+    return color_hex
 
 def log(where: str, s: str):
     print("[%s] %s: %s" % (str(datetime.datetime.now()), where, s))
@@ -72,7 +186,8 @@ class HuefriException(Exception):
 class Hub(object):
     """ Generic hub class """
 
-    def __init__(self, ip: str, secret: str, main_light: int, lights: list):
+    def __init__(self, ip: str, secret: str, main_light: int, lights: list,
+            colors: list = None):
         """
             Parameters
             ----------
@@ -87,12 +202,196 @@ class Hub(object):
 
             lights : list
                 A list of IDs of lights, which should be controlled.
+
+            colors : list
+                The colors translated between the hubs, in the same format
+                as COLORS_MAP, which is used if not given.
         """
         self.last_changed = datetime.datetime.now();
         self.ip = ip
         self.secret = secret
         self.lights_selected = lights
         self.main_light = main_light
+        self.colors = colors
+
+        # whether the state of the main light was read already
+        self.known = False
+        # writes to the main light which may still show up, oldest first,
+        # each is [fields, when the write ended or None]
+        self.echoes = collections.deque(maxlen=ECHOES)
+        self.echoes_lock = threading.Lock()
+
+    @property
+    def main_state(self) -> dict:
+        """ The last known state of the main light, named as in changed(). """
+        return {}
+
+    def sent(self, state: dict) -> list:
+        """ Remember a state about to be written to the main light by the
+            sync. When the main light changes to it, it is not a change to
+            propagate. Only the fields which differ from the last known
+            state of the main light can show up as a change, so only they
+            are remembered.
+
+            Returns the echo to pass to written() when the write ends, or
+            None if the main light is already in this state.
+
+            Parameters
+            ----------
+            state : dict
+                The written fields, named as in changed().
+        """
+        if self.known:
+            last = self.main_state
+            state = {k: v for k, v in state.items() if k not in last or last[k] != v}
+        if not state:
+            return None
+        echo = [state, None]
+        with self.echoes_lock:
+            self.echoes.append(echo)
+        return echo
+
+    def written(self, echo: list, ok: bool = True):
+        """ The write of an echo returned by sent() ended. A failed write
+            doesn't show up, so its echo is forgotten.
+        """
+        if echo is None:
+            return
+        with self.echoes_lock:
+            if not ok:
+                if echo in self.echoes:
+                    self.echoes.remove(echo)
+            else:
+                echo[1] = time.perf_counter()
+
+    def expire(self, start: float):
+        """ Forget the echoes of writes which ended more than ECHO_EXPIRY
+            before a read of the main light which started at start, a
+            time.perf_counter() value. The read didn't see them, so they
+            were never reached and would only swallow later changes.
+        """
+        with self.echoes_lock:
+            for echo in list(self.echoes):
+                if echo[1] is not None and echo[1] < start - ECHO_EXPIRY:
+                    self.echoes.remove(echo)
+
+    def echo(self, changes: dict) -> bool:
+        """ Test whether changes of the main light are just an echo of one
+            of our writes. The matching write and all older ones are
+            forgotten.
+
+            Parameters
+            ----------
+            changes : dict
+                The fields of the main light which changed and their new
+                values.
+        """
+        with self.echoes_lock:
+            for i, (state, ended) in enumerate(self.echoes):
+                if all(k in state and state[k] == v for k, v in changes.items()):
+                    for _ in range(0, i + 1):
+                        self.echoes.popleft()
+                    return True
+            return False
+
+class StateCache(object):
+    """ The last confirmed state of each light, so writes which wouldn't
+        change anything can be skipped.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # light -> {field: value}
+        self.lights = {}
+        # number of writes skipped because nothing would change
+        self.saved = 0
+
+    def diff(self, lights: list, values: dict) -> dict:
+        """ Return the values which differ from the confirmed state of any
+            of the lights. If nothing differs, a saved write is counted.
+        """
+        with self.lock:
+            confirmed = [self.lights.get(l, {}) for l in lights]
+            diff = {k: v for k, v in values.items()
+                    if any(k not in c or c[k] != v for c in confirmed)}
+            if not diff:
+                self.saved += 1
+            return diff
+
+    def confirm(self, lights: list, values: dict):
+        """ Remember values which were successfully written to the lights. """
+        with self.lock:
+            for l in lights:
+                self.lights.setdefault(l, {}).update(values)
+
+    def check(self, light, state: dict, tolerance: dict = None):
+        """ Forget the light if its observed state differs from the
+            confirmed one, somebody else changed it.
+
+            Parameters
+            ----------
+            tolerance : dict
+                How much each field of an observed state can differ from
+                the confirmed value and still be the same, for fields which
+                are observed less precisely than they are written.
+        """
+        if tolerance is None:
+            tolerance = {}
+        with self.lock:
+            confirmed = self.lights.get(light)
+            if confirmed is not None and \
+                    any(k in state and state[k] != v and
+                        not (k in tolerance and abs(state[k] - v) <= tolerance[k])
+                        for k, v in confirmed.items()):
+                del self.lights[light]
+
+    def invalidate(self, light=None, fields: list = None):
+        """ Forget one light, or all of them, or only some fields of one
+            light.
+        """
+        with self.lock:
+            if light is None:
+                self.lights = {}
+            elif fields is None:
+                self.lights.pop(light, None)
+            else:
+                for k in fields:
+                    self.lights.get(light, {}).pop(k, None)
+
+class Hubs(object):
+    """ Several hubs of the same kind sharing one connection, updated
+        together.
+    """
+
+    def __init__(self, hubs: list):
+        """
+            Parameters
+            ----------
+            hubs : list
+                Hue or Tradfri instances.
+        """
+        self.hubs = hubs
+
+    @property
+    def last_changed(self) -> datetime.datetime:
+        """ When any of the hubs changed last time. """
+        return max(hub.last_changed for hub in self.hubs)
+
+    def update(self):
+        """ Update all the hubs. A failure of one doesn't stop the others,
+            the first exception is raised when all are done.
+        """
+        error = None
+        for hub in self.hubs:
+            try:
+                hub.update()
+            except Exception as err:
+                if error is None:
+                    error = err
+                else:
+                    log("Hubs", err)
+        if error is not None:
+            raise error
 
 class BadConfigPathError(IOError):
     pass
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import collections
+import concurrent.futures
+import time
+import traceback
+
+import pytradfri
+
+from huefri.common import log as log
+from huefri.metrics import METRICS as METRICS
+
+# default time between two updates of a hub, in seconds
+INTERVAL = 1
+# default limit for one update of a hub, in seconds
+TIMEOUT = 10
+# default time between two updates while the lights are being changed
+FAST = 0.15
+# default time after the last change during which the hub is polled fast
+WINDOW = 10
+
+
+class Scheduler(object):
+    """ Decides when to poll a hub next.
+
+        While the lights are being changed, the hub is polled every `fast`
+        seconds. When nothing changes for `window` seconds, the interval is
+        doubled with every poll until it reaches `idle`.
+    """
+
+    def __init__(self, idle: float = INTERVAL, fast: float = FAST, window: float = WINDOW,
+            clock: 'callable' = time.monotonic):
+        """
+            Parameters
+            ----------
+            idle : float
+                The longest interval, used when nothing happens.
+
+            fast : float
+                The interval used while the lights are being changed.
+
+            window : float
+                How long after a change the hub is polled fast.
+
+            clock : callable
+                Returns the current time in seconds.
+        """
+        self.idle = idle
+        self.fast = min(fast, idle)
+        self.window = window
+        self.clock = clock
+        self.interval = idle
+        self.active_until = None
+        # times of the polls in the last minute
+        self.polls = collections.deque()
+
+    def next(self, active: bool) -> float:
+        """ Record a poll and return how long to wait for the next one.
+
+            Parameters
+            ----------
+            active : bool
+                Whether the poll found a change.
+        """
+        now = self.clock()
+        self.polls.append(now)
+        while self.polls[0] < now - 60:
+            self.polls.popleft()
+
+        if active:
+            self.active_until = now + self.window
+        if self.active_until is not None and now < self.active_until:
+            self.interval = self.fast
+        else:
+            self.interval = min(self.interval * 2, self.idle)
+        return self.interval
+
+    @property
+    def polls_per_minute(self) -> int:
+        """ Number of polls in the last minute. """
+        now = self.clock()
+        return len([t for t in self.polls if t >= now - 60])
+
+
+class Watcher(object):
+    """ Periodically update one hub. """
+
+    def __init__(self, name: str, hub: 'Hub', interval: float = INTERVAL, timeout: float = TIMEOUT,
+            fast: float = None, window: float = WINDOW):
+        """
+            Parameters
+            ----------
+            name : str
+                Name used in the log.
+
+            hub : Hub
+                The Hue or Tradfri instance to update.
+
+            interval : float
+                Time between two updates when idle, in seconds.
+
+            timeout : float
+                How long to wait for one update, see tick().
+
+            fast : float
+                Time between two updates after a change, in seconds. If not
+                given, the hub is always updated every `interval` seconds.
+
+            window : float
+                How long after a change the hub is updated fast.
+        """
+        self.name = name
+        self.hub = hub
+        self.timeout = timeout
+        self.scheduler = Scheduler(interval, interval if fast is None else fast, window)
+        # The hub API is blocking, so it runs in a thread. One thread per hub
+        # keeps the updates of the hub in order and a stuck request delays
+        # only this hub, never the other one.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def tick(self):
+        """ Run one update of the hub, raise asyncio.TimeoutError if it
+            takes longer than the timeout.
+
+            The thread can't be stopped, a timed out update goes on until
+            it ends and the updates of the next ticks wait for it. What
+            really bounds an update are the timeouts of the requests to the
+            hub: the connect and read timeouts of the Hue bridge and the
+            request timeout of the Tradfri gateway.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(loop.run_in_executor(self.executor, self.hub.update),
+                self.timeout)
+
+    async def run(self):
+        """ Update the hub forever. """
+        while True:
+            last_changed = self.hub.last_changed
+            try:
+                await self.tick()
+            except asyncio.TimeoutError:
+                METRICS.count("update_timeouts", hub=self.name.lower())
+                log(self.name, "update timed out after %ss" % str(self.timeout))
+            except pytradfri.error.RequestTimeout:
+                """ This exception is raised here and there and doesn't cause anything.
+                    So print just a short notice, not a full stacktrace.
+                """
+                METRICS.count("request_timeouts", hub=self.name.lower())
+                log(self.name, "Tradfri RequestTimeout().")
+            except Exception as err:
+                METRICS.count("update_errors", hub=self.name.lower())
+                traceback.print_exc()
+                log(self.name, err)
+            delay = self.scheduler.next(self.hub.last_changed != last_changed)
+            METRICS.set("interval_seconds", delay, hub=self.name.lower())
+            METRICS.set("polls_per_minute", self.scheduler.polls_per_minute,
+                    hub=self.name.lower())
+            await asyncio.sleep(delay)
+
+    @property
+    def interval(self) -> float:
+        """ The current time between two updates. """
+        return self.scheduler.interval
+
+    def shutdown(self):
+        """ Drop the worker thread, don't wait for a stuck request. """
+        self.executor.shutdown(wait=False)
+
+
+class Engine(object):
+    """ Run watchers of all hubs side by side, each with its own cadence. """
+
+    def __init__(self, watchers: list):
+        """
+            Parameters
+            ----------
+            watchers : list
+                A list of Watcher instances.
+        """
+        self.watchers = watchers
+
+    async def run_async(self):
+        tasks = [asyncio.ensure_future(w.run()) for w in self.watchers]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for w in self.watchers:
+                w.shutdown()
+
+    def run(self):
+        """ Block and run all watchers until interrupted. """
+        asyncio.run(self.run_async())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" The event stream of the Hue bridge.
+
+    Bridges with the CLIP v2 API push every change of the lights as
+    server-sent events, so the lights don't need to be polled to notice a
+    change.
+"""
+
+import json
+import threading
+import time
+
+import requests
+import urllib3
+
+from huefri.common import log as log
+from huefri.metrics import METRICS as METRICS
+
+# the event stream of a bridge, formatted with its address
+EVENTS = "https://%s/eventstream/clip/v2"
+# how long the stream can be silent before it is opened again, in seconds
+IDLE = 300
+# how long to wait before opening the stream again after it dropped
+RETRY = 5
+# the brightness of the events is in percent, the bri converted from it can
+# differ from the written one by this much
+BRI_ERROR = 2
+
+
+def state(item: dict) -> dict:
+    """ The fields of a light changed in an event item, named as in the v1
+        API: on, bri, ct and xy. A color reported as xy can't be translated
+        to hue/sat exactly.
+    """
+    result = {}
+    if 'on' in item:
+        result['on'] = item['on'].get('on')
+    if 'dimming' in item:
+        result['bri'] = max(1, round(item['dimming'].get('brightness', 0) * 254 / 100))
+    if item.get('color_temperature', {}).get('mirek') is not None:
+        result['ct'] = item['color_temperature']['mirek']
+    xy = item.get('color', {}).get('xy')
+    if xy is not None:
+        result['xy'] = [xy.get('x'), xy.get('y')]
+    return result
+
+
+class EventStream(object):
+    """ Follow the event stream of a bridge in a background thread.
+
+        Each listener is called with the ID of a light and its changed
+        fields, see state(), when the bridge reports a change of it, and
+        with None, None whenever the stream was (re)opened, as anything
+        could have changed while it wasn't.
+        While the stream is not open, `connected` is not set and the lights
+        have to be polled.
+    """
+
+    def __init__(self, url: str, user: str, connect_timeout: float, idle: float = IDLE,
+            retry: float = RETRY, verify: bool = False):
+        """
+            Parameters
+            ----------
+            url : str
+                URL of the event stream.
+
+            user : str
+                The secret string generated when pairing with the bridge.
+
+            connect_timeout : float
+                How long connecting to the bridge can take, in seconds.
+
+            idle : float
+                How long the stream can be silent before it is opened again.
+
+            retry : float
+                How long to wait before opening a dropped stream again.
+
+            verify : bool
+                Verify the certificate of the bridge. Bridges have
+                self-signed certificates, so it isn't by default.
+        """
+        self.url = url
+        self.user = user
+        self.timeout = (connect_timeout, idle)
+        self.retry = retry
+        self.verify = verify
+        if not verify:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        # a connection of its own, the stream would block one of the pool
+        self.session = requests.Session()
+        self.listeners = []
+        self.connected = threading.Event()
+        self.thread = None
+        self.closed = False
+
+    def start(self):
+        """ Start following the stream, if it isn't followed yet. """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """ Keep the stream open forever. """
+        while not self.closed:
+            try:
+                self._follow()
+                err = "closed by the bridge"
+            except Exception as e:
+                err = str(e)
+            self.connected.clear()
+            if self.closed:
+                return
+            METRICS.count("stream_drops", hub="hue")
+            log("Hue", "event stream dropped, polling instead: %s" % err)
+            time.sleep(self.retry)
+
+    def _follow(self):
+        """ Open the stream and pass its events on until it ends. """
+        headers = {'hue-application-key': self.user, 'Accept': "text/event-stream"}
+        with self.session.get(self.url, headers=headers, stream=True,
+                timeout=self.timeout, verify=self.verify) as response:
+            response.raise_for_status()
+            self.connected.set()
+            self._notify(None)
+            data = []
+            # the events are passed on as they come, not when a buffer fills
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if self.closed:
+                    return
+                if line:
+                    if line.startswith("data:"):
+                        data.append(line[5:].strip())
+                    continue
+                # an empty line ends an event
+                if data:
+                    self._dispatch("\n".join(data))
+                    data = []
+
+    def _dispatch(self, data: str):
+        """ Notify the listeners about the lights changed in an event. """
+        try:
+            events = json.loads(data)
+        except ValueError:
+            log("Hue", "bad event: %s" % data)
+            return
+        # light -> its changed fields
+        lights = {}
+        for event in events:
+            if event.get('type') != "update":
+                continue
+            for item in event.get('data', []):
+                # the ID of the light in the v1 API, which we use
+                path = item.get('id_v1', "")
+                if path.startswith("/lights/"):
+                    light = int(path[len("/lights/"):])
+                    lights.setdefault(light, {}).update(state(item))
+        METRICS.count("events", len(lights), hub="hue")
+        for light, changed in lights.items():
+            self._notify(light, changed)
+
+    def _notify(self, light: int, changed: dict = None):
+        for listener in self.listeners:
+            try:
+                listener(light, changed)
+            except Exception as err:
+                log("Hue", "event of light %s failed: %s" % (str(light), str(err)))
+
+    def close(self):
+        """ Stop following the stream, after its next event. """
+        self.closed = True
+        self.session.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+
+# number of recent changes kept for the clients following the feed
+HISTORY = 256
+# how long a client waits for a change by default and at most, in seconds
+WAIT = 30
+MAX_WAIT = 60
+
+
+class Feed(object):
+    """ The last known state of every light and a feed of their changes.
+
+        The hubs publish whatever they read from or write to the lights, so
+        other local tools can get the states without asking the hubs. Each
+        change gets a version number; a client passes the last version it
+        has seen to changes() and gets the newer ones, waiting for them if
+        there are none yet.
+
+        The process wide instance is FEED.
+    """
+
+    def __init__(self, history: int = HISTORY):
+        """
+            Parameters
+            ----------
+            history : int
+                How many recent changes are kept for changes().
+        """
+        self.history = history
+        self.cond = threading.Condition()
+        # hub -> light -> {field: value}
+        self.lights = {}
+        self.version = 0
+        # (version, hub, light, changed fields), oldest first
+        self.events = []
+
+    def publish(self, hub: str, light, state: dict):
+        """ Record the state of a light, or a part of it. Fields which stay
+            the same are not a change.
+
+            Parameters
+            ----------
+            hub : str
+                Name of the hub the light belongs to.
+
+            light : int or str
+                ID of the light on its hub.
+
+            state : dict
+                Field -> value.
+        """
+        light = str(light)
+        with self.cond:
+            known = self.lights.setdefault(hub, {}).setdefault(light, {})
+            changes = {k: v for k, v in state.items() if k not in known or known[k] != v}
+            if not changes:
+                return
+            known.update(changes)
+            self.version += 1
+            self.events.append((self.version, hub, light, changes))
+            del self.events[:-self.history]
+            self.cond.notify_all()
+
+    def state(self) -> dict:
+        """ Return the states of all lights and the current version. """
+        with self.cond:
+            return {
+                'version': self.version,
+                'lights': {hub: {l: dict(s) for l, s in lights.items()}
+                    for hub, lights in self.lights.items()},
+            }
+
+    def changes(self, since: int, timeout: float = WAIT) -> dict:
+        """ Return the changes after the version since, wait up to timeout
+            seconds for one if there are none yet.
+
+            If some of the changes are not kept anymore, the states of all
+            lights are returned instead of the changes, as by state().
+        """
+        with self.cond:
+            if since > self.version:
+                # a version of another run
+                return self.state()
+            self.cond.wait_for(lambda: self.version > since, min(timeout, MAX_WAIT))
+            if self.events and self.events[0][0] > since + 1 or \
+                    not self.events and self.version > since:
+                return self.state()
+            return {
+                'version': self.version,
+                'changes': [{'version': v, 'hub': hub, 'light': light, 'state': dict(changes)}
+                    for v, hub, light, changes in self.events if v > since],
+            }
+
+    def reset(self):
+        with self.cond:
+            self.lights = {}
+            self.version = 0
+            self.events = []
+
+
+FEED = Feed()
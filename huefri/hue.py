@@ -17,23 +17,79 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import qhue
 import datetime
+import functools
 import threading
+import time
 from huefri.common import Hub as Hub
+from huefri.common import StateCache as StateCache
 from huefri.common import HuefriException as HuefriException
 from huefri.common import Config as Config
-from huefri.common import DELTA as DELTA
 from huefri.common import log as log
+from huefri.common import load_colors as load_colors
 from huefri.common import hsb2hex as hsb2hex
+from huefri import colorspace
+from huefri.pool import WritePool as WritePool
+from huefri.pool import Debouncer as Debouncer
+from huefri.pool import Limiter as Limiter
+from huefri.pool import WORKERS as WORKERS
+from huefri.pool import DEBOUNCE as DEBOUNCE
+from huefri.pool import RATE as RATE
+from huefri.transport import hue_bridge as hue_bridge
+from huefri.transport import CONNECT_TIMEOUT as CONNECT_TIMEOUT
+from huefri.transport import READ_TIMEOUT as READ_TIMEOUT
+from huefri.metrics import METRICS as METRICS
+from huefri.feed import FEED as FEED
+from huefri.events import EventStream as EventStream
+from huefri.events import EVENTS as EVENTS
+from huefri.events import BRI_ERROR as BRI_ERROR
 
+# fields of the light states published to FEED
+FIELDS = ('on', 'bri', 'hue', 'sat', 'ct', 'xy')
 
 
+class Snapshot(object):
+    """ States of all lights of a bridge, read with a single request.
+
+        Everybody looking at the lights in one cycle sees the same states.
+        Each refresh gets a new version; a reader refreshes the snapshot
+        only when it has already seen the current version, so when several
+        Hue instances share one snapshot, the first of them reads the
+        bridge and the others reuse it.
+    """
+
+    def __init__(self, bridge: 'qhue.Bridge'):
+        self.bridge = bridge
+        self.lights = {}
+        self.version = 0
+        # when the last read started, a time.perf_counter() value
+        self.read_at = 0
+        # number of bridge reads made so far
+        self.reads = 0
+
+    def refresh(self):
+        """ Read the states of all lights with one GET /lights. """
+        self.reads += 1
+        self.read_at = time.perf_counter()
+        self.lights = self.bridge.lights()
+        self.version += 1
+
+    def state(self, light: int) -> dict:
+        """ Return the state of one light as of the last refresh. """
+        return self.lights[str(light)]['state']
+
 
 class Hue(Hub):
     """ Class for Hue lights """
 
-    def __init__(self, ip: str, user: str, main_light: int, lights: list, tradfri: 'Tradfri' = None):
+    # name of the hub in FEED
+    name = "hue"
+
+    def __init__(self, ip: str, user: str, main_light: int, lights: list, tradfri: 'Tradfri' = None,
+            workers: int = WORKERS, create_group: bool = False, debounce: float = DEBOUNCE,
+            rate: float = RATE, connect_timeout: float = CONNECT_TIMEOUT,
+            read_timeout: float = READ_TIMEOUT, events: bool = False, share: 'Hue' = None,
+            colors: list = None):
         """
             Parameters
             ----------
@@ -51,30 +107,235 @@ class Hue(Hub):
 
             tradfri : Tradfri
                 The Tradfri instance we are controlling with the main light.
+
+            workers : int
+                Maximal number of lights written to at the same time. The
+                bridge is talked to over as many keep-alive connections, and
+                one more for reading.
+
+            create_group : bool
+                Create a bridge group of the controlled lights if there
+                is none yet.
+
+            debounce : float
+                How long to wait for a newer state before the lights are
+                changed, in seconds. See set_hsb().
+
+            rate : float
+                Maximal number of commands sent to the bridge per second,
+                0 for no limit. Shared by the instances sharing the bridge.
+
+            connect_timeout : float
+                How long connecting to the bridge can take, in seconds.
+
+            read_timeout : float
+                How long to wait for an answer of the bridge, in seconds.
+
+            events : bool
+                Follow the event stream of the bridge instead of polling the
+                main light. See start_streaming().
+
+            share : Hue
+                Another instance for the same bridge. Its connections, writing
+                pool, snapshot of light states, cache of written states, rate
+                limit and event stream are reused.
+
+            colors : list
+                The colors to translate to Tradfri, COLORS_MAP if not given.
         """
-        super().__init__(ip, user, main_light, lights)
-        self.bridge = qhue.Bridge(ip, user)
+        super().__init__(ip, user, main_light, lights, colors)
+        if share is None:
+            self.bridge, self.adapter = hue_bridge(ip, user, workers + 1,
+                    connect_timeout, read_timeout)
+            self.pool = WritePool(workers, "hue")
+            self.states = Snapshot(self.bridge)
+            self.cache = StateCache()
+            self.limiter = Limiter(rate)
+            self.stream = None
+        else:
+            self.bridge = share.bridge
+            self.adapter = share.adapter
+            self.pool = share.pool
+            self.states = share.states
+            self.cache = share.cache
+            self.stream = share.stream
+            self.limiter = share.limiter
+        if events and self.stream is None:
+            self.stream = EventStream(EVENTS % ip, user, connect_timeout)
+        if self.stream is not None:
+            self.stream.listeners.append(self._event)
+        # update() can be called both by the main loop and the event stream
+        self.lock = threading.Lock()
+        # the version of self.states seen by this instance
+        self.seen = 0
+
+        # the changes of the lights, at most `rate` commands per second to
+        # the bridge, together with the other pairs
+        self.debouncer = Debouncer(self._fan_out, debounce, limiter=self.limiter)
+
+        # ID of a bridge group with exactly the controlled lights
+        self.group = None
+        self.discover_group(create_group)
 
         self.hue = None
         self.bri = None
         self.sat = None
         self.state = None
+        self.ct = None
+        self.xy = None
+        # whether the state above was read already
+        self.known = False
         self.tradfri = tradfri
 
+        # state of the main light in the current cycle
+        self.snapshot = None
+        # number of bridge reads made in the current cycle
+        self.reads = 0
+
     @classmethod
-    def autoinit(cls, tradfri: 'Tradfri' = None):
-        """ Get the constructor arguments automatically from Config class. """
-        config = Config.get()
+    def autoinit(cls, tradfri: 'Tradfri' = None, pair: dict = None, share: 'Hue' = None,
+            config: dict = None):
+        """ Get the constructor arguments automatically from Config class.
+
+            Parameters
+            ----------
+            tradfri : Tradfri
+                The Tradfri instance we are controlling with the main light.
+
+            pair : dict
+                The "hue" part of a pair from the config with the main and
+                controlled lights. The hue section is used if not given.
+
+            share : Hue
+                Another instance to share the connection with.
+
+            config : dict
+                The config to use instead of the one of Config.
+        """
+        if config is None:
+            config = Config.get()
+        colors = load_colors(config)
+        if pair is None:
+            pair = config['hue']
         return cls(config['hue']['addr'],
             config['hue']['secret'],
-            config['hue']['main'],
-            config['hue']['controlled'],
-            tradfri)
+            pair['main'],
+            pair['controlled'],
+            tradfri,
+            config['hue'].get('workers', WORKERS),
+            config['hue'].get('create_group', False),
+            config['hue'].get('debounce', DEBOUNCE),
+            config['hue'].get('rate', RATE),
+            config['hue'].get('connect_timeout', CONNECT_TIMEOUT),
+            config['hue'].get('read_timeout', READ_TIMEOUT),
+            config['hue'].get('events', False),
+            share,
+            colors)
 
     def set_tradfri(self, tradfri: 'Tradfri'):
         self.tradfri = tradfri
 
-    def set_hsb(self, hsb: dict):
+    @property
+    def main_state(self) -> dict:
+        return {'hue': self.hue, 'sat': self.sat, 'ct': self.ct, 'xy': self.xy,
+            'bri': self.bri, 'on': self.state}
+
+    @property
+    def streaming(self) -> bool:
+        """ Whether the changes come from the event stream now. """
+        return self.stream is not None and self.stream.connected.is_set()
+
+    def start_streaming(self):
+        """ Start following the event stream of the bridge.
+
+            The bridge pushes the changes of the lights and a change of the
+            main light is propagated right away from a background thread.
+            While the stream is open, update() doesn't read the bridge at
+            all; when it drops, polling takes over until it is open again.
+        """
+        if self.stream is not None:
+            self.stream.start()
+
+    def _event(self, light: int, changed: dict = None):
+        """ Called by the event stream when a light changed, or with None
+            when the stream was opened.
+        """
+        if changed:
+            # nothing polls the other lights while the stream is open
+            FEED.publish(self.name, light, {k: v for k, v in changed.items() if k in FIELDS})
+        if light is not None and light != self.main_light:
+            if light in self.lights_selected:
+                # our own writes show up as events as well, only a state
+                # other than the written one means somebody else changed it
+                # and it is written in full next time
+                self.cache.check(light, changed or {}, {'bri': BRI_ERROR})
+                if changed and 'xy' in changed:
+                    # the color can't be compared with the written hue/sat
+                    self.cache.invalidate(light, ['hue', 'sat'])
+            return
+        if self.tradfri is None:
+            return
+        with self.lock:
+            # the snapshot may be older than the change, read the bridge
+            self._update(force=True)
+
+    def restore(self, state: dict):
+        """ Start from a state of the main light seen before a restart,
+            so a change made meanwhile is synced on the first look.
+
+            Parameters
+            ----------
+            state : dict
+                The state of the main light as in FEED.
+        """
+        if not state:
+            return
+        self.hue = state.get('hue')
+        self.sat = state.get('sat')
+        self.ct = state.get('ct')
+        self.xy = state.get('xy')
+        self.bri = state.get('bri')
+        self.state = state.get('on')
+        self.known = True
+
+    def discover_group(self, create: bool = False):
+        """ Find a bridge group containing exactly the controlled lights.
+
+            If there is one, set_hsb() changes all the lights with one group
+            action instead of writing to each of them.
+
+            Parameters
+            ----------
+            create : bool
+                Create the group if it doesn't exist.
+        """
+        self.group = None
+        selected = set(str(l) for l in self.lights_selected)
+        try:
+            for id, group in self.bridge.groups().items():
+                if set(group['lights']) == selected:
+                    self.group = id
+                    break
+            else:
+                if create:
+                    resp = self.bridge.groups(name="huefri",
+                            lights=sorted(selected, key=int),
+                            http_method="post")
+                    self.group = resp[0]['success']['id']
+        except Exception as err:
+            log("Hue", "can't get groups: %s" % str(err))
+
+        if self.group is not None:
+            log("Hue", "using group %s" % str(self.group))
+        self._limit()
+
+    def _limit(self):
+        """ Count the commands sent by one change of the lights against
+            the commands per second of the hub, shared by all the pairs.
+        """
+        self.debouncer.cost = 1 if self.group is not None else max(len(self.lights_selected), 1)
+
+    def set_hsb(self, hsb: dict, since: float = None):
         """ Set all controlled Hue lights to this color.
 
             Parameters
@@ -83,11 +344,84 @@ class Hue(Hub):
                 A dictionary that will be passed "as is" to the Hue REST API.
                 The most important fields are: on, hue, sat, bri. See Qhue project
                 description for further info.
+
+            since : float
+                When the change was found on the other hub, a
+                time.perf_counter() value. The time until the lights are
+                written is counted as the sync latency.
+
+            Quickly following changes are coalesced by self.debouncer and
+            only the latest one is sent, see _fan_out().
+        """
+        self.debouncer(hsb, since)
+
+    def flush(self, timeout: float = None) -> bool:
+        """ Send the waiting change right away and wait until the lights
+            are written to. Return False if the timeout expired first.
+        """
+        self.debouncer.flush()
+        return self.pool.join(timeout)
+
+    def _fan_out(self, hsb: dict, since: float = None):
+        """ Change all controlled lights, see set_hsb().
+
+            If the controlled lights form a bridge group, only the group is
+            written to. Otherwise the writes are done asynchronously by
+            self.pool. If the previous write to a light is still waiting, it
+            is replaced by this one.
+
+            Only the fields which differ from what the lights were last set
+            to are sent, and nothing at all if the lights already are in
+            this state, see self.cache.
         """
+        if self.group is not None:
+            self.pool.submit(('group', self.group), self._write, self.lights_selected, hsb,
+                    self._set_hsb_group, since)
+            return
+
         lights = self.bridge.lights
         for l in self.lights_selected:
-            t = threading.Thread(target=self._set_hsb_selected, args=(lights[l], hsb))
-            t.start()
+            self.pool.submit(l, self._write, [l], self._fit(l, hsb),
+                    functools.partial(self._set_hsb_selected, lights[l]), since)
+
+    def _write(self, lights: list, hsb: dict, write: 'callable', since: float = None):
+        """ Send the part of hsb which would change the lights.
+
+            Parameters
+            ----------
+            lights : list
+                IDs of the lights affected by the write.
+
+            hsb : dict
+                The desired state of the lights.
+
+            write : callable
+                Called with the fields to send.
+
+            since : float
+                When the change was found, see set_hsb().
+        """
+        diff = self.cache.diff(lights, hsb)
+        if not diff:
+            METRICS.count("writes_saved", hub="hue")
+            return
+        echo = None
+        if self.main_light in lights:
+            # the changes of the main light to this state are our own
+            echo = self.sent(dict(self._fit(self.main_light, hsb)))
+        try:
+            with METRICS.timer("write", hub="hue"):
+                write(diff)
+        except Exception:
+            METRICS.count("write_failures", hub="hue")
+            self.written(echo, False)
+            raise
+        self.written(echo)
+        self.cache.confirm(lights, diff)
+        for l in lights:
+            FEED.publish(self.name, l, {k: v for k, v in diff.items() if k in FIELDS})
+        if since is not None:
+            METRICS.since("sync", since, hub="hue")
 
     def _set_hsb_selected(self, light, hsb: dict):
         """ Set one specific light to this color.
@@ -103,62 +437,186 @@ class Hue(Hub):
         """
         light.state(**hsb)
 
-    def changed(self):
-        """ Test whether there is any change since the last call. """
+    def _set_hsb_group(self, hsb: dict):
+        """ Set the group of the controlled lights to this color.
+
+            Parameters
+            ----------
+            hsb : dict
+                Passed "as is" to the Hue REST API, see _set_hsb_selected.
+        """
+        self.bridge.groups[self.group].action(**hsb)
+
+    def poll(self, force: bool = False) -> dict:
+        """ Get the state of the main light and keep it as the snapshot
+            for the current cycle.
+
+            The states of all lights are read at once by self.states, unless
+            another instance sharing it did so already in this cycle.
+            Controlled lights changed by someone else are dropped from
+            self.cache, so the next write to them is sent in full.
+
+            Parameters
+            ----------
+            force : bool
+                Read the bridge even if the snapshot wasn't seen yet, when
+                the main light is known to have changed since.
+        """
+        if force or self.seen == self.states.version:
+            self.reads += 1
+            self.states.refresh()
+            for light, data in self.states.lights.items():
+                state = data.get('state', {})
+                FEED.publish(self.name, light, {k: state[k] for k in FIELDS if k in state})
+        self.seen = self.states.version
+        self.snapshot = self.states.state(self.main_light)
+        for l in self.lights_selected:
+            light = self.states.lights.get(str(l))
+            if light is not None:
+                self.cache.check(l, light['state'])
+        return self.snapshot
+
+    def changed(self, force: bool = False):
+        """ Test whether there is any change since the last call. With
+            force, the bridge is read, see poll().
+        """
         if self.tradfri is None:
             raise HuefriException("Tradfri object was not passed to Hue.")
 
-        main = self.bridge.lights[self.main_light]()['state']
-
-        change = False
-        hue = main['hue']
-        sat = main['sat']
-        bri = main['bri']
-        state = main['on']
-
-        if hue != self.hue:
-            change = True
-            self.hue = hue
-        if bri != self.bri:
-            change = True
-            self.bri = bri
-        if sat != self.sat:
-            change = True
-            self.sat = sat
-        if state != self.state:
-            change = True
-            self.state = state
-
-        if self.tradfri.last_changed > datetime.datetime.now() - DELTA:
-            """ If the other side changed within DELTA time, any change
-                we found is likely caused by the sync and not by a manual
-                control.  So, skip any operation.
+        METRICS.count("polls", hub="hue")
+        with METRICS.timer("read", hub="hue"):
+            main = self.poll(force)
+        start = self.states.read_at
+
+        # white ambiance bulbs have only ct, no hue and sat
+        current = {
+            'hue': main.get('hue'),
+            'sat': main.get('sat'),
+            'ct': main.get('ct'),
+            'xy': main.get('xy'),
+            'bri': main['bri'],
+            'on': main['on'],
+        }
+        previous = self.main_state
+        # a light set by xy has hue, sat and ct computed from it by the
+        # bridge, only xy itself is the change
+        if main.get('colormode') == 'xy':
+            fields = ('xy', 'bri', 'on')
+        else:
+            fields = ('hue', 'sat', 'ct', 'bri', 'on')
+        changes = {k: current[k] for k in fields if previous[k] != current[k]}
+
+        self.hue = current['hue']
+        self.sat = current['sat']
+        self.ct = current['ct']
+        self.xy = current['xy']
+        self.bri = current['bri']
+        self.state = current['on']
+
+        if not self.known:
+            # the first look at the light, there is nothing to compare with
+            self.known = True
+            return False
+        echo = bool(changes) and self.echo(changes)
+        self.expire(start)
+        if not changes:
+            return False
+        if echo:
+            """ The main light just got to a state written by the sync,
+                it is not a change by the user. Anything else is.
             """
             log("Hue", "tradfri sync skipped")
-            change = False
-
-        return change
+            METRICS.count("echoes", hub="hue")
+            return False
+        METRICS.count("changes", hub="hue")
+        return True
 
     def update(self):
         """ Check if the main light changed since the last call of this function
             and if yes, propagate the change to other lights.
+
+            The main light is read only once per call; changed() takes the
+            snapshot and it is reused here. While the event stream is open,
+            the bridge tells us about the changes and nothing is read here.
         """
+        with self.lock:
+            if self.streaming:
+                return
+            self._update()
+
+    def _update(self, force: bool = False):
+        self.reads = 0
+        self.snapshot = None
+        start = time.perf_counter()
 
-        if self.changed():
-            main = self.bridge.lights[self.main_light]()['state']
-            hue = main['hue']
-            sat = main['sat']
+        if self.changed(force):
+            main = self.snapshot if self.snapshot is not None else self.poll()
             bri = main['bri']
             state = main['on']
 
             self.last_changed = datetime.datetime.now()
+            with METRICS.timer("translate", hub="hue"):
+                rgb = self._hex(main)
+                xy, mireds = self._xy_mireds(main)
             if state:
-                rgb = hsb2hex(hue, sat)
                 log("Hue", "send to tradfri: %s, %s" % (rgb, str(bri)))
-                self.tradfri.set_all(rgb, bri)
+                self.tradfri.set_all(rgb, bri, start, xy, mireds)
             else:
-                rgb = hsb2hex(hue, sat)
                 log("Hue", "turn off")
-                self.tradfri.set_all(rgb, 0)
+                self.tradfri.set_all(rgb, 0, start)
+
+    def _hex(self, main: dict) -> str:
+        """ Translate the state of a light to a Tradfri color. """
+        if 'hue' not in main and 'ct' in main:
+            # white ambiance bulbs know only the color temperature
+            hue, sat, bri = colorspace.mired2hsb([main['ct']])[0]
+            return hsb2hex(int(hue), int(sat), self.colors)
+        return hsb2hex(main['hue'], main['sat'], self.colors)
+
+    def _xy_mireds(self, main: dict) -> tuple:
+        """ Translate the state of a light to CIE xy for color bulbs and
+            to a color temperature in mireds for white spectrum ones.
+        """
+        mode = main.get('colormode')
+        if mode == 'ct' or ('hue' not in main and 'ct' in main):
+            mireds = main['ct']
+            xy = colorspace.mired2xy([mireds])[0]
+        elif mode == 'xy' and 'xy' in main:
+            xy = main['xy']
+            mireds = colorspace.xy2mired([xy])[0]
+        else:
+            rgb = colorspace.hsb2rgb([(main['hue'], main['sat'], colorspace.BRI_MAX)])
+            xy = colorspace.rgb2xy(rgb)[0]
+            mireds = colorspace.xy2mired([xy])[0]
+        return (float(xy[0]), float(xy[1])), int(mireds)
+
+    def _fit(self, light: int, hsb: dict) -> dict:
+        """ Fit a color given as xy to what a light can show, as reported
+            in its capabilities: clamp it to the gamut of a color light,
+            turn it into a color temperature for a white ambiance one and
+            leave it out for a light without colors. Lights whose
+            capabilities are not known are left to the bridge.
+        """
+        if 'xy' not in hsb:
+            return hsb
+        data = self.states.lights.get(str(light), {})
+        control = data.get('capabilities', {}).get('control')
+        if not control:
+            return hsb
+        hsb = dict(hsb)
+        xy = hsb.pop('xy')
+        gamut = control.get('colorgamut')
+        if not gamut and control.get('colorgamuttype') in colorspace.GAMUTS:
+            gamut = control['colorgamuttype']
+        if gamut:
+            x, y = colorspace.clamp([xy], gamut)[0]
+            # the bridge keeps 4 decimals, what it reports must match
+            hsb['xy'] = [round(float(x), 4), round(float(y), 4)]
+        elif 'ct' in control:
+            mireds = colorspace.xy2mired([xy])[0]
+            limits = control['ct']
+            hsb['ct'] = int(min(max(mireds, limits.get('min', colorspace.MIRED_MIN)),
+                limits.get('max', colorspace.MIRED_MAX)))
+        return hsb
 
 
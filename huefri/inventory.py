@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import threading
+
+from huefri.common import HuefriException as HuefriException
+from huefri.common import log as log
+
+# default file with the cached devices, next to config.json
+CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "tradfri_devices.json")
+
+
+class Inventory(object):
+    """ The devices of a Tradfri gateway.
+
+        Reading all devices takes a request for each of them, so the IDs and
+        capabilities of the devices are cached on disk. With the cache, only
+        the lights which are actually used are fetched at startup, see need(),
+        and the rest is checked in the background, see revalidate().
+    """
+
+    def __init__(self, api: 'callable', gateway: 'Gateway', path: str = None, addr: str = None):
+        """
+            Parameters
+            ----------
+            api : callable
+                The request function of the Tradfri API.
+
+            gateway : Gateway
+                Makes the pytradfri commands.
+
+            path : str
+                The cache file. Nothing is cached if not given.
+
+            addr : str
+                Address of the gateway, a cache of another gateway is ignored.
+        """
+        self.api = api
+        self.gateway = gateway
+        self.path = path
+        self.addr = addr
+        self.lock = threading.Lock()
+        # [{'id': ..., 'light': ..., 'name': ...}] of all devices, in the
+        # order of the gateway
+        self.entries = []
+        # fetched devices, by their ID
+        self.fetched = {}
+        # IDs of the lights and the fetched lights (None if not fetched),
+        # indexed the same way as in the config
+        self.ids = []
+        self.lights = []
+        # called with True or False when revalidate() finds whether the
+        # lights changed, see listen()
+        self.listeners = []
+        # what the last revalidate() found, None until it is done
+        self.revalidated = None
+        self.thread = None
+        self.saving = threading.Lock()
+
+    def _index(self):
+        """ Rebuild the index of lights, self.lock must be held. """
+        self.ids = [e['id'] for e in self.entries if e['light']]
+        self.lights = [self.fetched.get(id) for id in self.ids]
+
+    def load(self) -> bool:
+        """ Read the cache, return False if there is none to use. """
+        if self.path is None:
+            return False
+        try:
+            with open(self.path, 'r') as h:
+                cache = json.load(h)
+            if cache['addr'] != self.addr:
+                return False
+            entries = [{'id': e['id'], 'light': e['light'], 'name': e.get('name')}
+                    for e in cache['devices']]
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        with self.lock:
+            self.entries = entries
+            self._index()
+        return True
+
+    def save(self):
+        """ Write the cache. """
+        if self.path is None:
+            return
+        with self.lock:
+            cache = {'addr': self.addr, 'devices': self.entries}
+        tmp = self.path + ".tmp"
+        try:
+            with self.saving:
+                with open(tmp, 'w') as h:
+                    json.dump(cache, h, indent=1)
+                os.replace(tmp, self.path)
+        except IOError as err:
+            log("Tradfri", "can't write the device cache: %s" % str(err))
+
+    def need(self, indexes: list):
+        """ Fetch the lights with these indexes, if they aren't yet. """
+        with self.lock:
+            ids = self.ids
+        missing = []
+        for i in indexes:
+            if i >= len(ids):
+                raise HuefriException("There is no Tradfri light %d." % i)
+            if ids[i] not in self.fetched and ids[i] not in missing:
+                missing.append(ids[i])
+        if not missing:
+            return
+        devices = self.api([self.gateway.get_device(id) for id in missing])
+        with self.lock:
+            for dev in devices:
+                self.fetched[dev.id] = dev
+            self._index()
+
+    def scan(self) -> bool:
+        """ Fetch all devices from the gateway and rebuild the index of
+            lights. Return True if the lights are different than before.
+        """
+        devices = self.api(self.api(self.gateway.get_devices()))
+        entries = [{'id': dev.id, 'light': bool(dev.has_light_control), 'name': dev.name}
+                for dev in devices]
+        with self.lock:
+            ids = self.ids
+            self.entries = entries
+            # keep the devices fetched before, the observation of the main
+            # light updates the one it was started on
+            self.fetched = {dev.id: self.fetched.get(dev.id, dev) for dev in devices}
+            self._index()
+            changed = ids != self.ids
+        self.save()
+        return changed
+
+    def listen(self, listener: 'callable'):
+        """ Call listener with the result of every revalidate(). If one is
+            done already, the listener gets its result right away, so no
+            change is missed by a listener added after the scan finished.
+        """
+        with self.lock:
+            self.listeners.append(listener)
+            changed = self.revalidated
+        if changed is not None:
+            listener(changed)
+
+    def revalidate(self):
+        """ Scan the gateway in the background and tell self.listeners
+            whether the lights changed.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._revalidate, daemon=True)
+        self.thread.start()
+
+    def _revalidate(self):
+        try:
+            changed = self.scan()
+        except Exception as err:
+            log("Tradfri", "can't check the cached devices: %s" % str(err))
+            return
+        if changed:
+            log("Tradfri", "the cached lights were outdated, check the indexes in the config")
+        with self.lock:
+            self.revalidated = changed
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(changed)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import contextlib
+import threading
+import time
+
+# upper bounds of the latency buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+    """ Counts of values in buckets with fixed upper bounds. Values above
+        the last bound fall into an extra bucket.
+    """
+
+    def __init__(self, bounds: tuple = BUCKETS):
+        """
+            Parameters
+            ----------
+            bounds : tuple
+                Sorted upper bounds of the buckets.
+        """
+        self.bounds = tuple(bounds)
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        """ Count one value. """
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+
+    @property
+    def mean(self) -> float:
+        with self.lock:
+            return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """ Return the upper bound of the bucket with the p-th percentile,
+            infinity if it is above the last bound.
+        """
+        with self.lock:
+            if not self.count:
+                return 0.0
+            wanted = p / 100 * self.count
+            seen = 0
+            for bound, count in zip(self.bounds, self.counts):
+                seen += count
+                if seen >= wanted:
+                    return bound
+            return float('inf')
+
+    def dict(self) -> dict:
+        """ Return the counts, keyed by the bucket names. """
+        with self.lock:
+            buckets = {"<=%s" % str(b): c for b, c in zip(self.bounds, self.counts)}
+            buckets[">%s" % str(self.bounds[-1])] = self.counts[-1]
+            return {
+                'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'buckets': buckets,
+            }
+
+
+class Metrics(object):
+    """ Counters, current values and latency histograms, each with a name
+        and labels.
+
+        The process wide instance is METRICS. text() renders everything in
+        the Prometheus text format, so the p99 of the sync latency can be
+        alerted on with histogram_quantile().
+    """
+
+    def __init__(self, prefix: str = "huefri"):
+        """
+            Parameters
+            ----------
+            prefix : str
+                Put before all the names in text().
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # (name, labels) -> value or Histogram, labels are sorted tuples
+        self.counters = {}
+        self.values = {}
+        self.histograms = {}
+
+    def count(self, name: str, n: int = 1, **labels):
+        """ Add n to a counter. """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name: str, value: float, **labels):
+        """ Set a value which can go up and down, like the current polling
+            interval.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name: str, ms: float, **labels):
+        """ Add a latency in milliseconds to a histogram. """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+        histogram.add(ms)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """ Observe how long the with block takes. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000, **labels)
+
+    def since(self, name: str, start: float, **labels):
+        """ Observe the time from start, a time.perf_counter() value. """
+        self.observe(name, (time.perf_counter() - start) * 1000, **labels)
+
+    def get(self, name: str, **labels):
+        """ Return a counter, a value or a histogram, in this order. """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key in self.counters:
+                return self.counters[key]
+            if key in self.values:
+                return self.values[key]
+            return self.histograms.get(key)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.values = {}
+            self.histograms = {}
+
+    def export(self) -> dict:
+        """ Return everything as plain data which can be sent to another
+            process and merged there, see merge().
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            values = dict(self.values)
+            histograms = dict(self.histograms)
+        exported = {'counters': counters, 'values': values, 'histograms': {}}
+        for key, h in histograms.items():
+            with h.lock:
+                exported['histograms'][key] = (h.bounds, list(h.counts), h.count, h.total)
+        return exported
+
+    def merge(self, exported: dict, **labels):
+        """ Add the counters and histograms returned by export() of another
+            instance, with the given labels added to them. Its values replace
+            the ones with the same labels.
+        """
+        extra = tuple(labels.items())
+        for (name, old), value in exported['counters'].items():
+            key = (name, tuple(sorted(old + extra)))
+            with self.lock:
+                self.counters[key] = self.counters.get(key, 0) + value
+        for (name, old), value in exported.get('values', {}).items():
+            key = (name, tuple(sorted(old + extra)))
+            with self.lock:
+                self.values[key] = value
+        for (name, old), (bounds, counts, count, total) in exported['histograms'].items():
+            key = (name, tuple(sorted(old + extra)))
+            with self.lock:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(bounds)
+            with histogram.lock:
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.total += total
+
+    def dict(self) -> dict:
+        """ Return the counters, the values and the percentiles of the
+            histograms.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            values = dict(self.values)
+            histograms = dict(self.histograms)
+        result = {'counters': {}, 'values': {}, 'latency': {}}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'][_name(name, labels)] = value
+        for (name, labels), value in sorted(values.items()):
+            result['values'][_name(name, labels)] = value
+        for (name, labels), h in sorted(histograms.items()):
+            result['latency'][_name(name, labels)] = {
+                'count': h.count,
+                'mean': h.mean,
+                'p50': h.percentile(50),
+                'p95': h.percentile(95),
+                'p99': h.percentile(99),
+            }
+        return result
+
+    def text(self) -> str:
+        """ Render everything in the Prometheus text format. """
+        with self.lock:
+            counters = dict(self.counters)
+            values = dict(self.values)
+            histograms = dict(self.histograms)
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            name = "%s_%s_total" % (self.prefix, name)
+            lines.append("%s %s" % (_name(name, labels), str(value)))
+        for (name, labels), value in sorted(values.items()):
+            name = "%s_%s" % (self.prefix, name)
+            lines.append("%s %s" % (_name(name, labels), str(value)))
+        for (name, labels), h in sorted(histograms.items()):
+            name = "%s_%s_ms" % (self.prefix, name)
+            with h.lock:
+                counts = list(h.counts)
+                count = h.count
+                total = h.total
+            seen = 0
+            for bound, n in zip(h.bounds, counts):
+                seen += n
+                lines.append("%s %d" % (_name(name + "_bucket", labels + (('le', str(bound)),)), seen))
+            lines.append("%s %d" % (_name(name + "_bucket", labels + (('le', "+Inf"),)), count))
+            lines.append("%s %s" % (_name(name + "_sum", labels), repr(total)))
+            lines.append("%s %d" % (_name(name + "_count", labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _name(name: str, labels: tuple) -> str:
+    """ Return name{label="value",...} """
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (k, str(v)) for k, v in labels))
+
+
+METRICS = Metrics()
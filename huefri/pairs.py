@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from huefri.common import Config as Config
+from huefri.common import Hubs as Hubs
+from huefri.engine import Watcher as Watcher
+from huefri.engine import INTERVAL as INTERVAL
+from huefri.engine import TIMEOUT as TIMEOUT
+from huefri.engine import FAST as FAST
+from huefri.engine import WINDOW as WINDOW
+from huefri.hue import Hue as Hue
+from huefri.tradfri import Tradfri as Tradfri
+
+
+def autoinit(config: dict = None, name: str = None) -> list:
+    """ Create the Hue and Tradfri instances for all pairs in the config.
+
+        The config can list any number of pairs of watched and controlled
+        lights:
+
+            "pairs": [
+                {"hue": {"main": 1, "controlled": [2, 3]},
+                 "tradfri": {"main": 0, "controlled": [0, 1]}},
+                ...
+            ]
+
+        Without "pairs", the main and controlled lights of the hue and tradfri
+        sections make a single pair. All instances of one kind share a single
+        connection to their hub.
+
+        Parameters
+        ----------
+        config : dict
+            The config to use instead of the one of Config.
+
+        name : str
+            Name of the installation, the lights of its hubs are named
+            "<name>/hue" and "<name>/tradfri" in FEED.
+
+        Returns a list of (Hue, Tradfri) tuples.
+    """
+    if config is None:
+        config = Config.get()
+    pairs = config.get('pairs', [config])
+
+    result = []
+    hue_share = None
+    tradfri_share = None
+    for pair in pairs:
+        hue = Hue.autoinit(pair=pair['hue'], share=hue_share, config=config)
+        tradfri = Tradfri.autoinit(hue, pair=pair['tradfri'], share=tradfri_share,
+                config=config)
+        hue.set_tradfri(tradfri)
+        if name is not None:
+            hue.name = "%s/%s" % (name, hue.name)
+            tradfri.name = "%s/%s" % (name, tradfri.name)
+        hue_share = hue_share or hue
+        tradfri_share = tradfri_share or tradfri
+        result.append((hue, tradfri))
+    return result
+
+def hubs(pairs: list) -> tuple:
+    """ Group the instances created by autoinit() by their hub.
+
+        Returns a (Hubs of Hue, Hubs of Tradfri) tuple. Updating the Hue
+        ones reads the states of all their main lights with one request.
+    """
+    return (Hubs([hue for hue, tradfri in pairs]),
+            Hubs([tradfri for hue, tradfri in pairs]))
+
+def watchers(pairs: list, config: dict = None, name: str = None) -> list:
+    """ Return the Watchers of the hubs of the pairs created by autoinit(),
+        with the intervals and timeouts from the config.
+
+        Parameters
+        ----------
+        config : dict
+            The config to use instead of the one of Config.
+
+        name : str
+            Name of the installation, put before the names of the watchers.
+    """
+    if config is None:
+        config = Config.get()
+    hues, tradfris = hubs(pairs)
+    result = []
+    for kind, hub in [("Tradfri", tradfris), ("Hue", hues)]:
+        section = config[kind.lower()]
+        result.append(Watcher(kind if name is None else "%s/%s" % (name, kind), hub,
+            section.get('interval', INTERVAL),
+            section.get('timeout', TIMEOUT),
+            section.get('fast_interval', FAST),
+            section.get('active_window', WINDOW)))
+    return result
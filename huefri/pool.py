@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import threading
+import time
+
+from huefri.common import log as log
+from huefri.metrics import METRICS as METRICS
+
+# default number of threads writing to lights
+WORKERS = 8
+# default time without a new state before the latest one is sent, in seconds
+DEBOUNCE = 0.1
+# default limit of commands sent to a hub per second, the Hue bridge
+# handles about 10
+RATE = 10
+
+
+class WritePool(object):
+    """ A bounded pool of threads for writing to lights.
+
+        Writes to one light are done one at a time and in order. When a new
+        write for a light comes while an older one is still waiting, the
+        older one is dropped, so only the latest state gets to the light.
+
+        The number of waiting writes is in METRICS as pool_depth, the
+        dropped and the failed writes as pool_coalesced and pool_failed.
+    """
+
+    def __init__(self, workers: int = WORKERS, hub: str = None):
+        """
+            Parameters
+            ----------
+            workers : int
+                Maximal number of lights written to at the same time.
+
+            hub : str
+                The hub label of the metrics of the pool.
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # key -> (function, args) of the latest write waiting for a light
+        self.pending = {}
+        # keys with a worker assigned
+        self.busy = set()
+
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.labels = {} if hub is None else {'hub': hub}
+
+    def submit(self, key, fn, *args):
+        """ Call fn(*args) in the pool, replacing any waiting call with the
+            same key.
+
+            Parameters
+            ----------
+            key : hashable
+                Identifies the light, usually its ID.
+
+            fn : callable
+                The function doing the write.
+        """
+        with self.lock:
+            if key in self.pending:
+                self.coalesced += 1
+                METRICS.count("pool_coalesced", **self.labels)
+            self.pending[key] = (fn, args)
+            METRICS.set("pool_depth", len(self.pending), **self.labels)
+            if key in self.busy:
+                # the worker of this light picks it up when it's done
+                return
+            self.busy.add(key)
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        """ Do writes for one light until there is none waiting. """
+        while True:
+            with self.lock:
+                job = self.pending.pop(key, None)
+                METRICS.set("pool_depth", len(self.pending), **self.labels)
+                if job is None:
+                    self.busy.discard(key)
+                    self.idle.notify_all()
+                    return
+
+            fn, args = job
+            try:
+                fn(*args)
+                with self.lock:
+                    self.written += 1
+            except Exception as err:
+                with self.lock:
+                    self.failed += 1
+                METRICS.count("pool_failed", **self.labels)
+                log("Pool", "write to %s failed: %s" % (str(key), str(err)))
+
+    def join(self, timeout: float = None) -> bool:
+        """ Wait until all submitted writes are done.
+            Return False if the timeout expired first.
+        """
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.busy, timeout)
+
+    @property
+    def depth(self) -> int:
+        """ Number of writes waiting for a worker. """
+        with self.lock:
+            return len(self.pending)
+
+    def stats(self) -> dict:
+        """ Return the counters of the pool. """
+        with self.lock:
+            return {
+                'depth': len(self.pending),
+                'written': self.written,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+            }
+
+
+class Limiter(object):
+    """ The commands per second a hub can take, shared by everybody
+        writing to it.
+    """
+
+    def __init__(self, rate: float = RATE):
+        """
+            Parameters
+            ----------
+            rate : float
+                Maximal number of commands per second, 0 for no limit.
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        # when the next command can be sent, a time.monotonic() value
+        self.free = 0
+
+    def take(self, commands: int):
+        """ Spend the time of the commands about to be sent. """
+        if not self.rate:
+            return
+        with self.lock:
+            self.free = max(time.monotonic(), self.free) + commands / self.rate
+
+
+class Debouncer(object):
+    """ Forward only the latest of quickly following calls.
+
+        A call is forwarded when no newer one came for `delay` seconds. While
+        the calls keep coming, like when a dimmer button is held, the latest
+        one is forwarded every `cost`/rate seconds, so the lights still
+        follow. Either way, a call is forwarded only when the limiter has
+        time for the `cost` commands it sends, so all the debouncers sharing
+        a limiter together send at most `rate` commands per second. With
+        both delay and rate 0, fn is called right away.
+    """
+
+    def __init__(self, fn: 'callable', delay: float = DEBOUNCE, rate: float = RATE,
+            limiter: Limiter = None):
+        """
+            Parameters
+            ----------
+            fn : callable
+                The function to forward the calls to.
+
+            delay : float
+                How long to wait for a newer call, in seconds.
+
+            rate : float
+                Maximal number of commands per second, 0 for no limit. Not
+                used with a limiter.
+
+            limiter : Limiter
+                The limit of the hub, shared with other debouncers.
+        """
+        self.fn = fn
+        self.delay = delay
+        self.limiter = Limiter(rate) if limiter is None else limiter
+        # number of commands sent by one forwarded call
+        self.cost = 1
+        self.cond = threading.Condition()
+        # held while a call is being forwarded, keeps the calls in order
+        self.forwarding = threading.Lock()
+        # arguments of the latest call waiting to be forwarded
+        self.pending = None
+        # when the waiting calls started to come and when the last one came
+        self.since = None
+        self.last = None
+        self.thread = None
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def __call__(self, *args):
+        if not self.delay and not self.limiter.rate:
+            self.calls += 1
+            self.fn(*args)
+            return
+
+        with self.cond:
+            now = time.monotonic()
+            if self.pending is None:
+                self.since = now
+            else:
+                self.coalesced += 1
+            self.pending = args
+            self.last = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    @property
+    def rate(self) -> float:
+        """ Maximal number of forwarded calls per second. """
+        return self.limiter.rate / self.cost
+
+    @property
+    def period(self) -> float:
+        """ The shortest time between two forwarded calls. """
+        return self.cost / self.limiter.rate if self.limiter.rate else 0
+
+    def _due(self) -> float:
+        """ When the waiting call should be forwarded. """
+        due = self.last + self.delay
+        if self.period:
+            due = min(due, self.since + self.period)
+        return max(due, self.limiter.free)
+
+    def _run(self):
+        """ Forward the waiting calls when they are due. """
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                wait = self._due() - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+            self.flush()
+
+    def flush(self):
+        """ Forward the waiting call now, if there is one. """
+        with self.forwarding:
+            with self.cond:
+                args = self.pending
+                if args is None:
+                    return
+                self.pending = None
+                self.calls += 1
+            self.limiter.take(self.cost)
+            try:
+                self.fn(*args)
+            except Exception as err:
+                log("Debouncer", "forwarding failed: %s" % str(err))
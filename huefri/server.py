@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import http.server
+import json
+import os
+import socketserver
+import threading
+import urllib.parse
+
+from huefri.common import log as log
+from huefri.feed import FEED as FEED
+from huefri.feed import WAIT as WAIT
+from huefri.metrics import METRICS as METRICS
+
+# default address of the local HTTP server
+ADDR = "127.0.0.1"
+PORT = 9120
+
+
+class Server(object):
+    """ A small local HTTP server running in a background thread.
+
+        Each route is a path and a function returning a (content type, body)
+        tuple for GET requests of that path. The function gets the query
+        of the request as a dict.
+    """
+
+    def __init__(self, addr: str = ADDR, port: int = PORT, routes: dict = None,
+            socket: str = None):
+        """
+            Parameters
+            ----------
+            addr : str
+                Address to listen on, keep it local.
+
+            port : int
+                Port to listen on, 0 picks a free one.
+
+            routes : dict
+                Path -> function. The metrics and the states of the lights
+                are served by default.
+
+            socket : str
+                Path of a Unix socket to listen on instead of addr and port.
+        """
+        self.routes = {
+            "/metrics": metrics_text,
+            "/metrics.json": metrics_json,
+            "/lights": lights_json,
+            "/events": events_json,
+        }
+        if routes is not None:
+            self.routes.update(routes)
+        self.socket = socket
+        if socket is None:
+            self.httpd = http.server.ThreadingHTTPServer((addr, port), self._handler())
+        else:
+            if os.path.exists(socket):
+                # left behind by a previous run
+                os.unlink(socket)
+            self.httpd = socketserver.ThreadingUnixStreamServer(socket, self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    @property
+    def where(self) -> str:
+        if self.socket is not None:
+            return self.socket
+        return "%s:%d" % (self.httpd.server_address[0], self.port)
+
+    def _handler(self):
+        routes = self.routes
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                route = routes.get(url.path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+                try:
+                    content_type, body = route(query)
+                except ValueError:
+                    self.send_error(400)
+                    return
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+            def address_string(self):
+                # clients of a Unix socket have no address
+                return str(self.client_address)
+
+        return Handler
+
+    def start(self):
+        """ Serve in a background thread. """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        log("Server", "listening on %s" % self.where)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.socket is not None and os.path.exists(self.socket):
+            os.unlink(self.socket)
+
+
+def metrics_text(query: dict) -> tuple:
+    """ The metrics in the Prometheus text format. """
+    return ("text/plain; version=0.0.4", METRICS.text())
+
+
+def metrics_json(query: dict) -> tuple:
+    """ The counters and the latency percentiles as JSON. """
+    return ("application/json", json.dumps(METRICS.dict()))
+
+
+def lights_json(query: dict) -> tuple:
+    """ The last known states of all lights, as huefri saw them. """
+    return ("application/json", json.dumps(FEED.state()))
+
+
+def events_json(query: dict) -> tuple:
+    """ The changes of the lights after the version in ?since=, waits up
+        to ?timeout= seconds for the next one (long polling).
+    """
+    since = int(query.get('since', 0))
+    timeout = float(query.get('timeout', WAIT))
+    return ("application/json", json.dumps(FEED.changes(since, timeout)))
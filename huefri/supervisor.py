@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Run many installations, each a bridge and a gateway with their pairs,
+    in several worker processes.
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import huefri.pairs
+from huefri.common import Config as Config
+from huefri.common import log as log
+from huefri.engine import Engine as Engine
+from huefri.feed import FEED as FEED
+from huefri.inventory import CACHE as CACHE
+from huefri.metrics import METRICS as METRICS
+from huefri.metrics import Metrics as Metrics
+from huefri.server import Server as Server
+from huefri.server import ADDR as ADDR
+from huefri.server import PORT as PORT
+
+# default number of worker processes
+WORKERS = os.cpu_count() or 1
+# seconds between two reports of a worker to the supervisor
+REPORT = 1
+# seconds before a crashed worker is started again, doubled with each crash
+# up to MAX_RESTART
+RESTART = 1
+MAX_RESTART = 60
+
+
+def installations(config: dict) -> list:
+    """ Return (name, config) of each installation in the config.
+
+        Each item of "installations" is a config of its own, as for a single
+        installation. Top level "colors" are used by the installations which
+        don't have their own. Installations are named by their "name", or
+        their index, and each has its own cache of the Tradfri devices.
+    """
+    result = []
+    for i, installation in enumerate(config['installations']):
+        installation = dict(installation)
+        name = str(installation.get('name', i))
+        if 'colors' in config:
+            installation.setdefault('colors', config['colors'])
+        tradfri = installation['tradfri'] = dict(installation['tradfri'])
+        if 'cache' not in tradfri:
+            base, ext = os.path.splitext(CACHE)
+            tradfri['cache'] = "%s.%s%s" % (base, name, ext)
+        result.append((name, installation))
+    return result
+
+
+def shard(installations: list, workers: int) -> list:
+    """ Split the installations among at most `workers` shards. """
+    shards = [installations[i::workers] for i in range(0, max(workers, 1))]
+    return [s for s in shards if s]
+
+
+def work(index: int, installations: list, reports: 'multiprocessing.Queue', states: dict):
+    """ Sync a shard of installations, the body of a worker process.
+
+        Parameters
+        ----------
+        index : int
+            Index of the worker.
+
+        installations : list
+            (name, config) of the installations to sync.
+
+        reports : multiprocessing.Queue
+            Where to send the metrics and the states of the lights.
+
+        states : dict
+            The states of the lights reported before the worker was
+            restarted, as in FEED.
+    """
+    # the config of this worker only
+    Config._config = {'installations': [config for name, config in installations]}
+    watchers = []
+    try:
+        for name, config in installations:
+            pairs = huefri.pairs.autoinit(config, name)
+            for hue, tradfri in pairs:
+                hue.restore(states.get(hue.name, {}).get(str(hue.main_light)))
+                tradfri.restore(states.get(tradfri.name, {}).get(str(tradfri.main_light)))
+                hue.start_streaming()
+                if tradfri.observe_main:
+                    tradfri.start_observing()
+            watchers += huefri.pairs.watchers(pairs, config, name)
+        log("Worker %d" % index, "syncing %s" % ", ".join(name for name, config in installations))
+
+        def report():
+            while True:
+                reports.put((index, METRICS.export(), FEED.state()['lights']))
+                time.sleep(REPORT)
+
+        threading.Thread(target=report, daemon=True).start()
+        Engine(watchers).run()
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor(object):
+    """ Shard the installations of the config among worker processes, start
+        again the ones which crash and collect their metrics and the states
+        of their lights.
+
+        The states reported by the workers are published to FEED of the
+        supervisor, so its server has the lights of all installations. A
+        restarted worker gets the states it reported last, so a change made
+        while it was down is synced.
+    """
+
+    def __init__(self, config: dict, workers: int = None, restart: float = RESTART,
+            target: 'callable' = work):
+        """
+            Parameters
+            ----------
+            config : dict
+                The config with "installations".
+
+            workers : int
+                Number of worker processes, "workers" from the config or the
+                number of CPUs if not given.
+
+            restart : float
+                Seconds before the first restart of a crashed worker.
+
+            target : callable
+                The body of the workers, see work().
+        """
+        if workers is None:
+            workers = config.get('workers', WORKERS)
+        self.config = config
+        self.shards = shard(installations(config), workers)
+        self.restart = restart
+        self.target = target
+        self.context = multiprocessing.get_context("spawn")
+        self.reports = self.context.Queue()
+        self.lock = threading.Lock()
+        count = len(self.shards)
+        self.processes = [None] * count
+        # the last report of each worker: (metrics, states)
+        self.last = [({'counters': {}, 'histograms': {}}, {}) for i in range(0, count)]
+        # metrics of the workers which are gone
+        self.retired = Metrics()
+        self.crashes = [0] * count
+        self.started = [0] * count
+        self.restart_at = [None] * count
+
+    def start(self, index: int):
+        """ Start the worker with the index. """
+        process = self.context.Process(target=self.target, daemon=True,
+                args=(index, self.shards[index], self.reports, self.last[index][1]))
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        self.restart_at[index] = None
+
+    def receive(self, timeout: float = REPORT):
+        """ Take the reports of the workers, wait up to timeout for them. """
+        try:
+            report = self.reports.get(timeout=timeout)
+            while True:
+                index, metrics, states = report
+                with self.lock:
+                    self.last[index] = (metrics, states)
+                for hub, lights in states.items():
+                    for light, state in lights.items():
+                        FEED.publish(hub, light, state)
+                report = self.reports.get_nowait()
+        except queue.Empty:
+            pass
+
+    def check(self):
+        """ Notice crashed workers and start them again when it is time. """
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process is not None and process.exitcode is not None:
+                if now - self.started[index] > MAX_RESTART:
+                    # it ran for a while, the crashes aren't in a row
+                    self.crashes[index] = 0
+                delay = min(self.restart * 2 ** self.crashes[index], MAX_RESTART)
+                self.crashes[index] += 1
+                log("Supervisor", "worker %d exited with %s, restarting in %g s" % (
+                    index, str(process.exitcode), delay))
+                with self.lock:
+                    # its counters start from zero again, its values are
+                    # set anew
+                    self.retired.merge(dict(self.last[index][0], values={}), worker=str(index))
+                    self.last[index] = ({'counters': {}, 'values': {}, 'histograms': {}},
+                            self.last[index][1])
+                self.processes[index] = None
+                self.restart_at[index] = now + delay
+            if self.processes[index] is None and self.restart_at[index] is not None and \
+                    now >= self.restart_at[index]:
+                self.start(index)
+
+    def metrics(self) -> Metrics:
+        """ Return the metrics of all workers, labeled by the worker. """
+        metrics = Metrics()
+        with self.lock:
+            metrics.merge(self.retired.export())
+            for index, (exported, states) in enumerate(self.last):
+                metrics.merge(exported, worker=str(index))
+        return metrics
+
+    def serve(self):
+        """ Serve the metrics of all workers and the states of all lights,
+            as configured in "server".
+        """
+        server = self.config.get('server', {})
+        if server is None:
+            return
+        routes = {
+            "/metrics": lambda query: ("text/plain; version=0.0.4", self.metrics().text()),
+            "/metrics.json": lambda query: ("application/json", json.dumps(self.metrics().dict())),
+        }
+        try:
+            Server(server.get('addr', ADDR), server.get('port', PORT), routes,
+                socket=server.get('socket')).start()
+        except OSError as err:
+            log("Supervisor", "can't start the server: %s" % str(err))
+
+    def run(self):
+        """ Start the workers and look after them until interrupted. """
+        log("Supervisor", "%d installations in %d workers" % (
+            sum(len(s) for s in self.shards), len(self.shards)))
+        for index in range(0, len(self.shards)):
+            self.start(index)
+        self.serve()
+        try:
+            while True:
+                self.receive()
+                self.check()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """ Stop all workers. """
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
@@ -19,24 +19,58 @@
 
 import time
 import datetime
-import os
 import threading
 
 from pytradfri import Gateway
 from pytradfri.api.libcoap_api import APIFactory
+from pytradfri.const import ATTR_DEVICE_STATE
+from pytradfri.const import ATTR_LIGHT_COLOR_HEX
+from pytradfri.const import ATTR_LIGHT_DIMMER
+from pytradfri.const import ATTR_LIGHT_COLOR_X
+from pytradfri.const import ATTR_LIGHT_COLOR_Y
+from pytradfri.const import ATTR_LIGHT_MIREDS
+from pytradfri.const import RANGE_X
+from pytradfri.const import RANGE_Y
+from pytradfri.const import RANGE_MIREDS
 
 from huefri.common import Hub as Hub
+from huefri.common import StateCache as StateCache
 from huefri.common import HuefriException as HuefriException
 from huefri.common import Config as Config
-from huefri.common import DELTA as DELTA
 from huefri.common import log as log
+from huefri.common import load_colors as load_colors
 from huefri.common import hex2hsb as hex2hsb
-
+from huefri.pool import WritePool as WritePool
+from huefri.pool import Debouncer as Debouncer
+from huefri.pool import Limiter as Limiter
+from huefri.pool import WORKERS as WORKERS
+from huefri.pool import DEBOUNCE as DEBOUNCE
+from huefri.pool import RATE as RATE
+from huefri.transport import Session as Session
+from huefri.transport import LIBCOAP as LIBCOAP
+from huefri.transport import TRANSPORTS as TRANSPORTS
+from huefri.transport import TIMEOUT as REQUEST_TIMEOUT
+from huefri.inventory import Inventory as Inventory
+from huefri.inventory import CACHE as CACHE
+from huefri.metrics import METRICS as METRICS
+from huefri.feed import FEED as FEED
+
+# how long one CoAP observation of the main light lasts before it is renewed
+OBSERVE_DURATION = 60
+# how long to wait before observing again after the observation failed
+OBSERVE_RETRY = 30
 
 class Tradfri(Hub):
     """ Class for Tradfri lights """
 
-    def __init__(self, ip: str, key: str, main_light: int, lights: list, hue: 'Hue' = None):
+    # name of the hub in FEED
+    name = "tradfri"
+
+    def __init__(self, ip: str, key: str, main_light: int, lights: list, hue: 'Hue' = None,
+            observe: bool = False, workers: int = WORKERS, debounce: float = DEBOUNCE,
+            rate: float = RATE, transport: str = LIBCOAP, cache: str = None,
+            share: 'Tradfri' = None, colors: list = None,
+            request_timeout: float = REQUEST_TIMEOUT):
         """
             Parameters
             ----------
@@ -54,59 +88,309 @@ class Tradfri(Hub):
 
             hue: Hue
                 The Hue instance we are controlling with the main light.
-        """
-        super().__init__(ip, key, main_light, lights)
 
-        self.hue = hue
-        self.threads = []
+            observe : bool
+                Watch the main light with CoAP observe instead of polling it.
+                See start_observing().
+
+            workers : int
+                Maximal number of lights written to at the same time.
+
+            debounce : float
+                How long to wait for a newer state before the lights are
+                changed, in seconds. See set_all().
 
-        api_factory = APIFactory(ip)
-        api_factory.psk = key
-        self.api = api_factory.request
-        self.gateway = Gateway()
+            rate : float
+                Maximal number of commands sent to the gateway per second,
+                0 for no limit. Shared by the instances sharing the gateway.
 
-        devices_command = self.gateway.get_devices()
-        devices_commands = self.api(devices_command)
-        self._devices = self.api(devices_commands)
+            transport : str
+                "libcoap" runs coap-client for each request, "aiocoap" keeps
+                one DTLS session open. See huefri.transport.
+
+            cache : str
+                A file to cache the devices of the gateway in. With the
+                cache, only the used lights are fetched at startup. See
+                huefri.inventory.
+
+            share : Tradfri
+                Another instance for the same gateway. Its connection, device
+                list, writing pool, cache of written states and rate limit are
+                reused.
+
+            colors : list
+                The colors to translate to Hue, COLORS_MAP if not given.
+
+            request_timeout : float
+                How long one request to the gateway can take, in seconds.
+        """
+        super().__init__(ip, key, main_light, lights, colors)
+
+        self.hue = hue
+        # update() can be called both by the main loop and the observer
+        self.lock = threading.Lock()
+        self.observe_main = observe
+        self.observing = False
+        self.observer = None
+        # set when a session pushed a change of the main light or when the
+        # observation broke
+        self.wakeup = threading.Event()
+
+        # the changes of the lights, at most `rate` commands per second to
+        # the gateway, together with the other pairs
+        self.limiter = Limiter(rate) if share is None else share.limiter
+        self.debouncer = Debouncer(self._fan_out, debounce, limiter=self.limiter)
+
+        # a gateway group with exactly the controlled lights, if there is one
+        self.group = None
+
+        if share is None:
+            if transport not in TRANSPORTS:
+                raise HuefriException("Unknown Tradfri transport '%s'." % transport)
+            self.transport = transport
+            self.pool = WritePool(workers, "tradfri")
+            self.cache = StateCache()
+            if transport == LIBCOAP:
+                api_factory = APIFactory(ip, timeout=request_timeout)
+                api_factory.psk = key
+                self.api = api_factory.request
+            else:
+                self.api = Session(ip, key, request_timeout).request
+            self.gateway = Gateway()
+
+            self.inventory = Inventory(self.api, self.gateway, cache, ip)
+            self.inventory.listen(self._revalidated)
+            if self.inventory.load():
+                self.inventory.need([main_light] + list(lights))
+                self.discover_group()
+                self.inventory.revalidate()
+            else:
+                self.rescan()
+        else:
+            self.transport = share.transport
+            self.pool = share.pool
+            self.cache = share.cache
+            self.api = share.api
+            self.gateway = share.gateway
+            self.inventory = share.inventory
+            self.inventory.need([main_light] + list(lights))
+            self.discover_group()
+            # the scan of the first pair may be done already
+            self.inventory.listen(self._revalidated)
 
         self.color = None
         self.state = None
         self.dimmer = None
+        # whether the state above was read already
+        self.known = False
 
     @classmethod
-    def autoinit(cls, hue: 'Hue' = None):
+    def autoinit(cls, hue: 'Hue' = None, pair: dict = None, share: 'Tradfri' = None,
+            config: dict = None):
         """ Get the constructor arguments automatically from Config class.
             Parameters
             ----------
             hue : Hue
                 The Hue instance we are controlling with the main light.
+
+            pair : dict
+                The "tradfri" part of a pair from the config with the main and
+                controlled lights. The tradfri section is used if not given.
+
+            share : Tradfri
+                Another instance to share the connection with.
+
+            config : dict
+                The config to use instead of the one of Config.
         """
 
-        config = Config.get()
+        if config is None:
+            config = Config.get()
+        colors = load_colors(config)
+        if pair is None:
+            pair = config['tradfri']
         return cls(config['tradfri']['addr'],
                 config['tradfri']['secret'],
-                config['tradfri']['main'],
-                config['tradfri']['controlled'],
-                hue)
+                pair['main'],
+                pair['controlled'],
+                hue,
+                config['tradfri'].get('observe', False),
+                config['tradfri'].get('workers', WORKERS),
+                config['tradfri'].get('debounce', DEBOUNCE),
+                config['tradfri'].get('rate', RATE),
+                config['tradfri'].get('transport', LIBCOAP),
+                config['tradfri'].get('cache', CACHE),
+                share,
+                colors,
+                config['tradfri'].get('request_timeout', REQUEST_TIMEOUT))
 
     def set_hue(self, hue):
         self.hue = hue
 
-    def set_all(self, hex_color: str, brightness: int):
+    @property
+    def main_state(self) -> dict:
+        return {'color': self.color, 'dimmer': self.dimmer, 'state': self.state}
+
+    def restore(self, state: dict):
+        """ Start from a state of the main light seen before a restart,
+            so a change made meanwhile is synced on the first look.
+
+            Parameters
+            ----------
+            state : dict
+                The state of the main light as in FEED.
+        """
+        if not state:
+            return
+        self.color = state.get('color')
+        if isinstance(self.color, list):
+            # xy, as a list after a round trip through json
+            self.color = tuple(self.color)
+        self.dimmer = state.get('dimmer')
+        self.state = state.get('state')
+        self.known = True
+
+    @property
+    def _lights(self) -> list:
+        """ The lights of the gateway, indexed the same way as in the config. """
+        return self.inventory.lights
+
+    def rescan(self):
+        """ Fetch the devices from the gateway and rebuild the index of lights.
+
+            The index is built only here, call this again when a device was
+            added to or removed from the gateway.
+        """
+        self.inventory.scan()
+        self._revalidated(True)
+
+    def _revalidated(self, changed: bool):
+        """ Called when the inventory was scanned. """
+        if not changed:
+            return
+        # the indexes may point to other lights now
+        self.cache.invalidate()
+        self.discover_group()
+
+    def discover_group(self):
+        """ Find a gateway group containing exactly the controlled lights.
+
+            If there is one, set_all() changes all the lights with one group
+            command instead of writing to each of them.
+        """
+        self.group = None
+        try:
+            groups = self.api(self.api(self.gateway.get_groups()))
+        except Exception as err:
+            log("Tradfri", "can't get groups: %s" % str(err))
+            groups = []
+
+        lights = set(self.inventory.ids)
+        selected = set(self.inventory.ids[l] for l in self.lights_selected)
+        for group in groups:
+            # groups contain also remotes and other devices, ignore them
+            if set(group.member_ids) & lights == selected:
+                log("Tradfri", "using group %s" % str(group.id))
+                self.group = group
+                break
+        self._limit()
+
+    def _kind(self, lights: list) -> str:
+        """ How the color of the lights is set: 'xy' for color bulbs,
+            'mireds' for white spectrum ones and 'hex' for the preset
+            colors, which all bulbs take. Lights of different kinds are
+            set the way they all take.
+
+            Parameters
+            ----------
+            lights : list
+                Indexes of the lights.
+        """
+        kinds = set()
+        for l in lights:
+            light = self._lights[l].light_control.lights[0]
+            if light.supports_hsb_xy_color:
+                kinds.add('xy')
+            elif light.supports_color_temp:
+                kinds.add('mireds')
+            else:
+                kinds.add('hex')
+        return kinds.pop() if len(kinds) == 1 else 'hex'
+
+    def _color(self, light) -> 'str or tuple or int':
+        """ The color of the main light the way it is set, see _kind(). """
+        kind = self._kind([self.main_light])
+        if kind == 'xy' and light.xy_color is not None:
+            return tuple(light.xy_color)
+        if kind == 'mireds' and light.color_temp is not None:
+            return light.color_temp
+        return light.hex_color
+
+    def _limit(self):
+        """ Count the commands sent by one change of the lights against
+            the commands per second of the hub, shared by all the pairs.
+        """
+        self.debouncer.cost = 1 if self.group is not None else max(len(self.lights_selected), 1)
+
+    def set_all(self, hex_color: str, brightness: int, since: float = None,
+            xy: tuple = None, mireds: int = None):
         """ Set all controlled lights to specific color and brightness.
 
             Parameters
             ----------
             hex_color : str
-                Color to set.
+                Color to set, the closest preset color.
 
             brightness : int
                 Brightness to set. If 0, the bulb will be turned off.
+
+            since : float
+                When the change was found on the other hub, a
+                time.perf_counter() value. The time until the lights are
+                written is counted as the sync latency.
+
+            xy : tuple
+                The same color in CIE xy, sent to color bulbs instead.
+
+            mireds : int
+                The same color as a color temperature, sent to white
+                spectrum bulbs instead.
+
+            Quickly following changes are coalesced by self.debouncer and
+            only the latest one is sent, see _fan_out().
+        """
+        self.debouncer(hex_color, brightness, since, xy, mireds)
+
+    def flush(self, timeout: float = None) -> bool:
+        """ Send the waiting change right away and wait until the lights
+            are written to. Return False if the timeout expired first.
         """
+        self.debouncer.flush()
+        return self.pool.join(timeout)
+
+    def _fan_out(self, hex_color: str, brightness: int, since: float = None,
+            xy: tuple = None, mireds: int = None):
+        """ Change all controlled lights, see set_all().
+
+            If the controlled lights form a gateway group, only the group is
+            written to. Otherwise the bulbs are written to in parallel by
+            self.pool. If the previous write to a bulb is still waiting, it is
+            replaced by this one.
+
+            Only the values which differ from what the lights were last set
+            to are sent, and nothing at all if the lights already are in
+            this state, see self.cache.
+        """
+        if self.group is not None:
+            self.pool.submit(self.group.id, self._set_control, self.group, hex_color,
+                    brightness, self.lights_selected, since, xy, mireds)
+            return
+
         for l in self.lights_selected:
-            self._set(l, hex_color, brightness)
+            self.pool.submit(l, self._set, l, hex_color, brightness, since, xy, mireds)
 
-    def _set(self, light: int, hex_color: str, brightness: int):
+    def _set(self, light: int, hex_color: str, brightness: int, since: float = None,
+            xy: tuple = None, mireds: int = None):
         """ Set given light (indexed from 0) to specific color and brightness.
 
             Parameters
@@ -119,68 +403,250 @@ class Tradfri(Hub):
 
             brightness : int
                 Brightness to set. If 0, the bulb will be turned off.
+
+            Color, brightness and state are sent in a single request.
+        """
+        self._set_control(self._lights[light].light_control, hex_color, brightness, [light],
+                since, xy, mireds)
+
+    def _set_control(self, control, hex_color: str, brightness: int, lights: list,
+            since: float = None, xy: tuple = None, mireds: int = None):
+        """ Set a light control or a group to specific color and brightness.
+
+            Parameters
+            ----------
+            control : LightControl or Group
+                Anything with set_values() and set_state() commands.
+
+            hex_color : str
+                Color to set.
+
+            brightness : int
+                Brightness to set. If 0, the lights will be turned off.
+
+            lights : list
+                Indexes of the lights behind the control.
+
+            since : float
+                When the change was found, see set_all().
+
+            xy, mireds
+                The color for color and white spectrum bulbs, see set_all().
+                The color is sent the way all the lights take, see _kind().
         """
+        color = None
         if brightness:
-            self.api(self._lights[light].light_control.set_hex_color(hex_color))
-            self.api(self._lights[light].light_control.set_dimmer(brightness))
-            self.api(self._lights[light].light_control.set_state(True))
+            values = {ATTR_LIGHT_DIMMER: brightness, ATTR_DEVICE_STATE: 1}
+            kind = self._kind(lights)
+            if kind == 'xy' and xy is not None:
+                color = (round(min(max(xy[0], 0), 1) * RANGE_X[1]),
+                        round(min(max(xy[1], 0), 1) * RANGE_Y[1]))
+                values[ATTR_LIGHT_COLOR_X], values[ATTR_LIGHT_COLOR_Y] = color
+            elif kind == 'mireds' and mireds is not None:
+                color = min(max(mireds, RANGE_MIREDS[0]), RANGE_MIREDS[1])
+                values[ATTR_LIGHT_MIREDS] = color
+            else:
+                color = hex_color
+                values[ATTR_LIGHT_COLOR_HEX] = hex_color
         else:
-            self.api(self._lights[light].light_control.set_state(False))
+            values = {ATTR_DEVICE_STATE: 0}
+
+        diff = self.cache.diff(lights, values)
+        if not diff:
+            METRICS.count("writes_saved", hub="tradfri")
+            return
+        echo = None
+        if self.main_light in lights:
+            # the changes of the main light to this state are our own
+            if brightness:
+                echo = self.sent({'color': color, 'dimmer': brightness, 'state': True})
+            else:
+                echo = self.sent({'state': False})
+        try:
+            with METRICS.timer("write", hub="tradfri"):
+                if diff == {ATTR_DEVICE_STATE: 0}:
+                    self.api(control.set_state(False))
+                else:
+                    self.api(control.set_values(diff))
+        except Exception:
+            METRICS.count("write_failures", hub="tradfri")
+            self.written(echo, False)
+            raise
+        self.written(echo)
+        self.cache.confirm(lights, diff)
+        state = {'state': bool(diff[ATTR_DEVICE_STATE])} if ATTR_DEVICE_STATE in diff else {}
+        if any(k in diff for k in (ATTR_LIGHT_COLOR_HEX, ATTR_LIGHT_COLOR_X,
+                ATTR_LIGHT_COLOR_Y, ATTR_LIGHT_MIREDS)):
+            state['color'] = color
+        if ATTR_LIGHT_DIMMER in diff:
+            state['dimmer'] = diff[ATTR_LIGHT_DIMMER]
+        for l in lights:
+            FEED.publish(self.name, l, state)
+        if since is not None:
+            METRICS.since("sync", since, hub="tradfri")
 
     def observe(self, device):
         """ A dirty hack to get the new API working """
         self.api(device.update())
 
+    def start_observing(self):
+        """ Start watching the main light with CoAP observe.
+
+            The gateway pushes every change of the main light to us and it
+            is propagated right away from a background thread. While the
+            observation is running, changed() doesn't fetch the main light
+            anymore, so the polling loop is just a cheap fallback which takes
+            over whenever the observation fails.
+        """
+        if self.observer is not None:
+            return
+        self.observer = threading.Thread(target=self._observe_loop, daemon=True)
+        self.observing = True
+        self.observer.start()
+
+    def _observe_loop(self):
+        """ Keep the observation of the main light running forever.
+
+            With libcoap, the request lasts for the whole observation and
+            it is renewed when it ends. With a session, the request only
+            starts the observation, which then runs until it breaks, and
+            this thread propagates the pushed changes meanwhile.
+        """
+        while True:
+            self.observing = True
+            self.wakeup.clear()
+            try:
+                self.api(self._lights[self.main_light].observe(
+                    self._observed, self._observe_failed, duration=OBSERVE_DURATION))
+            except Exception as err:
+                self._observe_failed(err)
+
+            if self.transport != LIBCOAP:
+                self._follow_pushes()
+            if not self.observing:
+                time.sleep(OBSERVE_RETRY)
+
+    def _follow_pushes(self):
+        """ Propagate the changes pushed by a session until the
+            observation breaks. Changes pushed while one is propagated are
+            propagated together.
+        """
+        while self.observing:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.observing:
+                self._propagate()
+
+    def _observed(self, device):
+        """ Called by pytradfri when the observed main light changed.
+
+            With libcoap, it is called in the observer thread and the change
+            is propagated right away. A session calls it from its event
+            loop, which must not wait for the lock or for requests to the
+            gateway, so the observer thread is woken up to propagate it.
+        """
+        if self.transport == LIBCOAP:
+            self._propagate()
+        else:
+            self.wakeup.set()
+
+    def _propagate(self):
+        """ Propagate a change of the observed main light. """
+        try:
+            self.update()
+        except Exception as err:
+            log("Tradfri", "update from observation failed: %s" % str(err))
+
+    def _observe_failed(self, err: Exception):
+        """ Called when the observation broke, fall back to polling. """
+        log("Tradfri", "observation failed, polling instead: %s" % str(err))
+        self.observing = False
+        self.wakeup.set()
 
     def changed(self):
         """ Test whether there is any change since the last call. """
         if self.hue is None:
             raise HuefriException("Hue object was not passed to Tradfri.")
 
-        self.observe(self._lights[self.main_light])
-
-        change = False
-        color = self._lights[self.main_light].light_control.lights[0].hex_color
-        dimmer = self._lights[self.main_light].light_control.lights[0].dimmer
-        state = self._lights[self.main_light].light_control.lights[0].state
-
-        if dimmer != self.dimmer:
-            change = True
-            self.dimmer = dimmer
-        if color != self.color:
-            change = True
-            self.color = color
-        if state != self.state:
-            change = True
-            self.state = state
-
-        if self.hue.last_changed > datetime.datetime.now() - DELTA:
-            """ If the other side changed within DELTA time, any change
-                we found is likely caused by the sync and not by a manual
-                control.  So, skip any operation.
+        METRICS.count("polls", hub="tradfri")
+        start = time.perf_counter()
+        device = self._lights[self.main_light]
+        if not self.observing:
+            with METRICS.timer("read", hub="tradfri"):
+                self.observe(device)
+
+        main = device.light_control.lights[0]
+        current = {
+            'color': self._color(main),
+            'dimmer': main.dimmer,
+            'state': main.state,
+        }
+        previous = {
+            'color': self.color,
+            'dimmer': self.dimmer,
+            'state': self.state,
+        }
+        changes = {k: v for k, v in current.items() if previous[k] != v}
+
+        self.color = current['color']
+        self.dimmer = current['dimmer']
+        self.state = current['state']
+        FEED.publish(self.name, self.main_light, current)
+
+        if not self.known:
+            # the first look at the light, there is nothing to compare with
+            self.known = True
+            return False
+        echo = bool(changes) and self.echo(changes)
+        self.expire(start)
+        if not changes:
+            return False
+        if echo:
+            """ The main light just got to a state written by the sync,
+                it is not a change by the user. Anything else is.
             """
             log("Tradfri", "hue sync skipped")
-            change = False
-
-        return change
+            METRICS.count("echoes", hub="tradfri")
+            return False
+        METRICS.count("changes", hub="tradfri")
+        return True
 
     def update(self):
         """ Check if the main light changed since the last call of this function
             and if yes, propagate the change to other lights.
         """
+        with self.lock:
+            self._update()
+
+    def _hsb(self, main) -> dict:
+        """ Translate the state of the main light for Hue: CIE xy from a
+            color bulb, a color temperature from a white spectrum one and
+            the preset color otherwise, see hex2hsb().
+        """
+        color = self._color(main)
+        if isinstance(color, tuple):
+            x, y = color
+            return {'on': True, 'xy': [round(x / RANGE_X[1], 4), round(y / RANGE_Y[1], 4)],
+                    'bri': main.dimmer}
+        if isinstance(color, int):
+            return {'on': True, 'ct': color, 'bri': main.dimmer}
+        return hex2hsb(color, main.dimmer, self.colors)
+
+    def _update(self):
+        start = time.perf_counter()
         if self.changed():
             main = self._lights[self.main_light].light_control.lights[0]
+            # The controlled bulbs can't be watched, but whoever changed the
+            # main light could have changed them as well, so don't trust
+            # what we wrote to them before.
+            self.cache.invalidate()
 
             self.last_changed = datetime.datetime.now()
             if main.state:
-                hsb = hex2hsb(main.hex_color, main.dimmer)
+                with METRICS.timer("translate", hub="tradfri"):
+                    hsb = self._hsb(main)
                 log("Tradfri", "send to hue: %s" % str(hsb))
-                self.hue.set_hsb(hsb)
+                self.hue.set_hsb(hsb, start)
             else:
-                hsb = hex2hsb(main.hex_color, 0)
                 log("Tradfri", "turn off")
-                self.hue.set_hsb({'on': False})
-
-    @property
-    def _lights(self):
-        return [dev for dev in self._devices if dev.has_light_control]
+                self.hue.set_hsb({'on': False}, start)
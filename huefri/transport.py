@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Ways of talking to the hubs.
+
+    The default "libcoap" transport of pytradfri runs coap-client for every
+    request to the Tradfri gateway, so each of them forks a process and does
+    a new DTLS handshake. The "aiocoap" transport keeps one DTLS session open
+    in a Session and sends all requests through it. It needs the aiocoap
+    package.
+
+    The Hue bridge is talked to over a pool of keep-alive HTTP connections,
+    see HueAdapter.
+"""
+
+import asyncio
+import threading
+import time
+
+import qhue
+import requests.adapters
+
+try:
+    from pytradfri.api.aiocoap_api import APIFactory as AsyncAPIFactory
+except ImportError:
+    AsyncAPIFactory = None
+
+from huefri.common import HuefriException as HuefriException
+from huefri.common import log as log
+from huefri.metrics import Histogram as Histogram
+
+LIBCOAP = "libcoap"
+AIOCOAP = "aiocoap"
+TRANSPORTS = (LIBCOAP, AIOCOAP)
+
+# default limit for one request to the Tradfri gateway, in seconds, below the
+# timeout of an update in huefri.engine so a stuck request ends first
+TIMEOUT = 5
+# default limits for connecting to the Hue bridge and for its answer, in seconds
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 5
+
+
+class Session(object):
+    """ One DTLS session to the gateway, shared by all requests.
+
+        pytradfri's aiocoap API is asynchronous, so it runs in its own event
+        loop in a background thread. request() blocks the caller like the
+        libcoap API does, many threads can use it at the same time and their
+        requests are multiplexed over the session.
+    """
+
+    def __init__(self, ip: str, key: str, timeout: float = TIMEOUT):
+        """
+            Parameters
+            ----------
+            ip : str
+                Address of Tradfri gate. DNS will be resolved.
+
+            key : str
+                The PSK for the gateway.
+
+            timeout : float
+                How long one request can take, in seconds.
+        """
+        if AsyncAPIFactory is None:
+            raise HuefriException("The aiocoap transport needs the aiocoap package.")
+
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.factory = self._run(AsyncAPIFactory.init(ip, psk=key))
+
+    def _run(self, coroutine):
+        """ Run a coroutine in the session's loop and wait for the result. """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request(self, commands):
+        """ Send a command or a list of commands, return their results.
+            The signature matches the request() of pytradfri's libcoap API.
+        """
+        return self._run(self.factory.request(commands, self.timeout))
+
+    def close(self):
+        """ Close the session and stop its loop. """
+        if not self.loop.is_running():
+            return
+        try:
+            self._run(self.factory.shutdown())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class HueAdapter(requests.adapters.HTTPAdapter):
+    """ Keep-alive connections to the Hue bridge.
+
+        At most `connections` of them are open, a request waits for a free
+        one instead of opening another. The latency of every request is
+        counted in a histogram per HTTP method.
+    """
+
+    def __init__(self, connections: int):
+        """
+            Parameters
+            ----------
+            connections : int
+                Maximal number of connections open at the same time.
+        """
+        super().__init__(pool_connections=1, pool_maxsize=connections, pool_block=True)
+        self.lock = threading.Lock()
+        # method -> Histogram of latencies in milliseconds
+        self.latency = {}
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                histogram = self.latency.setdefault(request.method, Histogram())
+            histogram.add(elapsed)
+
+    @property
+    def reuse(self) -> float:
+        """ The share of requests which reused an open connection. """
+        connections = 0
+        requests = 0
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests += pool.num_requests
+        return 1 - connections / requests if requests else 0.0
+
+    def stats(self) -> dict:
+        """ Return the reuse rate and the latency histograms. """
+        with self.lock:
+            latency = dict(self.latency)
+        return {
+            'reuse': self.reuse,
+            'latency': {method: h.dict() for method, h in latency.items()},
+        }
+
+    def report(self):
+        """ Log the reuse rate and the latencies. """
+        log("Hue", "%.0f %% of requests reused a connection" % (self.reuse * 100))
+        with self.lock:
+            latency = dict(self.latency)
+        for method, h in sorted(latency.items()):
+            log("Hue", "%s: %d requests, mean %.1f ms, p50 <= %s ms, p95 <= %s ms" % (
+                method, h.count, h.mean, str(h.percentile(50)), str(h.percentile(95))))
+
+
+def hue_bridge(ip: str, user: str, connections: int,
+        connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+    """ Connect to a Hue bridge, return the qhue.Bridge and its HueAdapter.
+
+        Parameters
+        ----------
+        ip : str
+            Address of Hue Bridge. DNS will be resolved.
+
+        user : str
+            The secret string generated when pairing with the Bridge.
+
+        connections : int
+            Maximal number of connections open at the same time.
+
+        connect_timeout : float
+            How long connecting to the bridge can take, in seconds.
+
+        read_timeout : float
+            How long to wait for an answer, in seconds.
+    """
+    bridge = qhue.Bridge(ip, user, timeout=(connect_timeout, read_timeout))
+    adapter = HueAdapter(connections)
+    bridge.session.mount("http://", adapter)
+    bridge.session.mount("https://", adapter)
+    return bridge, adapter
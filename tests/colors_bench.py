@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+""" Measure color lookups per second. """
+
+import timeit
+
+import huefri
+import huefri.common
+
+NUMBER = 100000
+
+
+def scan_hex2hsb(color_hex, brightness):
+    """ the linear scan hex2hsb did before the lookup tables """
+    color = None
+    for c in huefri.common.COLORS_MAP:
+        if c["hex"] == color_hex:
+            color = dict(c["hsb"])
+    color['bri'] = brightness
+    return color
+
+
+def scan_hsb2hex(hue, sat):
+    """ the linear scan hsb2hex did before the lookup tables """
+    for vals in huefri.common.COLORS_MAP:
+        if hue == vals['hsb']['hue'] and sat == vals['hsb']['sat']:
+            return vals['hex']
+
+
+def rate(fnt, *args) -> float:
+    return NUMBER / timeit.timeit(lambda: fnt(*args), number=NUMBER)
+
+
+def bench():
+    print("Color lookups per second, %d colors:" % len(huefri.common.COLORS_MAP))
+    print("  hex2hsb scan:  %9.0f" % rate(scan_hex2hsb, "f5faf6", 100))
+    print("  hex2hsb table: %9.0f" % rate(huefri.common.hex2hsb, "f5faf6", 100))
+    print("  hsb2hex scan:  %9.0f" % rate(scan_hsb2hex, 39392, 13))
+    print("  hsb2hex table: %9.0f" % rate(huefri.common.hsb2hex, 39392, 13))
+    huefri.common.hsb2hex(1000, 100)
+    print("  hsb2hex grid:  %9.0f" % rate(huefri.common.hsb2hex, 1000, 100))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+""" Measure color conversions per second. """
+
+import random
+import time
+
+import huefri
+from huefri import colorspace
+
+BATCH = 10000
+
+
+def rate(fnt, colors) -> float:
+    start = time.perf_counter()
+    fnt(colors)
+    return len(colors) / (time.perf_counter() - start)
+
+
+def run(hsb, mireds):
+    print("    hsb -> xy (gamut C): %10.0f" % rate(
+        lambda c: colorspace.rgb2xy(colorspace.hsb2rgb(c), 'C'), hsb))
+    print("    hsb -> rgb -> hsb:   %10.0f" % rate(
+        lambda c: colorspace.rgb2hsb(colorspace.hsb2rgb(c)), hsb))
+    print("    mired -> hsb:        %10.0f" % rate(colorspace.mired2hsb, mireds))
+
+
+def bench():
+    random.seed(0)
+    hsb = [(random.randrange(0, 65536), random.randrange(0, 255), random.randrange(0, 255))
+            for i in range(0, BATCH)]
+    mireds = [random.randrange(153, 501) for i in range(0, BATCH)]
+
+    print("Color conversions per second, batches of %d:" % BATCH)
+    numpy = colorspace.numpy
+    if numpy is not None:
+        print("  NumPy:")
+        run(hsb, mireds)
+    try:
+        colorspace.numpy = None
+        print("  pure Python:")
+        run(hsb, mireds)
+    finally:
+        colorspace.numpy = numpy
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+
+import huefri
+from huefri import colorspace
+
+
+class TestColorspace(unittest.TestCase):
+
+    def assertColors(self, expected, colors, places=3):
+        self.assertEqual(len(expected), len(colors))
+        for e, c in zip(expected, colors):
+            for a, b in zip(e, c):
+                self.assertAlmostEqual(a, b, places=places)
+
+    def test_hsb2rgb(self):
+        self.assertColors([(1, 0, 0), (0, 1, 0), (1, 1, 1), (0, 0, 0)],
+                colorspace.hsb2rgb([(0, 254, 254), (21845, 254, 254),
+                    (12345, 0, 254), (12345, 254, 0)]))
+
+    def test_rgb2hsb(self):
+        self.assertColors([(0, 254, 254), (43691, 254, 254), (0, 0, 127)],
+                colorspace.rgb2hsb([(1, 0, 0), (0, 0, 1), (0.5, 0.5, 0.5)]))
+
+        # and back
+        hsb = [(1000, 200, 100), (30000, 50, 254), (60000, 254, 10)]
+        self.assertColors(hsb, colorspace.rgb2hsb(colorspace.hsb2rgb(hsb)), places=-1)
+
+    def test_xy(self):
+        # white is the white point, black too
+        self.assertColors([colorspace.WHITE, colorspace.WHITE],
+                colorspace.rgb2xy([(1, 1, 1), (0, 0, 0)]), places=2)
+
+        # xy -> rgb -> xy keeps the color
+        xy = [(0.5, 0.4), (0.3, 0.3), (0.2, 0.5)]
+        self.assertColors(xy, colorspace.rgb2xy(colorspace.xy2rgb(xy)))
+
+    def test_clamp(self):
+        inside = (0.4, 0.4)
+        red = colorspace.GAMUTS['B'][0]
+        self.assertColors([inside, red],
+                colorspace.clamp([inside, (0.8, 0.2)], 'B'))
+
+        # a gamut as reported by a light
+        self.assertColors([inside, red],
+                colorspace.clamp([inside, (0.8, 0.2)], [list(c) for c in colorspace.GAMUTS['B']]))
+
+        # pure green is out of gamut B
+        x, y = colorspace.rgb2xy([(0, 1, 0)], 'B')[0]
+        self.assertLess(y, colorspace.GAMUTS['B'][1][1] + 1e-9)
+
+    def test_mired(self):
+        mireds = colorspace.xy2mired(colorspace.mired2xy([153, 250, 366, 500]))
+        self.assertColors([(153,), (250,), (366,), (500,)], [(m,) for m in mireds], places=-1)
+        self.assertColors([(0.4476, 0.4074)], colorspace.mired2xy([1e6 / 2856]), places=2)
+
+    def test_hex(self):
+        self.assertEqual(["ff8000", "f1e0b5"],
+                colorspace.rgb2hex(colorspace.hex2rgb(["ff8000", "f1e0b5"])))
+        self.assertColors([(0, 254, 254)], colorspace.hex2hsb(["ff0000"]))
+
+    def test_empty(self):
+        self.assertEqual(0, len(colorspace.hsb2rgb([])))
+        self.assertEqual(0, len(colorspace.mired2hsb([])))
+
+    @unittest.skipIf(colorspace.numpy is None, "NumPy is not installed")
+    def test_numpy(self):
+        # the vectorized and the scalar conversions give the same results
+        hsb = [(h, s, 200) for h in range(0, 65536, 4096) for s in range(0, 255, 32)]
+        xy = [(x / 10, y / 10 + 0.05) for x in range(0, 8) for y in range(0, 8)]
+        numpy = colorspace.numpy
+        vectorized = (colorspace.hsb2rgb(hsb), colorspace.rgb2hsb(colorspace.hsb2rgb(hsb)),
+                colorspace.clamp(xy, 'A'), colorspace.xy2rgb(xy),
+                colorspace.xy2mired(xy), colorspace.mired2hsb([153, 300, 500]))
+        try:
+            colorspace.numpy = None
+            scalar = (colorspace.hsb2rgb(hsb), colorspace.rgb2hsb(colorspace.hsb2rgb(hsb)),
+                    colorspace.clamp(xy, 'A'), colorspace.xy2rgb(xy),
+                    colorspace.xy2mired(xy), colorspace.mired2hsb([153, 300, 500]))
+        finally:
+            colorspace.numpy = numpy
+        for v, s in zip(vectorized, scalar):
+            self.assertTrue(numpy.allclose(numpy.asarray(v, dtype=float),
+                numpy.asarray(s, dtype=float)))
+
@@ -91,3 +91,55 @@ class TestColors(unittest.TestCase):
                 huefri.common.hex2hsb("efd275", "150"))
         self.assertEqual({'on': True, 'hue':  7644, 'sat': 150, 'bri': '150'},
                 huefri.common.hex2hsb("f1e0b5", "150"))
+
+    def test_hex2hsb_fresh(self):
+        # results don't leak into the map or into each other
+        first = huefri.common.hex2hsb("efd275", 100)
+        first['hue'] = 0
+        self.assertEqual({'on': True, 'hue':  6188, 'sat': 249, 'bri': 50},
+                huefri.common.hex2hsb("efd275", 50))
+        self.assertNotIn('bri', self.map[0]['hsb'])
+
+    def test_unknown(self):
+        # colors out of the map are converted by their RGB value
+        self.assertEqual({'on': True, 'hue': 0, 'sat': 254, 'bri': 50},
+                huefri.common.hex2hsb("ff0000", 50))
+        self.assertEqual({'on': True, 'hue': 21845, 'sat': 127, 'bri': 50},
+                huefri.common.hex2hsb("80ff80", 50))
+        with self.assertRaises(Exception):
+            huefri.common.hex2hsb("bad", 50)
+
+    def test_nearest(self):
+        self.assertEqual("f1e0b5", huefri.common.hsb2hex(7000, 160))
+        self.assertEqual("f5faf6", huefri.common.hsb2hex(40000, 20))
+        # low saturation is close to white, whatever the hue is
+        self.assertEqual("f5faf6", huefri.common.hsb2hex(1000, 1))
+        # hue goes around
+        self.assertEqual("efd275", huefri.common.hsb2hex(65000, 249))
+        self.assertEqual("f5faf6", huefri.common.hsb2hex(65535, 13))
+
+        huefri.common.COLORS_MAP = []
+        with self.assertRaises(Exception):
+            huefri.common.hsb2hex(1, 1)
+
+    def test_load_colors(self):
+        huefri.common.Config._config = {'colors': [
+            {"hex": "000000", "hsb": {'on': True, 'hue': 1, 'sat': 2}}]}
+        colors = huefri.common.load_colors()
+        self.assertEqual("000000", huefri.common.hsb2hex(1, 2, colors))
+        self.assertEqual({'on': True, 'hue': 1, 'sat': 2, 'bri': 3},
+                huefri.common.hex2hsb("000000", 3, colors))
+        self.assertEqual("000000", huefri.common.hsb2hex(7644, 150, colors))
+        # the colors of the config don't replace the default ones
+        self.assertEqual("f5faf6", huefri.common.hsb2hex(1, 2))
+
+        huefri.common.Config._config = {}
+        self.assertIsNone(huefri.common.load_colors())
+
+        huefri.common.Config._config = {'colors': [{"hex": "000000", "hsb": {'hue': 1}}]}
+        with self.assertRaises(huefri.common.HuefriException):
+            huefri.common.load_colors()
+
+        huefri.common.Config._config = {'colors': [{"hex": "000000"}]}
+        with self.assertRaises(huefri.common.HuefriException):
+            huefri.common.load_colors()
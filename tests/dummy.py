@@ -18,93 +18,456 @@
 #
 
 
+import asyncio
 import datetime
-from huefri.common import DELTA as DELTA
+import random
+import threading
+import time
+import requests
+import pytradfri.error
+from pytradfri.const import ATTR_DEVICE_STATE
+from pytradfri.const import ATTR_LIGHT_COLOR_HEX
+from pytradfri.const import ATTR_LIGHT_DIMMER
+from pytradfri.const import ATTR_LIGHT_COLOR_X
+from pytradfri.const import ATTR_LIGHT_COLOR_Y
+from pytradfri.const import ATTR_LIGHT_MIREDS
 
 class DummyHub(object):
     """ mock of Hue and Tradfri classes """
     def __init__(self):
-        self.set_time_to_now()
+        self.last_changed = datetime.datetime.now()
         self.rgb = None
         self.bri = None
         self.hsb = None
+        self.xy = None
+        self.mireds = None
 
-    def set_time_to_now(self):
-        """ test method to manipulate with last_changed time """
-        self.last_changed = datetime.datetime.now()
-
-    def set_time_to_past(self):
-        """ test method to manipulate with last_changed time """
-        self.last_changed = datetime.datetime.now() - 2*DELTA
-
-
-    def set_all(self, rgb, bri):
+    def set_all(self, rgb, bri, since=None, xy=None, mireds=None):
         """ Tradfri method """
         self.rgb = rgb
         self.bri = bri
+        self.xy = xy
+        self.mireds = mireds
 
-    def set_hsb(self, hsb):
+    def set_hsb(self, hsb, since=None):
         """ Hue method """
         self.hsb = hsb
 
 
+class Network(object):
+    """ how a simulated hub answers: every request takes latency +- jitter
+        seconds, at most rate requests per second are handled (the others
+        wait for their turn) and the given share of requests times out
+    """
+    def __init__(self, latency=0, jitter=0, rate=0, timeouts=0, error=Exception, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.timeouts = timeouts
+        self.error = error
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # when the hub can handle the next request
+        self.free = 0
+        # number of requests and of the timed out ones
+        self.requests = 0
+        self.failed = 0
+
+    def request(self):
+        """ take as long as a request to the hub, raise self.error if it
+            times out
+        """
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            delay = 0
+            if self.rate:
+                start = max(now, self.free)
+                self.free = start + 1 / self.rate
+                delay = start - now
+            delay += max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.timeouts
+            if failed:
+                self.failed += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise self.error("simulated timeout")
+
+def wait(network):
+    """ simulate a request over the network, if there is one """
+    if network is not None:
+        network.request()
+
+def bridge_network(**kwargs):
+    """ a Hue bridge, about 10 requests per second """
+    kwargs.setdefault('rate', 10)
+    return Network(error=requests.exceptions.Timeout, **kwargs)
+
+def gateway_network(**kwargs):
+    """ a Tradfri gateway """
+    return Network(error=pytradfri.error.RequestTimeout, **kwargs)
+
+
 # Hue section
 class HLight(object):
-    def __init__(self):
+    def __init__(self, white=False, network=None, gamut=None):
         self.hsb = None
+        # white ambiance bulbs have ct instead of hue and sat
+        self.white = white
+        self.network = network
+        # the color gamut reported in the capabilities, none if not given
+        self.gamut = gamut
+        # the colormode, set by the last color written
+        self.mode = None
+        # number of requests to this light
+        self.requests = 0
 
-    def state(self, hue, sat, bri):
-        self.hsb = {'hue': hue, 'sat': sat, 'bri': bri}
+    def state(self, **hsb):
+        wait(self.network)
+        self.requests += 1
+        # the last request
+        self.sent = hsb
+        self.apply(hsb)
 
-    def __call__(self):
+    def apply(self, hsb):
+        """ change the light without counting it as a request """
         if self.hsb is None:
-            return {'state': {'hue': 0, 'sat': 0, 'bri': 0, 'on': False}}
-        x = self.hsb.copy()
-        x['on'] = True if x['bri'] else False
-        return {'state': x}
+            self.hsb = {}
+        self.hsb.update(hsb)
+        for mode in ('xy', 'ct', 'hue', 'sat'):
+            if mode in hsb:
+                self.mode = 'hs' if mode in ('hue', 'sat') else mode
+
+    def __call__(self):
+        wait(self.network)
+        self.requests += 1
+        return self.read()
+
+    def read(self):
+        """ the state of the light, without counting a request """
+        x = {'ct': 366, 'bri': 0} if self.white else {'hue': 0, 'sat': 0, 'bri': 0}
+        if self.hsb is not None:
+            x.update(self.hsb)
+        if 'on' not in x:
+            x['on'] = True if x['bri'] else False
+        if self.mode is not None:
+            x['colormode'] = self.mode
+        light = {'state': x}
+        if self.white:
+            light['capabilities'] = {'control': {'ct': {'min': 153, 'max': 454}}}
+        elif self.gamut is not None:
+            light['capabilities'] = {'control': {'colorgamuttype': self.gamut,
+                'ct': {'min': 153, 'max': 500}}}
+        return light
+
+class HLights(list):
+    """ the /lights resource """
+    requests = 0
+    network = None
+
+    def __call__(self):
+        wait(self.network)
+        self.requests += 1
+        return {str(i): l.read() for i, l in enumerate(self)}
+
+class HGroup(object):
+    def __init__(self, groups, lights):
+        self.groups = groups
+        self.lights = lights
+
+    def action(self, **hsb):
+        wait(self.groups.bridge.network)
+        self.groups.requests += 1
+        for l in self.lights:
+            self.groups.bridge.lights[int(l)].apply(hsb)
+
+class HGroups(object):
+    """ the /groups resource """
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.groups = {}
+        self.requests = 0
+
+    def __call__(self, http_method='get', **kwargs):
+        wait(self.bridge.network)
+        self.requests += 1
+        if http_method == 'post':
+            return [{'success': {'id': self.add(kwargs['lights'], kwargs.get('name'))}}]
+        return {id: {'name': g.name, 'lights': g.lights, 'type': 'LightGroup'}
+                for id, g in self.groups.items()}
+
+    def __getitem__(self, id):
+        return self.groups[str(id)]
+
+    def add(self, lights, name=None):
+        """ test method to create a group of the given lights """
+        id = str(len(self.groups) + 1)
+        self.groups[id] = HGroup(self, [str(l) for l in lights])
+        self.groups[id].name = name
+        return id
 
 class Bridge(object):
-    def __init__(self, ip, secret):
+    def __init__(self, ip, secret, count=10, timeout=None, network=None):
         self.ip = ip
         self.secret = secret
-        self.lights = [HLight() for x in range(0,10)]
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.network = network
+        self.lights = HLights([HLight(network=network) for x in range(0,count)])
+        self.lights.network = network
+        self.groups = HGroups(self)
+
+    @property
+    def requests(self):
+        """ number of requests to the bridge """
+        return self.lights.requests + self.groups.requests + \
+                sum(l.requests for l in self.lights)
 
 # Tradfri section
 class TLight(object):
-    def __init__(self):
+    """ a bulb paired with the gateway, kind is 'hex' for a bulb taking
+        only the preset colors, 'xy' for a color bulb and 'mireds' for a
+        white spectrum one
+    """
+    def __init__(self, id=None, kind='hex'):
+        self.id = id
+        self.kind = kind
         self.color = None
+        self.xy = None
+        self.mireds = None
         self.dimmer = None
         self.state = None
+        self.name = "light %d" % (id or 0)
         self.has_light_control = True
         self.lights = [self]
+        # number of writes to this light
+        self.requests = 0
+        # (device, callback, err_callback) of the observations
+        self.observers = []
 
     @property
     def hex_color(self):
         return self.color
 
+    @property
+    def xy_color(self):
+        return self.xy
+
+    @property
+    def color_temp(self):
+        return self.mireds
+
+    @property
+    def supports_hsb_xy_color(self):
+        return self.kind == 'xy'
+
+    @property
+    def supports_color_temp(self):
+        return self.kind in ('xy', 'mireds')
+
     @property
     def light_control(self):
         return self
 
     def set_state(self, state):
+        self.requests += 1
         self.state = state
 
     def set_hex_color(self, color):
+        self.requests += 1
         self.color = color
 
     def set_dimmer(self, dimmer):
+        self.requests += 1
         self.dimmer = dimmer
 
+    def set_values(self, values):
+        self.requests += 1
+        self.apply(values)
+
+    def apply(self, values):
+        """ change the light without counting it as a request """
+        if ATTR_LIGHT_COLOR_HEX in values:
+            self.color = values[ATTR_LIGHT_COLOR_HEX]
+        if ATTR_LIGHT_COLOR_X in values:
+            self.xy = (values[ATTR_LIGHT_COLOR_X], values[ATTR_LIGHT_COLOR_Y])
+        if ATTR_LIGHT_MIREDS in values:
+            self.mireds = values[ATTR_LIGHT_MIREDS]
+        if ATTR_LIGHT_DIMMER in values:
+            self.dimmer = values[ATTR_LIGHT_DIMMER]
+        if ATTR_DEVICE_STATE in values:
+            self.state = bool(values[ATTR_DEVICE_STATE])
+
+    def push(self):
+        """ test method to simulate a change reported by the gateway """
+        for device, callback, err_callback in list(self.observers):
+            device.read()
+            callback(device)
+
+    def fail(self, err):
+        """ test method to simulate a broken observation """
+        observers = self.observers
+        self.observers = []
+        for device, callback, err_callback in observers:
+            err_callback(err)
+
+class TDevice(object):
+    """ a bulb as fetched from the gateway: its state at that time, which
+        changes only when it is updated or observed
+    """
+    def __init__(self, bulb):
+        self.bulb = bulb
+        self.id = bulb.id
+        self.name = bulb.name
+        self.has_light_control = True
+        self.lights = [self]
+        self.read()
+
+    def read(self):
+        self.xy = self.bulb.xy
+        self.mireds = self.bulb.mireds
+        self.color = self.bulb.color
+        self.dimmer = self.bulb.dimmer
+        self.state = self.bulb.state
+
+    @property
+    def kind(self):
+        """ what the bulb can show doesn't change """
+        return self.bulb.kind
+
+    hex_color = TLight.hex_color
+    xy_color = TLight.xy_color
+    color_temp = TLight.color_temp
+    supports_hsb_xy_color = TLight.supports_hsb_xy_color
+    supports_color_temp = TLight.supports_color_temp
+
+    @property
+    def light_control(self):
+        return self
+
+    def set_state(self, state):
+        self.bulb.set_state(state)
+
+    def set_values(self, values):
+        self.bulb.set_values(values)
+
+    def update(self):
+        """ the state is fetched right away """
+        self.read()
+        return None
+
+    def observe(self, callback, err_callback, duration):
+        """ the bulb calls the callbacks, see TLight.push() and fail() """
+        self.bulb.observers.append((self, callback, err_callback))
+        return None
+
+def fetch(device):
+    """ a device as returned by the gateway, a new object every time """
+    if isinstance(device, TLight):
+        return TDevice(device)
+    return device
+
 class TAPI(object):
-    def __init__(self, ip, secret):
+    def __init__(self, ip, secret=None, network=None, timeout=None):
         self.ip = ip
         self.secret = secret
+        self.timeout = timeout
+        self.psk = None
+        self.network = network
+
+    @property
+    def request(self):
+        return self
+
+    def __call__(self, command):
+        """ commands of the dummy objects are executed immediately,
+            so just pass the result through
+        """
+        for _ in (command if isinstance(command, list) else [command]):
+            wait(self.network)
+        return command
+
+class AsyncTAPI(object):
+    """ the aiocoap API factory """
+    def __init__(self, ip, psk):
+        self.ip = ip
+        self.psk = psk
+        # number of requests running at the same time, and the most of them
+        self.running = 0
+        self.most = 0
+        self.closed = False
+
+    @classmethod
+    async def init(cls, host, psk_id="pytradfri", psk=None):
+        return cls(host, psk)
+
+    async def request(self, command, timeout=None):
+        self.running += 1
+        self.most = max(self.most, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        return command
+
+    async def shutdown(self):
+        self.closed = True
+
+class TGroup(object):
+    def __init__(self, id, members):
+        self.id = id
+        self.members = members
+        self.member_ids = [m.id for m in members]
+        # number of writes to this group
+        self.requests = 0
+
+    def set_state(self, state):
+        self.requests += 1
+        for m in self.members:
+            m.state = state
+
+    def set_values(self, values):
+        self.requests += 1
+        for m in self.members:
+            m.apply(values)
+
+class TRemote(object):
+    """ a device without light control """
+    def __init__(self, id=None):
+        self.id = id
+        self.name = "remote"
+        self.has_light_control = False
 
 class Gateway(object):
-    def __init__(self, api):
+    def __init__(self, api=None, count=10):
         self.api = api
-        self.lights = [TLight() for x in range(0,10)]
+        self.lights = [TLight(65536 + x) for x in range(0,count)]
+        self.devices = self.lights
+        self.groups = []
+        # number of reads of all devices and of single devices
+        self.scans = 0
+        self.fetches = 0
 
     def get_devices(self):
-        return self.lights
+        self.scans += 1
+        return [fetch(dev) for dev in self.devices]
+
+    def get_device(self, id):
+        self.fetches += 1
+        for dev in self.devices:
+            if dev.id == id:
+                return fetch(dev)
+        raise KeyError(id)
+
+    def add_remote(self):
+        """ test method to pair a new remote with the gateway """
+        self.devices = [TRemote(65536 + len(self.devices))] + self.devices
+
+    def get_groups(self):
+        return self.groups
+
+    def add_group(self, lights):
+        """ test method to create a group of the given lights """
+        group = TGroup(131072 + len(self.groups), [self.lights[l] for l in lights])
+        self.groups.append(group)
+        return group
 
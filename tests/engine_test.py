@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+import asyncio
+import time
+
+import huefri
+import huefri.common
+import huefri.engine
+from huefri.engine import Engine, Watcher, Scheduler
+from huefri.metrics import METRICS as METRICS
+
+
+class CountingHub(object):
+    """ a hub whose update() takes some time """
+    def __init__(self, delay):
+        self.delay = delay
+        self.updates = 0
+        self.last_changed = 0
+
+    def update(self):
+        time.sleep(self.delay)
+        self.updates += 1
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.engine.log
+        huefri.engine.log = lambda x,y: None
+
+    def tearDown(self):
+        huefri.engine.log = self.fnt_log
+
+    def run_engine(self, watchers, duration):
+        async def run():
+            try:
+                await asyncio.wait_for(Engine(watchers).run_async(), duration)
+            except asyncio.TimeoutError:
+                pass
+        asyncio.run(run())
+
+    def test_independent(self):
+        # a stuck hub doesn't slow down the other one
+        slow = CountingHub(1)
+        fast = CountingHub(0)
+        self.run_engine([Watcher("slow", slow, 0.01, 5),
+            Watcher("fast", fast, 0.01, 5)], 0.3)
+        self.assertEqual(0, slow.updates)
+        self.assertGreater(fast.updates, 5)
+
+    def test_timeout(self):
+        # the watcher goes on after a timed out update
+        hub = CountingHub(0.1)
+        self.run_engine([Watcher("hub", hub, 0, 0.05)], 0.5)
+        self.assertGreater(hub.updates, 1)
+
+    def test_scheduler(self):
+        now = [0]
+        scheduler = Scheduler(idle=2, fast=0.1, window=1, clock=lambda: now[0])
+
+        # idle from the start
+        self.assertEqual(2, scheduler.next(False))
+
+        # fast after a change, for the whole window
+        self.assertEqual(0.1, scheduler.next(True))
+        now[0] = 0.9
+        self.assertEqual(0.1, scheduler.next(False))
+
+        # then backing off up to the idle interval
+        now[0] = 1.1
+        self.assertEqual(0.2, scheduler.next(False))
+        self.assertEqual(0.4, scheduler.next(False))
+        self.assertEqual(0.8, scheduler.next(False))
+        self.assertEqual(1.6, scheduler.next(False))
+        self.assertEqual(2, scheduler.next(False))
+        self.assertEqual(2, scheduler.interval)
+
+        self.assertEqual(8, scheduler.polls_per_minute)
+        now[0] = 61
+        self.assertEqual(5, scheduler.polls_per_minute)
+
+    def test_fast_after_change(self):
+        hub = CountingHub(0)
+        watcher = Watcher("hub", hub, 10, 5, 0.01, 5)
+
+        def change():
+            hub.updates += 1
+            hub.last_changed += 1
+        hub.update = change
+
+        METRICS.reset()
+        self.run_engine([watcher], 0.3)
+        self.assertEqual(0.01, watcher.interval)
+        self.assertGreater(watcher.scheduler.polls_per_minute, 5)
+
+        # both are on the metrics endpoint
+        values = METRICS.dict()['values']
+        self.assertEqual(0.01, values['interval_seconds{hub="hub"}'])
+        self.assertGreater(values['polls_per_minute{hub="hub"}'], 5)
+
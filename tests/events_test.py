@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from unittest import mock as mock
+import http.server
+import json
+import queue
+import threading
+import time
+
+import dummy
+import huefri
+import huefri.events
+import huefri.hue
+from huefri.hue import Hue
+
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    """ the event stream of a Hue bridge, sending what is put into
+        server.events, None ends the stream
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.keys.append(self.headers.get('hue-application-key'))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.chunk(b": hi\n\n")
+        while True:
+            event = self.server.events.get()
+            if event is None:
+                self.chunk(b"")
+                self.close_connection = True
+                return
+            self.chunk(("id: 1:0\ndata: %s\n\n" % json.dumps(event)).encode("utf-8"))
+
+    def chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def update(light, **state):
+    """ an event about the light changed """
+    data = dict(id="uuid", id_v1="/lights/%d" % light, type="light", **state)
+    return [{'creationtime': "2026-01-01T00:00:00Z", 'id': "uuid", 'type': "update",
+        'data': [data]}]
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.events.log
+        huefri.events.log = lambda x,y: None
+        huefri.hue.log = lambda x,y: None
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StreamHandler)
+        self.server.daemon_threads = True
+        self.server.events = queue.Queue()
+        self.server.keys = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.tradfri = dummy.DummyHub()
+        address = "127.0.0.1:%d" % self.server.server_address[1]
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            with mock.patch('huefri.hue.EVENTS', "http://%s/eventstream/clip/v2") as n:
+                self.hue = Hue(address, "KEY", 1, [1, 2], self.tradfri, debounce=0, rate=0,
+                        events=True)
+        self.hue.stream.retry = 0.1
+        self.bridge = self.hue.bridge
+        self.bridge.lights[1].state(on=True, hue=7644, sat=150, bri=100)
+        # the first look at the main light
+        self.hue.update()
+
+    def tearDown(self):
+        self.hue.stream.close()
+        self.server.events.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+        huefri.events.log = self.fnt_log
+
+    def wait(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return condition()
+
+    def test_push(self):
+        self.hue.start_streaming()
+        self.assertTrue(self.hue.stream.connected.wait(5))
+        self.assertEqual(["KEY"], self.server.keys)
+
+        # no polling while the bridge pushes the changes
+        requests = self.bridge.requests
+        for i in range(0, 10):
+            self.hue.update()
+        self.assertEqual(requests, self.bridge.requests)
+
+        # a change of the main light is synced as soon as it is pushed
+        self.bridge.lights[1].state(on=True, hue=7644, sat=150, bri=50)
+        self.server.events.put(update(1, dimming={'brightness': 19.7}))
+        self.assertTrue(self.wait(lambda: self.tradfri.bri == 50))
+
+        # other lights are not read
+        requests = self.bridge.requests
+        self.server.events.put(update(5, on={'on': False}))
+        self.server.events.put(update(1, on={'on': True}))
+        self.assertTrue(self.wait(lambda: self.bridge.requests > requests))
+        self.assertEqual(requests + 1, self.bridge.requests)
+
+    def test_pairs(self):
+        # a second pair on the same bridge and stream
+        other = dummy.DummyHub()
+        hue = Hue(self.hue.ip, "KEY", 3, [3, 4], other, debounce=0, rate=0, share=self.hue)
+        hue.update()
+        self.hue.start_streaming()
+        self.assertTrue(self.hue.stream.connected.wait(5))
+
+        # each pushed change is synced to its own pair, even when another
+        # pair read the bridge after the last look of this one
+        self.bridge.lights[1].state(on=True, hue=7644, sat=150, bri=50)
+        self.server.events.put(update(1, dimming={'brightness': 19.7}))
+        self.assertTrue(self.wait(lambda: self.tradfri.bri == 50))
+        self.bridge.lights[3].state(on=True, hue=7644, sat=150, bri=30)
+        self.server.events.put(update(3, dimming={'brightness': 11.8}))
+        self.assertTrue(self.wait(lambda: other.bri == 30))
+
+    def test_fallback(self):
+        self.hue.stream.retry = 10
+        self.hue.start_streaming()
+        self.assertTrue(self.hue.stream.connected.wait(5))
+
+        # the stream dropped, the main light is polled again
+        self.server.events.put(None)
+        self.assertTrue(self.wait(lambda: not self.hue.streaming))
+        self.bridge.lights[1].state(on=True, hue=7644, sat=150, bri=30)
+        self.hue.update()
+        self.assertEqual(30, self.tradfri.bri)
+
+    def test_reconnect(self):
+        self.hue.start_streaming()
+        self.assertTrue(self.hue.stream.connected.wait(5))
+        self.server.events.put(None)
+        # a change made while the stream was down is synced when it is back
+        self.bridge.lights[1].state(on=True, hue=7644, sat=150, bri=70)
+        self.assertTrue(self.wait(lambda: len(self.server.keys) == 2))
+        self.assertTrue(self.wait(lambda: self.tradfri.bri == 70))
+
+    def test_controlled(self):
+        # a controlled light changed by somebody else is written in full
+        self.hue.cache.confirm([2], {'on': True, 'bri': 10})
+        self.hue.stream._dispatch(json.dumps(update(2, dimming={'brightness': 50})))
+        self.assertEqual({}, self.hue.cache.lights.get(2, {}))
+
+        # the states of all lights are published
+        self.hue.stream._dispatch(json.dumps(update(7, on={'on': False},
+            color_temperature={'mirek': 366})))
+        state = huefri.hue.FEED.state()['lights']['hue']['7']
+        self.assertEqual((False, 366), (state['on'], state['ct']))
+
+        # events of other resources are ignored
+        self.hue.stream._dispatch(json.dumps([{'type': "update",
+            'data': [{'id_v1': "/groups/1", 'type': "grouped_light"}]}]))
+        self.hue.stream._dispatch("not json")
+
+    def test_controlled_echo(self):
+        # the events of our own write keep what was written to the light
+        self.hue.cache.confirm([2], {'on': True, 'hue': 7644, 'sat': 150, 'bri': 100})
+        self.hue.stream._dispatch(json.dumps(update(2, on={'on': True},
+            dimming={'brightness': 39.37})))
+        self.assertEqual({'on': True, 'hue': 7644, 'sat': 150, 'bri': 100},
+                self.hue.cache.lights[2])
+
+        # a new color can't be compared, only the written hue/sat are forgotten
+        self.hue.stream._dispatch(json.dumps(update(2,
+            color={'xy': {'x': 0.45, 'y': 0.41}})))
+        self.assertEqual({'on': True, 'bri': 100}, self.hue.cache.lights[2])
+        self.assertEqual([0.45, 0.41], huefri.hue.FEED.state()['lights']['hue']['2']['xy'])
+
+        # but the light turned off by somebody else is written in full
+        self.hue.stream._dispatch(json.dumps(update(2, on={'on': False})))
+        self.assertNotIn(2, self.hue.cache.lights)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from unittest import mock as mock
+import threading
+
+import dummy
+import huefri
+import huefri.hue
+from huefri.feed import Feed as Feed
+from huefri.feed import FEED as FEED
+from huefri.hue import Hue
+
+
+class TestFeed(unittest.TestCase):
+
+    def test_publish(self):
+        feed = Feed()
+        feed.publish("hue", 1, {'on': True, 'bri': 100})
+        # nothing new, no change
+        feed.publish("hue", 1, {'bri': 100})
+        feed.publish("hue", "1", {'bri': 50})
+        self.assertEqual({'version': 2, 'lights': {'hue': {'1': {'on': True, 'bri': 50}}}},
+                feed.state())
+        self.assertEqual([{'version': 2, 'hub': "hue", 'light': "1", 'state': {'bri': 50}}],
+                feed.changes(1)['changes'])
+
+    def test_wait(self):
+        feed = Feed()
+        threading.Timer(0.05, feed.publish, ("tradfri", 0, {'dimmer': 10})).start()
+        self.assertEqual(1, len(feed.changes(0, 5)['changes']))
+        self.assertEqual([], feed.changes(1, 0.01)['changes'])
+
+    def test_history(self):
+        feed = Feed(history=2)
+        for i in range(0, 5):
+            feed.publish("hue", 1, {'bri': i})
+        self.assertEqual(2, len(feed.changes(3)['changes']))
+        # the older changes are gone, all the states are returned instead
+        self.assertEqual({'hue': {'1': {'bri': 4}}}, feed.changes(1)['lights'])
+        # a version of another run
+        self.assertEqual(5, feed.changes(10)['version'])
+
+    def test_hue(self):
+        FEED.reset()
+        huefri.hue.log = lambda x,y: None
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            hue = Hue("hue", "secret", 1, [1, 2], dummy.DummyHub(), debounce=0, rate=0)
+        hue.bridge.lights[3].state(on=True, bri=30, hue=100, sat=200)
+        hue.poll()
+        # all lights read by the poll are known
+        self.assertEqual({'on': True, 'bri': 30, 'hue': 100, 'sat': 200},
+                FEED.state()['lights']['hue']['3'])
+
+        # and the written ones right away
+        hue.set_hsb({'on': True, 'hue': 7644, 'sat': 150, 'bri': 90})
+        hue.flush()
+        self.assertEqual(90, FEED.state()['lights']['hue']['2']['bri'])
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Count requests to the Hue bridge per sync. """
+
+import functools
+from unittest import mock as mock
+
+import dummy
+import huefri
+import huefri.common
+import huefri.hue
+import huefri.pool
+from huefri.hue import Hue
+
+LIGHTS = 30
+SYNCS = 100
+
+
+def requests_per_sync(group: bool) -> float:
+    bridge = functools.partial(dummy.Bridge, count=LIGHTS + 1)
+    with mock.patch('qhue.Bridge', bridge) as m:
+        hue = Hue("hue", "secret", 0, list(range(1, LIGHTS + 1)), create_group=group)
+
+    start = hue.bridge.requests
+    for i in range(0, SYNCS):
+        hue.set_hsb({'on': True, 'hue': 7644, 'sat': 150, 'bri': i})
+        hue.flush()
+    return (hue.bridge.requests - start) / SYNCS
+
+
+def bench():
+    huefri.hue.log = lambda x,y: None
+    huefri.pool.log = lambda x,y: None
+    print("Hue set_hsb, %d lights:" % LIGHTS)
+    print("  per light: %.1f requests per sync" % requests_per_sync(False))
+    print("  group:     %.1f requests per sync" % requests_per_sync(True))
+
+
+if __name__ == '__main__':
+    bench()
@@ -26,7 +26,6 @@ import dummy
 import huefri
 import huefri.common
 from huefri.hue import Hue
-from huefri.common import DELTA as DELTA
 
 
 
@@ -82,6 +81,7 @@ class TestHue(unittest.TestCase):
 
     def test_set_hsb(self):
         self.hue.set_hsb({'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
         self.assertDictEqual(self.hue.bridge.lights[1].hsb,
                 {'hue':  7644, 'sat': 150, 'bri': 100})
         self.assertDictEqual(self.hue.bridge.lights[2].hsb,
@@ -100,38 +100,248 @@ class TestHue(unittest.TestCase):
             self.hue.changed()
 
         # set up
-        self.hue.set_hsb({'hue':  7644, 'sat': 150, 'bri': 100})
+        light = self.hue.bridge.lights[1]
+        light.state(hue=7644, sat=150, bri=100)
         self.hue.tradfri = dummy.DummyHub()
 
-        # save current state
-        self.hue.tradfri.set_time_to_now()
+        # save current state, the first look is not a change
         self.assertFalse(self.hue.changed())
-        # move time, test if it remembers state
-        self.hue.tradfri.set_time_to_past()
+        # test if it remembers state
         self.assertFalse(self.hue.changed())
 
         # change state
-        self.hue.set_hsb({'hue':  100, 'sat': 100, 'bri': 100})
+        light.state(hue=100, sat=100, bri=100)
         self.assertTrue(self.hue.changed())
-        # move time, test if it remembers state
-        self.hue.tradfri.set_time_to_past()
+        # test if it remembers state
+        self.assertFalse(self.hue.changed())
+
+    def test_echo(self):
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.changed()
+
+        # our own write to the main light is not a change
+        self.hue.set_hsb({'on': True, 'hue': 7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+        self.assertFalse(self.hue.changed())
+
+        # but the user changing it right after is
+        self.hue.bridge.lights[1].state(bri=50)
+        self.assertTrue(self.hue.changed())
+        # even back to the state we wrote
+        self.hue.bridge.lights[1].state(bri=100)
+        self.assertTrue(self.hue.changed())
+
+        # writes which didn't show up yet are still recognized
+        self.hue.set_hsb({'on': True, 'hue': 7644, 'sat': 150, 'bri': 10})
+        self.hue.flush()
+        self.hue.set_hsb({'on': True, 'hue': 7644, 'sat': 150, 'bri': 20})
+        self.hue.flush()
+        self.hue.bridge.lights[1].apply({'bri': 10})
+        self.assertFalse(self.hue.changed())
+        self.hue.bridge.lights[1].apply({'bri': 20})
+        self.assertFalse(self.hue.changed())
+
+    def test_echo_same_state(self):
+        self.hue.tradfri = dummy.DummyHub()
+        light = self.hue.bridge.lights[1]
+        light.apply({'on': True, 'hue': 7644, 'sat': 150, 'bri': 100})
+        self.hue.changed()
+
+        # the sync writes the state the main light already is in
+        self.hue.set_hsb({'on': True, 'hue': 7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
         self.assertFalse(self.hue.changed())
 
+        # so no echo of it can swallow the user going back to it
+        light.apply({'bri': 50})
+        self.assertTrue(self.hue.changed())
+        light.apply({'bri': 100})
+        self.assertTrue(self.hue.changed())
+
 
     def test_update(self):
         self.hue.tradfri = dummy.DummyHub()
 
         # the colors of tradfri should change
-        with mock.patch('huefri.hue.Hue.changed', lambda x: True) as m:
+        with mock.patch('huefri.hue.Hue.changed', lambda x, force=False: True) as m:
             self.hue.set_hsb({'hue':  7644, 'sat': 150, 'bri': 100})
+            self.hue.flush()
             self.hue.update()
             self.assertEqual("f1e0b5", self.hue.tradfri.rgb)
             self.assertEqual(100, self.hue.tradfri.bri)
 
         # the colors of tradfri should stay same as in the previous case
-        with mock.patch('huefri.hue.Hue.changed', lambda x: False) as m:
+        with mock.patch('huefri.hue.Hue.changed', lambda x, force=False: False) as m:
             self.hue.set_hsb({'hue': 39312, 'sat':  13, 'bri': 150})
+            self.hue.flush()
             self.hue.update()
             self.assertEqual("f1e0b5", self.hue.tradfri.rgb)
             self.assertEqual(100, self.hue.tradfri.bri)
 
+    def test_update_single_read(self):
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.update()
+
+        # a change is propagated with just one read of the main light
+        self.hue.bridge.lights[1].state(hue=7644, sat=150, bri=100)
+        self.hue.update()
+        self.assertEqual(1, self.hue.reads)
+        self.assertEqual("f1e0b5", self.hue.tradfri.rgb)
+
+        # and no change costs one read as well
+        self.hue.update()
+        self.assertEqual(1, self.hue.reads)
+
+    def test_set_hsb_group(self):
+        # a group which doesn't match the controlled lights is not used
+        self.hue.bridge.groups.add([1, 2])
+        self.hue.discover_group()
+        self.assertIsNone(self.hue.group)
+
+        self.hue.bridge.groups.add([3, 2, 1])
+        self.hue.discover_group()
+        self.assertEqual('2', self.hue.group)
+
+        # one group action changes all the lights
+        requests = self.hue.bridge.requests
+        self.hue.set_hsb({'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+        self.assertEqual(requests + 1, self.hue.bridge.requests)
+        for l in range(1, 4):
+            self.assertDictEqual(self.hue.bridge.lights[l].hsb,
+                    {'hue':  7644, 'sat': 150, 'bri': 100})
+        self.assertEqual(self.hue.bridge.lights[4].hsb, None)
+
+    def test_create_group(self):
+        self.hue.discover_group()
+        self.assertIsNone(self.hue.group)
+        self.hue.discover_group(create=True)
+        self.assertEqual('1', self.hue.group)
+        self.assertEqual(['1', '2', '3'], self.hue.bridge.groups['1'].lights)
+
+    def test_update_white(self):
+        # white ambiance bulbs are synced by their color temperature
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.bridge.lights[1] = dummy.HLight(white=True)
+        self.hue.update()
+
+        self.hue.bridge.lights[1].state(ct=153, bri=100)
+        self.hue.update()
+        self.assertEqual("f5faf6", self.hue.tradfri.rgb)
+        self.assertEqual(100, self.hue.tradfri.bri)
+
+        self.hue.bridge.lights[1].state(ct=366, bri=100)
+        self.hue.update()
+        self.assertEqual("f1e0b5", self.hue.tradfri.rgb)
+        self.assertEqual(366, self.hue.tradfri.mireds)
+
+    def test_update_xy(self):
+        # the true color is sent along with the closest preset one
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.update()
+
+        self.hue.bridge.lights[1].state(xy=[0.3227, 0.329], bri=100)
+        self.hue.update()
+        self.assertEqual((0.3227, 0.329), self.hue.tradfri.xy)
+        self.assertAlmostEqual(167, self.hue.tradfri.mireds, delta=2)
+        self.assertEqual(100, self.hue.tradfri.bri)
+
+        # a color set by hue and sat is converted
+        self.hue.bridge.lights[1].state(hue=0, sat=254)
+        self.hue.update()
+        x, y = self.hue.tradfri.xy
+        self.assertTrue(x > 0.6 and y < 0.35)
+
+    def test_set_hsb_xy(self):
+        # each light gets the color the way it can show it
+        self.hue.bridge.lights[1] = dummy.HLight(gamut='A')
+        self.hue.bridge.lights[2] = dummy.HLight(white=True)
+        self.hue.poll()
+
+        self.hue.set_hsb({'on': True, 'xy': [0.17, 0.7], 'bri': 100})
+        self.hue.flush()
+        # green beyond gamut A is clamped into it
+        self.assertEqual([0.2132, 0.6947], self.hue.bridge.lights[1].hsb['xy'])
+        # white ambiance bulbs get a color temperature within their range
+        hsb = self.hue.bridge.lights[2].hsb
+        self.assertNotIn('xy', hsb)
+        self.assertTrue(153 <= hsb['ct'] <= 454)
+        # and lights not telling what they can show get it as it is
+        self.assertEqual([0.17, 0.7], self.hue.bridge.lights[3].hsb['xy'])
+
+    def test_echo_xy(self):
+        # the main light set to a clamped color is not a change
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.bridge.lights[1] = dummy.HLight(gamut='A')
+        self.hue.update()
+
+        self.hue.set_hsb({'on': True, 'xy': [0.17, 0.7], 'bri': 100})
+        self.hue.flush()
+        self.assertFalse(self.hue.changed())
+
+        self.hue.bridge.lights[1].state(xy=[0.3, 0.3])
+        self.assertTrue(self.hue.changed())
+
+    def test_snapshot(self):
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.set_hsb({'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+
+        # one GET /lights per cycle, no request for a single light
+        requests = self.hue.bridge.requests
+        self.hue.update()
+        self.assertEqual(requests + 1, self.hue.bridge.requests)
+        self.assertEqual(1, self.hue.bridge.lights.requests)
+
+        # the states of the other lights come from the same read
+        self.assertEqual(100, self.hue.states.state(2)['bri'])
+        self.assertEqual(0, self.hue.states.state(5)['bri'])
+
+
+    def test_skip_redundant(self):
+        self.hue.set_hsb({'on': True, 'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+        requests = self.hue.bridge.requests
+
+        # the lights already are in this state
+        self.hue.set_hsb({'on': True, 'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+        self.assertEqual(requests, self.hue.bridge.requests)
+        self.assertEqual(3, self.hue.cache.saved)
+
+        # only the changed field is sent
+        self.hue.set_hsb({'on': True, 'hue':  7644, 'sat': 150, 'bri': 200})
+        self.hue.flush()
+        self.assertEqual(requests + 3, self.hue.bridge.requests)
+        self.assertEqual({'bri': 200}, self.hue.bridge.lights[2].sent)
+        self.assertEqual(200, self.hue.bridge.lights[2].hsb['bri'])
+
+    def test_skip_redundant_changed_outside(self):
+        self.hue.tradfri = dummy.DummyHub()
+        self.hue.set_hsb({'on': True, 'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+
+        # somebody else dims a light, it is written to again
+        self.hue.bridge.lights[2].apply({'bri': 10})
+        self.hue.update()
+        requests = self.hue.bridge.lights[2].requests
+        self.hue.set_hsb({'on': True, 'hue':  7644, 'sat': 150, 'bri': 100})
+        self.hue.flush()
+        self.assertEqual(requests + 1, self.hue.bridge.lights[2].requests)
+        self.assertEqual(100, self.hue.bridge.lights[2].hsb['bri'])
+
+    def test_rate(self):
+        # each change costs a command for every light
+        self.assertAlmostEqual(10 / 3, self.hue.debouncer.rate)
+        # but only one for a group
+        self.hue.bridge.groups.add([1, 2, 3])
+        self.hue.discover_group()
+        self.assertEqual(10, self.hue.debouncer.rate)
+
+        # changes in a quick succession are sent only once
+        requests = self.hue.bridge.requests
+        for bri in range(100, 110):
+            self.hue.set_hsb({'hue':  7644, 'sat': 150, 'bri': bri})
+        self.hue.flush()
+        self.assertEqual(requests + 1, self.hue.bridge.requests)
+        self.assertEqual(109, self.hue.bridge.lights[1].hsb['bri'])
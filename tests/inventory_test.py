@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from unittest import mock as mock
+import json
+import os
+import tempfile
+
+import dummy
+import huefri
+import huefri.common
+import huefri.inventory
+import huefri.tradfri
+from huefri.inventory import Inventory
+from huefri.tradfri import Tradfri
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.inventory.log
+        huefri.inventory.log = lambda x,y: None
+        huefri.tradfri.log = lambda x,y: None
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "devices.json")
+        self.gateway = dummy.Gateway()
+        self.api = dummy.TAPI("tradfri")
+
+    def tearDown(self):
+        huefri.inventory.log = self.fnt_log
+        self.dir.cleanup()
+
+    def tradfri(self, main=0, lights=[0, 1, 2]):
+        with mock.patch('huefri.tradfri.APIFactory', lambda ip, timeout=None: self.api) as m:
+            with mock.patch('huefri.tradfri.Gateway', lambda: self.gateway) as n:
+                tradfri = Tradfri("tradfri", "secret", main, lights, dummy.DummyHub(),
+                        cache=self.path)
+        if tradfri.inventory.thread is not None:
+            tradfri.inventory.thread.join(5)
+        return tradfri
+
+    def test_cold(self):
+        # without a cache, all devices are read and cached
+        tradfri = self.tradfri()
+        self.assertEqual(1, self.gateway.scans)
+        with open(self.path) as h:
+            cache = json.load(h)
+        self.assertEqual("tradfri", cache['addr'])
+        self.assertEqual(10, len(cache['devices']))
+        self.assertEqual(65536, cache['devices'][0]['id'])
+        self.assertTrue(cache['devices'][0]['light'])
+
+    def test_warm(self):
+        self.tradfri()
+        self.gateway.scans = 0
+        self.gateway.fetches = 0
+
+        # with the cache, only the used lights are fetched first
+        with mock.patch('huefri.inventory.Inventory.revalidate') as m:
+            tradfri = self.tradfri(5, [5, 7])
+        self.assertEqual(0, self.gateway.scans)
+        self.assertEqual(2, self.gateway.fetches)
+        self.assertIs(self.gateway.lights[5], tradfri._lights[5].bulb)
+        self.assertIsNone(tradfri._lights[0])
+
+        # and the rest is checked in the background
+        tradfri = self.tradfri(5, [5, 7])
+        self.assertEqual(1, self.gateway.scans)
+        self.assertIs(self.gateway.lights[0], tradfri._lights[0].bulb)
+
+    def test_outdated(self):
+        self.tradfri()
+        # a light paired since the cache was written moves the indexes
+        self.gateway.lights.insert(0, dummy.TLight(65546))
+        self.gateway.devices = self.gateway.lights
+
+        tradfri = self.tradfri()
+        self.assertEqual(11, len(tradfri._lights))
+        self.assertEqual(65546, tradfri.inventory.ids[0])
+        with open(self.path) as h:
+            self.assertEqual(11, len(json.load(h)['devices']))
+
+    def test_outdated_shared(self):
+        self.tradfri()
+        self.gateway.lights.insert(0, dummy.TLight(65546))
+        self.gateway.devices = self.gateway.lights
+
+        # the pair sharing the gateway comes after the scan is done and
+        # still learns that the indexes changed
+        first = self.tradfri()
+        with mock.patch('huefri.tradfri.Tradfri._revalidated') as m:
+            second = Tradfri("tradfri", "secret", 3, [3, 4], dummy.DummyHub(), share=first)
+        m.assert_called_once_with(True)
+
+        # a late listener gets the last result, then the next ones
+        calls = []
+        first.inventory.listen(calls.append)
+        first.inventory.revalidate()
+        first.inventory.thread.join(5)
+        self.assertEqual([True, False], calls)
+
+    def test_other_gateway(self):
+        with open(self.path, 'w') as h:
+            json.dump({'addr': "other", 'devices': []}, h)
+        inventory = Inventory(self.api, self.gateway, self.path, "tradfri")
+        self.assertFalse(inventory.load())
+
+    def test_missing_light(self):
+        inventory = Inventory(self.api, self.gateway, None, "tradfri")
+        inventory.scan()
+        with self.assertRaises(huefri.common.HuefriException):
+            inventory.need([10])
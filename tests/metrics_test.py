@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import time
+
+from huefri.metrics import Histogram
+from huefri.metrics import Metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_add(self):
+        h = Histogram((10, 100))
+        for value in (1, 10, 11, 50, 1000):
+            h.add(value)
+        self.assertEqual(5, h.count)
+        self.assertAlmostEqual(1072 / 5, h.mean)
+        self.assertEqual({'<=10': 2, '<=100': 2, '>100': 1}, h.dict()['buckets'])
+
+    def test_percentile(self):
+        h = Histogram((10, 100))
+        self.assertEqual(0.0, h.percentile(50))
+        for value in range(0, 90):
+            h.add(5)
+        for value in range(0, 10):
+            h.add(500)
+        self.assertEqual(10, h.percentile(50))
+        self.assertEqual(10, h.percentile(90))
+        self.assertEqual(float('inf'), h.percentile(95))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_count(self):
+        self.metrics.count("polls", hub="hue")
+        self.metrics.count("polls", hub="hue")
+        self.metrics.count("polls", hub="tradfri")
+        self.assertEqual(2, self.metrics.get("polls", hub="hue"))
+        self.assertEqual(1, self.metrics.get("polls", hub="tradfri"))
+        self.assertIsNone(self.metrics.get("polls"))
+
+    def test_timer(self):
+        with self.metrics.timer("read", hub="hue"):
+            time.sleep(0.01)
+        h = self.metrics.get("read", hub="hue")
+        self.assertEqual(1, h.count)
+        self.assertGreaterEqual(h.mean, 10)
+        self.assertEqual(20, self.metrics.dict()['latency']['read{hub="hue"}']['p99'])
+
+    def test_text(self):
+        self.metrics.count("echoes", hub="hue")
+        self.metrics.set("interval_seconds", 0.5, hub="hue")
+        self.metrics.set("interval_seconds", 2, hub="hue")
+        self.metrics.observe("sync", 3, hub="tradfri")
+        self.metrics.observe("sync", 30, hub="tradfri")
+        lines = self.metrics.text().splitlines()
+        self.assertIn('huefri_echoes_total{hub="hue"} 1', lines)
+        self.assertIn('huefri_interval_seconds{hub="hue"} 2', lines)
+        self.assertIn('huefri_sync_ms_bucket{hub="tradfri",le="2"} 0', lines)
+        self.assertIn('huefri_sync_ms_bucket{hub="tradfri",le="5"} 1', lines)
+        self.assertIn('huefri_sync_ms_bucket{hub="tradfri",le="50"} 2', lines)
+        self.assertIn('huefri_sync_ms_bucket{hub="tradfri",le="+Inf"} 2', lines)
+        self.assertIn('huefri_sync_ms_sum{hub="tradfri"} 33.0', lines)
+        self.assertIn('huefri_sync_ms_count{hub="tradfri"} 2', lines)
+
+    def test_merge(self):
+        other = Metrics()
+        other.count("polls", hub="hue")
+        other.observe("sync", 42, hub="hue")
+        other.set("polls_per_minute", 12, hub="hue")
+        self.metrics.count("polls", hub="hue", worker="0")
+        self.metrics.merge(other.export(), worker="0")
+        self.metrics.merge(other.export(), worker="1")
+        self.assertEqual(2, self.metrics.get("polls", hub="hue", worker="0"))
+        self.assertEqual(1, self.metrics.get("polls", hub="hue", worker="1"))
+        self.assertEqual(1, self.metrics.get("sync", hub="hue", worker="1").count)
+        self.assertEqual(50, self.metrics.get("sync", hub="hue", worker="1").percentile(99))
+
+        # values are replaced, not added
+        self.metrics.merge(other.export(), worker="1")
+        self.assertEqual(12, self.metrics.get("polls_per_minute", hub="hue", worker="1"))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from unittest import mock as mock
+import json
+
+import dummy
+import huefri
+import huefri.common
+import huefri.pairs
+
+
+class TestPairs(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.common.log
+        huefri.common.log = lambda x,y: None
+        huefri.hue.log = lambda x,y: None
+        huefri.tradfri.log = lambda x,y: None
+        huefri.common.Config._config = json.loads("""{
+            "hue":{
+                "addr":"hue",
+                "secret": "SECRET1"
+                },
+            "tradfri":{
+                "addr": "tradfri",
+                "secret": "SECRET2",
+                "cache": null
+                },
+            "pairs": [
+                {"hue": {"main": 1, "controlled": [1, 2]},
+                 "tradfri": {"main": 0, "controlled": [0, 1]}},
+                {"hue": {"main": 3, "controlled": [3, 4]},
+                 "tradfri": {"main": 2, "controlled": [2, 3]}},
+                {"hue": {"main": 5, "controlled": [5]},
+                 "tradfri": {"main": 4, "controlled": [4]}}
+            ]
+            }""")
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as n:
+                with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as o:
+                    self.pairs = huefri.pairs.autoinit()
+
+    def tearDown(self):
+        huefri.common.log = self.fnt_log
+
+    def test_autoinit(self):
+        self.assertEqual(3, len(self.pairs))
+        hue, tradfri = self.pairs[2]
+        self.assertEqual(5, hue.main_light)
+        self.assertEqual([4], tradfri.lights_selected)
+        self.assertIs(tradfri, hue.tradfri)
+        self.assertIs(hue, tradfri.hue)
+
+        # one connection per hub
+        for hue, tradfri in self.pairs:
+            self.assertIs(self.pairs[0][0].bridge, hue.bridge)
+            self.assertIs(self.pairs[0][0].states, hue.states)
+            self.assertIs(self.pairs[0][1].api, tradfri.api)
+            self.assertIs(self.pairs[0][1].gateway, tradfri.gateway)
+            self.assertIs(self.pairs[0][0].limiter, hue.limiter)
+            self.assertIs(self.pairs[0][1].limiter, tradfri.limiter)
+
+    def test_batched_reads(self):
+        hues, tradfris = huefri.pairs.hubs(self.pairs)
+        bridge = self.pairs[0][0].bridge
+        # the first look at the lights
+        hues.update()
+
+        # all the main lights are read with one request
+        bridge.lights[3].state(hue=7644, sat=150, bri=100)
+        requests = bridge.requests
+        hues.update()
+        self.assertEqual(requests + 1, bridge.requests)
+
+        # and each of them is synced to its own pair
+        tradfris.hubs[1].flush()
+        gateway = self.pairs[0][1].gateway
+        self.assertEqual("f1e0b5", gateway.lights[2].color)
+        self.assertEqual(100, gateway.lights[3].dimmer)
+        self.assertIsNone(gateway.lights[0].color)
+
+    def test_groups(self):
+        # each pair has its own group on the shared bridge
+        hues = [hue for hue, tradfri in self.pairs[0:2]]
+        bridge = hues[0].bridge
+        bridge.groups.add([1, 2])
+        bridge.groups.add([3, 4])
+        for hue in hues:
+            hue.discover_group()
+        self.assertNotEqual(hues[0].group, hues[1].group)
+
+        # the writes of both groups wait in the shared pool at once
+        jobs = []
+        with mock.patch.object(hues[0].pool.executor, 'submit',
+                lambda fn, *args: jobs.append((fn, args))) as m:
+            hues[0]._fan_out({'on': True, 'bri': 10})
+            hues[1]._fan_out({'on': True, 'bri': 20})
+        for fn, args in jobs:
+            fn(*args)
+        self.assertEqual(10, bridge.lights[1].hsb['bri'])
+        self.assertEqual(20, bridge.lights[3].hsb['bri'])
+
+    def test_single_pair(self):
+        # without pairs, the hub sections are used as before
+        huefri.common.Config._config = json.loads("""{
+            "hue":{"addr":"hue", "secret": "SECRET1", "controlled": [1,2,3], "main": 1},
+            "tradfri":{"addr": "tradfri", "secret": "SECRET2", "controlled": [0,1,2], "main": 0,
+                "cache": null}
+            }""")
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as n:
+                with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as o:
+                    pairs = huefri.pairs.autoinit()
+        self.assertEqual(1, len(pairs))
+        self.assertEqual([1, 2, 3], pairs[0][0].lights_selected)
+        self.assertIsNot(self.pairs[0][0].states, pairs[0][0].states)
+
+
+    def test_installation_colors(self):
+        # each installation translates with its own colors
+        config = json.loads("""{
+            "hue":{"addr":"hue2", "secret": "SECRET1", "controlled": [1], "main": 1},
+            "tradfri":{"addr": "tradfri2", "secret": "SECRET2", "controlled": [0], "main": 0,
+                "cache": null},
+            "colors": [{"hex": "000000", "hsb": {"on": true, "hue": 1, "sat": 2}}]
+            }""")
+        default = huefri.common.COLORS_MAP
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as n:
+                with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as o:
+                    hue, tradfri = huefri.pairs.autoinit(config, "custom")[0]
+                    other = huefri.pairs.autoinit(name="default")[0][0]
+        self.assertIs(default, huefri.common.COLORS_MAP)
+        self.assertIs(config['colors'], tradfri.colors)
+        self.assertEqual("000000", hue._hex({'hue': 7644, 'sat': 150}))
+        self.assertEqual("f1e0b5", other._hex({'hue': 7644, 'sat': 150}))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+import threading
+import time
+
+import huefri
+import huefri.pool
+from huefri.pool import WritePool
+from huefri.pool import Debouncer
+from huefri.pool import Limiter
+from huefri.metrics import METRICS as METRICS
+
+
+class TestWritePool(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.pool.log
+        huefri.pool.log = lambda x,y: None
+        self.pool = WritePool(2)
+        self.written = []
+
+    def tearDown(self):
+        huefri.pool.log = self.fnt_log
+
+    def write(self, light, value, block=None):
+        if block is not None:
+            block.wait()
+        self.written.append((light, value))
+
+    def test_write(self):
+        for l in range(0, 5):
+            self.pool.submit(l, self.write, l, 'a')
+        self.assertTrue(self.pool.join(5))
+        self.assertEqual(5, len(self.written))
+        self.assertEqual(5, self.pool.stats()['written'])
+
+    def test_coalesce(self):
+        block = threading.Event()
+        # the first write blocks the light, the next ones wait
+        self.pool.submit(1, self.write, 1, 'a', block)
+        self.pool.submit(1, self.write, 1, 'b')
+        self.pool.submit(1, self.write, 1, 'c')
+        self.pool.submit(1, self.write, 1, 'd')
+        self.assertEqual(1, self.pool.depth)
+        block.set()
+        self.assertTrue(self.pool.join(5))
+
+        # only the latest waiting write was done, in order
+        self.assertEqual([(1, 'a'), (1, 'd')], self.written)
+        self.assertEqual(2, self.pool.coalesced)
+        self.assertEqual(0, self.pool.depth)
+
+    def test_metrics(self):
+        METRICS.reset()
+        pool = WritePool(2, "hue")
+        block = threading.Event()
+        def fail():
+            raise Exception("unreachable")
+        pool.submit(1, self.write, 1, 'a', block)
+        # the first write is taken by a worker
+        while pool.depth:
+            time.sleep(0.001)
+        pool.submit(1, self.write, 1, 'b')
+        pool.submit(1, fail)
+        self.assertEqual(1, METRICS.get("pool_depth", hub="hue"))
+        block.set()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(0, METRICS.get("pool_depth", hub="hue"))
+        self.assertEqual(1, METRICS.get("pool_coalesced", hub="hue"))
+        self.assertEqual(1, METRICS.get("pool_failed", hub="hue"))
+
+    def test_failed(self):
+        def fail():
+            raise Exception("unreachable")
+        self.pool.submit(1, fail)
+        self.pool.submit(2, self.write, 2, 'a')
+        self.assertTrue(self.pool.join(5))
+        self.assertEqual(1, self.pool.stats()['failed'])
+        self.assertEqual([(2, 'a')], self.written)
+
+
+
+class TestDebouncer(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.pool.log
+        huefri.pool.log = lambda x,y: None
+        self.forwarded = []
+
+    def tearDown(self):
+        huefri.pool.log = self.fnt_log
+
+    def forward(self, value):
+        self.forwarded.append(value)
+
+    def wait(self, debouncer):
+        """ wait until nothing is waiting in the debouncer """
+        for i in range(0, 100):
+            if debouncer.pending is None:
+                return
+            time.sleep(0.01)
+        self.fail("the call wasn't forwarded")
+
+    def test_direct(self):
+        debouncer = Debouncer(self.forward, 0, 0)
+        debouncer(1)
+        debouncer(2)
+        self.assertEqual([1, 2], self.forwarded)
+        self.assertIsNone(debouncer.thread)
+
+    def test_trailing(self):
+        debouncer = Debouncer(self.forward, 0.05, 0)
+        for i in range(0, 10):
+            debouncer(i)
+        self.assertEqual([], self.forwarded)
+        self.wait(debouncer)
+        # only the latest one
+        self.assertEqual([9], self.forwarded)
+        self.assertEqual(9, debouncer.coalesced)
+
+    def test_rate(self):
+        # a held dimmer, a new value every 10 ms for 0.5 s
+        debouncer = Debouncer(self.forward, 0.05, 10)
+        for i in range(0, 50):
+            debouncer(i)
+            time.sleep(0.01)
+        self.wait(debouncer)
+
+        # the lights followed, but at most 10 times per second
+        self.assertLessEqual(len(self.forwarded), 7)
+        self.assertGreaterEqual(len(self.forwarded), 3)
+        self.assertEqual(49, self.forwarded[-1])
+        self.assertEqual(sorted(self.forwarded), self.forwarded)
+
+    def test_shared(self):
+        # two pairs held at once, sharing the limit of one hub
+        limiter = Limiter(10)
+        debouncers = [Debouncer(self.forward, 0.05, limiter=limiter) for i in range(0, 2)]
+        start = time.monotonic()
+        for i in range(0, 50):
+            for d in debouncers:
+                d(i)
+            time.sleep(0.01)
+        for d in debouncers:
+            self.wait(d)
+
+        # together they sent at most 10 commands per second
+        self.assertLessEqual(len(self.forwarded), (time.monotonic() - start) * 10 + 1)
+        self.assertEqual([49, 49], self.forwarded[-2:])
+
+    def test_flush(self):
+        debouncer = Debouncer(self.forward, 10, 0)
+        debouncer(1)
+        debouncer(2)
+        debouncer.flush()
+        self.assertEqual([2], self.forwarded)
+        debouncer.flush()
+        self.assertEqual([2], self.forwarded)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Drive a Hue/Tradfri pair through scripted scenarios against simulated
+    hubs with realistic latencies and report how the sync performs.
+"""
+
+import asyncio
+import contextlib
+import functools
+import io
+import threading
+import time
+from unittest import mock as mock
+
+from pytradfri.const import ATTR_DEVICE_STATE
+from pytradfri.const import ATTR_LIGHT_COLOR_HEX
+from pytradfri.const import ATTR_LIGHT_DIMMER
+
+import dummy
+import huefri
+import huefri.hue
+import huefri.engine
+import huefri.pool
+import huefri.tradfri
+from huefri.engine import Engine as Engine
+from huefri.engine import Watcher as Watcher
+from huefri.hue import Hue as Hue
+from huefri.metrics import METRICS as METRICS
+from huefri.tradfri import Tradfri as Tradfri
+
+# bulbs on each hub and how many of them are synced
+BULBS = 300
+CONTROLLED = 20
+# the Hue bridge: seconds per request, +- jitter, requests per second
+HUE_LATENCY = 0.02
+HUE_JITTER = 0.01
+HUE_RATE = 10
+# the Tradfri gateway
+TRADFRI_LATENCY = 0.05
+TRADFRI_JITTER = 0.02
+# share of the requests which time out
+TIMEOUTS = 0.01
+# how long to wait for the lights to settle after a scenario, in seconds
+SETTLE = 5
+
+
+def remote_press(hue: Hue, tradfri: Tradfri) -> tuple:
+    """ One press of the Tradfri remote. """
+    main = tradfri.gateway.lights[tradfri.main_light]
+    main.apply({ATTR_LIGHT_COLOR_HEX: "f1e0b5", ATTR_LIGHT_DIMMER: 120, ATTR_DEVICE_STATE: 1})
+    return 1, lambda: (hue.bridge.lights[hue.lights_selected[-1]].hsb or {}).get('bri') == 120
+
+
+def dimmer_hold(hue: Hue, tradfri: Tradfri) -> tuple:
+    """ The dimmer button held for a second. """
+    main = tradfri.gateway.lights[tradfri.main_light]
+    steps = 20
+    for i in range(0, steps):
+        main.apply({ATTR_LIGHT_COLOR_HEX: "efd275", ATTR_LIGHT_DIMMER: 10 + i * 10,
+            ATTR_DEVICE_STATE: 1})
+        time.sleep(0.05)
+    last = 10 + (steps - 1) * 10
+    return steps, lambda: (hue.bridge.lights[hue.lights_selected[-1]].hsb or {}).get('bri') == last
+
+
+def hue_app(hue: Hue, tradfri: Tradfri) -> tuple:
+    """ A scene picked in the Hue app. """
+    hue.bridge.lights[hue.main_light].apply({'on': True, 'hue': 39312, 'sat': 13, 'bri': 200})
+    return 1, lambda: tradfri.gateway.lights[tradfri.lights_selected[-1]].dimmer == 200
+
+
+SCENARIOS = [
+    ("remote press", remote_press),
+    ("dimmer held", dimmer_hold),
+    ("Hue app", hue_app),
+]
+
+
+def pair() -> tuple:
+    """ Return a Hue and a Tradfri instance talking to simulated hubs. """
+    hue_net = dummy.bridge_network(rate=HUE_RATE, seed=1)
+    tradfri_net = dummy.gateway_network(seed=2)
+    bridge = functools.partial(dummy.Bridge, count=BULBS + 1, network=hue_net)
+    gateway = dummy.Gateway(count=BULBS)
+    api = functools.partial(dummy.TAPI, network=tradfri_net)
+    with mock.patch('qhue.Bridge', bridge) as m:
+        with mock.patch('huefri.tradfri.APIFactory', api) as n:
+            with mock.patch('huefri.tradfri.Gateway', lambda: gateway) as o:
+                hue = Hue("hue", "secret", 1, list(range(1, CONTROLLED + 1)))
+                tradfri = Tradfri("tradfri", "secret", 0, list(range(0, CONTROLLED)), hue,
+                        cache=None)
+                hue.set_tradfri(tradfri)
+    # the start isn't measured, only the hubs at work are slow
+    for net, latency, jitter in [(hue_net, HUE_LATENCY, HUE_JITTER),
+            (tradfri_net, TRADFRI_LATENCY, TRADFRI_JITTER)]:
+        net.latency = latency
+        net.jitter = jitter
+        net.timeouts = TIMEOUTS
+    return hue, tradfri, hue_net, tradfri_net
+
+
+def run(scenario: 'callable') -> dict:
+    """ Run one scenario while both hubs are watched, return its numbers. """
+    hue, tradfri, hue_net, tradfri_net = pair()
+    result = {}
+
+    async def watch():
+        engine = Engine([
+            Watcher("Tradfri", tradfri, 1, 10, 0.15, 10),
+            Watcher("Hue", hue, 1, 10, 0.15, 10),
+        ])
+        try:
+            await asyncio.wait_for(engine.run_async(), 1 + SETTLE + 2)
+        except asyncio.TimeoutError:
+            pass
+
+    def script():
+        # let the first polls see the lights as they are
+        time.sleep(1)
+        METRICS.reset()
+        requests = hue_net.requests + tradfri_net.requests
+        cpu = time.process_time()
+        changes, synced = scenario(hue, tradfri)
+        done = time.perf_counter()
+        deadline = done + SETTLE
+        while not synced() and time.perf_counter() < deadline:
+            time.sleep(0.005)
+        result['settled'] = time.perf_counter() - done if synced() else None
+        result['cpu'] = time.process_time() - cpu
+        result['requests'] = (hue_net.requests + tradfri_net.requests - requests) / changes
+        result['timeouts'] = hue_net.failed + tradfri_net.failed
+        result['errors'] = sum(METRICS.get(name, hub=h) or 0 for h in ("hue", "tradfri")
+                for name in ("update_errors", "request_timeouts"))
+
+    thread = threading.Thread(target=script)
+    thread.start()
+    # the failed updates print their tracebacks, they are counted instead
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(watch())
+    thread.join()
+
+    latency = [METRICS.get("sync", hub=h) for h in ("hue", "tradfri")]
+    latency = [h for h in latency if h is not None]
+    result['p50'] = max([h.percentile(50) for h in latency], default=0)
+    result['p95'] = max([h.percentile(95) for h in latency], default=0)
+    result['p99'] = max([h.percentile(99) for h in latency], default=0)
+    return result
+
+
+def bench():
+    huefri.hue.log = lambda x,y: None
+    huefri.tradfri.log = lambda x,y: None
+    huefri.engine.log = lambda x,y: None
+    huefri.pool.log = lambda x,y: None
+    print("Scenarios, %d bulbs per hub, %d synced, Hue %d ms at %d/s, Tradfri %d ms, %d %% timeouts:" % (
+        BULBS, CONTROLLED, HUE_LATENCY * 1000, HUE_RATE, TRADFRI_LATENCY * 1000, TIMEOUTS * 100))
+    for name, scenario in SCENARIOS:
+        r = run(scenario)
+        settled = "never" if r['settled'] is None else "%.2f s" % r['settled']
+        print("  %-13s sync p50/p95/p99 %g/%g/%g ms, settled in %s, "
+            "%.1f requests per change, %.2f s CPU, %d timeouts, %d failed updates" % (
+            name, r['p50'], r['p95'], r['p99'], settled, r['requests'], r['cpu'], r['timeouts'],
+            r['errors']))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import json
+import os
+import socket
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+import huefri
+import huefri.server
+from huefri.feed import FEED as FEED
+from huefri.metrics import METRICS as METRICS
+from huefri.server import Server
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.server.log
+        huefri.server.log = lambda x,y: None
+        METRICS.reset()
+        FEED.reset()
+        self.server = Server(port=0, routes={"/hello": lambda query: ("text/plain", "hello")})
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        huefri.server.log = self.fnt_log
+
+    def get(self, path):
+        url = "http://127.0.0.1:%d%s" % (self.server.port, path)
+        with urllib.request.urlopen(url, timeout=5) as r:
+            return r.read().decode("utf-8")
+
+    def test_metrics(self):
+        METRICS.count("polls", hub="hue")
+        METRICS.observe("sync", 42, hub="tradfri")
+        self.assertIn('huefri_polls_total{hub="hue"} 1', self.get("/metrics"))
+        data = json.loads(self.get("/metrics.json"))
+        self.assertEqual(1, data['counters']['polls{hub="hue"}'])
+        self.assertEqual(50, data['latency']['sync{hub="tradfri"}']['p99'])
+
+    def test_routes(self):
+        self.assertEqual("hello", self.get("/hello"))
+        with self.assertRaises(urllib.error.HTTPError):
+            self.get("/nothing")
+
+    def test_lights(self):
+        FEED.publish("hue", 1, {'on': True, 'bri': 100})
+        FEED.publish("tradfri", 0, {'dimmer': 100})
+        data = json.loads(self.get("/lights"))
+        self.assertEqual(2, data['version'])
+        self.assertEqual({'on': True, 'bri': 100}, data['lights']['hue']['1'])
+
+    def test_events(self):
+        FEED.publish("hue", 1, {'bri': 100})
+        # a change which is already there is returned right away
+        data = json.loads(self.get("/events?since=0"))
+        self.assertEqual([{'version': 1, 'hub': "hue", 'light': "1", 'state': {'bri': 100}}],
+                data['changes'])
+
+        # otherwise the request waits for the next one
+        timer = threading.Timer(0.1, FEED.publish, ("hue", 1, {'bri': 50}))
+        timer.start()
+        data = json.loads(self.get("/events?since=1&timeout=5"))
+        self.assertEqual(2, data['version'])
+        self.assertEqual({'bri': 50}, data['changes'][0]['state'])
+
+        # or until the timeout
+        data = json.loads(self.get("/events?since=2&timeout=0.01"))
+        self.assertEqual([], data['changes'])
+
+        with self.assertRaises(urllib.error.HTTPError):
+            self.get("/events?since=x")
+
+    def test_socket(self):
+        FEED.publish("hue", 1, {'bri': 100})
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "huefri.sock")
+            server = Server(socket=path)
+            server.start()
+            try:
+                with socket.socket(socket.AF_UNIX) as s:
+                    s.connect(path)
+                    s.sendall(b"GET /lights HTTP/1.0\r\n\r\n")
+                    response = b""
+                    while True:
+                        data = s.recv(4096)
+                        if not data:
+                            break
+                        response += data
+            finally:
+                server.stop()
+            self.assertFalse(os.path.exists(path))
+        head, body = response.decode("utf-8").split("\r\n\r\n", 1)
+        self.assertIn("200", head.split("\r\n")[0])
+        self.assertEqual(100, json.loads(body)['lights']['hue']['1']['bri'])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Measure the time from start to the first sync with and without the
+    cached Tradfri devices.
+"""
+
+import functools
+import os
+import tempfile
+import time
+from unittest import mock as mock
+
+from pytradfri.const import ATTR_DEVICE_STATE
+from pytradfri.const import ATTR_LIGHT_COLOR_HEX
+from pytradfri.const import ATTR_LIGHT_DIMMER
+
+import dummy
+import huefri
+import huefri.inventory
+import huefri.tradfri
+from huefri.tradfri import Tradfri
+
+DEVICES = 200
+# time one request to the gateway takes, in seconds
+LATENCY = 0.005
+
+
+def first_sync(gateway: dummy.Gateway, path: str) -> float:
+    """ Return the seconds from creating Tradfri to sending the first change. """
+    api = functools.partial(dummy.TAPI, network=dummy.gateway_network(latency=LATENCY))
+    start = time.perf_counter()
+    with mock.patch('huefri.tradfri.APIFactory', api) as m:
+        with mock.patch('huefri.tradfri.Gateway', lambda: gateway) as n:
+            tradfri = Tradfri("tradfri", "secret", 0, [0, 1, 2], dummy.DummyHub(),
+                    debounce=0, rate=0, cache=path)
+    tradfri.update()
+    gateway.lights[0].apply({
+        ATTR_LIGHT_COLOR_HEX: "f1e0b5",
+        ATTR_LIGHT_DIMMER: 100,
+        ATTR_DEVICE_STATE: 1,
+    })
+    tradfri.update()
+    elapsed = time.perf_counter() - start
+    if tradfri.inventory.thread is not None:
+        tradfri.inventory.thread.join()
+    return elapsed
+
+
+def bench():
+    huefri.tradfri.log = lambda x,y: None
+    huefri.inventory.log = lambda x,y: None
+    gateway = dummy.Gateway(count=DEVICES)
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "devices.json")
+        print("Tradfri time to first sync, %d devices, %d ms per request:" % (
+            DEVICES, LATENCY * 1000))
+        print("  no cache: %6.3f s" % first_sync(gateway, path))
+        print("  cached:   %6.3f s" % first_sync(gateway, path))
+
+
+if __name__ == '__main__':
+    bench()
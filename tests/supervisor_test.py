@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from unittest import mock as mock
+import json
+import sys
+import time
+
+import dummy
+import huefri
+import huefri.hue
+import huefri.pairs
+import huefri.supervisor
+import huefri.tradfri
+from huefri.feed import FEED as FEED
+from huefri.hue import Hue as Hue
+from huefri.metrics import METRICS as METRICS
+from huefri.supervisor import Supervisor as Supervisor
+from huefri.supervisor import installations as installations
+from huefri.supervisor import shard as shard
+
+
+def crashing(index, installations, reports, states):
+    """ a worker which reports once and crashes """
+    METRICS.count("polls", hub="hue")
+    light = str(len(states.get("hue", {})))
+    reports.put((index, METRICS.export(), {"hue": dict(states.get("hue", {}),
+        **{light: {'bri': 1}})}))
+    time.sleep(0.1)
+    sys.exit(1)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.supervisor.log
+        huefri.supervisor.log = lambda x,y: None
+        FEED.reset()
+        self.config = json.loads("""{
+            "colors": [{"hex": "efd275", "hsb": {"hue": 6188, "sat": 249}}],
+            "installations": [
+                {"name": "office",
+                 "hue": {"addr": "hue1", "secret": "S", "main": 1, "controlled": [1]},
+                 "tradfri": {"addr": "tradfri1", "secret": "S", "main": 0, "controlled": [0]}},
+                {"hue": {"addr": "hue2", "secret": "S", "main": 1, "controlled": [1]},
+                 "tradfri": {"addr": "tradfri2", "secret": "S", "main": 0, "controlled": [0],
+                    "cache": null}},
+                {"hue": {"addr": "hue3", "secret": "S", "main": 1, "controlled": [1]},
+                 "tradfri": {"addr": "tradfri3", "secret": "S", "main": 0, "controlled": [0]}}
+            ]
+            }""")
+
+    def tearDown(self):
+        huefri.supervisor.log = self.fnt_log
+
+    def test_installations(self):
+        result = installations(self.config)
+        self.assertEqual(["office", "1", "2"], [name for name, config in result])
+        office = result[0][1]
+        self.assertEqual(self.config['colors'], office['colors'])
+        self.assertTrue(office['tradfri']['cache'].endswith("tradfri_devices.office.json"))
+        self.assertIsNone(result[1][1]['tradfri']['cache'])
+        # the config itself is kept as it was
+        self.assertNotIn('cache', self.config['installations'][0]['tradfri'])
+
+    def test_shard(self):
+        self.assertEqual([[0, 2, 4], [1, 3]], shard([0, 1, 2, 3, 4], 2))
+        self.assertEqual([[0], [1]], shard([0, 1], 8))
+        self.assertEqual(2, len(Supervisor(self.config, 2).shards))
+
+    def test_pairs(self):
+        # the config of an installation is used instead of Config
+        config = installations(self.config)[1][1]
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as n:
+                with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as o:
+                    pairs = huefri.pairs.autoinit(config, "1")
+        hue, tradfri = pairs[0]
+        self.assertEqual("hue2", hue.ip)
+        self.assertEqual("1/hue", hue.name)
+        self.assertEqual("1/tradfri", tradfri.name)
+        self.assertEqual(["1/Tradfri", "1/Hue"],
+                [w.name for w in huefri.pairs.watchers(pairs, config, "1")])
+
+    def test_restore(self):
+        huefri.hue.log = lambda x,y: None
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            hue = Hue("hue", "secret", 1, [1], dummy.DummyHub())
+        hue.bridge.lights[1].state(on=True, bri=30, hue=100, sat=200)
+        # the light changed while the worker was down
+        hue.restore({'on': True, 'bri': 20, 'hue': 100, 'sat': 200})
+        self.assertTrue(hue.changed())
+
+        with mock.patch('qhue.Bridge', dummy.Bridge) as m:
+            hue = Hue("hue", "secret", 1, [1], dummy.DummyHub())
+        hue.bridge.lights[1].state(on=True, bri=30, hue=100, sat=200)
+        hue.restore({'on': True, 'bri': 30, 'hue': 100, 'sat': 200})
+        self.assertFalse(hue.changed())
+
+    def test_restart(self):
+        supervisor = Supervisor(self.config, 1, restart=0.01, target=crashing)
+        supervisor.start(0)
+        deadline = time.monotonic() + 30
+        while supervisor.crashes[0] < 2 and time.monotonic() < deadline:
+            supervisor.receive(0.05)
+            supervisor.check()
+        supervisor.stop()
+        self.assertEqual(2, supervisor.crashes[0])
+
+        # the metrics of the crashed workers add up
+        self.assertEqual(2, supervisor.metrics().get("polls", hub="hue", worker="0"))
+        # and the restarted one got the states reported before
+        self.assertEqual({'0': {'bri': 1}, '1': {'bri': 1}}, FEED.state()['lights']['hue'])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+""" Measure memory allocated by one Tradfri poll without a change. """
+
+import functools
+import tracemalloc
+from unittest import mock as mock
+
+import dummy
+import huefri
+import huefri.tradfri
+from huefri.tradfri import Tradfri
+
+DEVICES = 100
+POLLS = 1000
+
+
+def uncached(self):
+    """ the light list as it was built before it got cached """
+    return [dev for dev in self.inventory.fetched.values() if dev.has_light_control]
+
+
+def peak_per_poll(tradfri: Tradfri) -> int:
+    tracemalloc.start()
+    try:
+        tradfri.update()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        tradfri.update()
+        return tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+
+
+def bench():
+    huefri.tradfri.log = lambda x,y: None
+    gateway = functools.partial(dummy.Gateway, count=DEVICES)
+    with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as m:
+        with mock.patch('huefri.tradfri.Gateway', gateway) as n:
+            tradfri = Tradfri("tradfri", "secret", 0, [0], dummy.DummyHub())
+
+    print("Tradfri poll, %d devices:" % DEVICES)
+    with mock.patch.object(Tradfri, '_lights', property(uncached), create=True) as m:
+        print("  uncached: %6d bytes peak per poll" % peak_per_poll(tradfri))
+    print("  cached:   %6d bytes peak per poll" % peak_per_poll(tradfri))
+
+
+if __name__ == '__main__':
+    bench()
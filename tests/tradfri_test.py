@@ -20,10 +20,21 @@
 import unittest
 from unittest import mock as mock
 import json
+import threading
+import time
+from pytradfri.const import ATTR_DEVICE_STATE
+from pytradfri.const import ATTR_LIGHT_COLOR_HEX
+from pytradfri.const import ATTR_LIGHT_DIMMER
+from pytradfri.const import ATTR_LIGHT_COLOR_X
+from pytradfri.const import ATTR_LIGHT_COLOR_Y
+from pytradfri.const import ATTR_LIGHT_MIREDS
+
 import dummy
 import huefri
 import huefri.common
 from huefri.tradfri import Tradfri
+from huefri.transport import AIOCOAP as AIOCOAP
+from huefri.metrics import METRICS as METRICS
 
 
 
@@ -44,7 +55,8 @@ class TestTradfri(unittest.TestCase):
                 "addr": "tradfri",
                 "secret": "SECRET2",
                 "controlled": [0,1,2],
-                "main": 0
+                "main": 0,
+                "cache": null
                 }
             }""")
         self.map = [
@@ -57,8 +69,8 @@ class TestTradfri(unittest.TestCase):
         ]
         self.cls_map = huefri.common.COLORS_MAP
         huefri.common.COLORS_MAP = self.map
-        with mock.patch('pytradfri.coap_cli.api_factory', dummy.TAPI) as m:
-            with mock.patch('pytradfri.gateway.Gateway', dummy.Gateway) as n:
+        with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as m:
+            with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as n:
                 self.tradfri = Tradfri.autoinit()
 
     def tearDown(self):
@@ -66,8 +78,8 @@ class TestTradfri(unittest.TestCase):
         huefri.common.COLORS_MAP = self.cls_map
 
     def test_init(self):
-        with mock.patch('pytradfri.coap_cli.api_factory', dummy.TAPI) as m:
-            with mock.patch('pytradfri.gateway.Gateway', dummy.Gateway) as n:
+        with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as m:
+            with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as n:
                 tradfri = Tradfri.autoinit()
         self.assertEqual('tradfri', tradfri.api.ip)
         self.assertIsNone(tradfri.color)
@@ -86,8 +98,13 @@ class TestTradfri(unittest.TestCase):
         # we didn't changed any other light
         self.assertIsNone(self.tradfri.gateway.lights[1].color)
 
+        # a change is a single request
+        self.tradfri._set(1, "caffee", 100)
+        self.assertEqual(1, self.tradfri.gateway.lights[1].requests)
+
     def test_set_all(self):
         self.tradfri.set_all("bababa", 150)
+        self.tradfri.flush()
         self.assertEqual("bababa", self.tradfri.gateway.lights[0].color)
         self.assertEqual("bababa", self.tradfri.gateway.lights[1].color)
         self.assertEqual("bababa", self.tradfri.gateway.lights[2].color)
@@ -96,6 +113,59 @@ class TestTradfri(unittest.TestCase):
         self.assertEqual(150, self.tradfri.gateway.lights[0].dimmer)
         self.assertTrue(self.tradfri.gateway.lights[2].state)
 
+    def test_set_all_xy(self):
+        # each bulb gets the color the way it can show it
+        self.tradfri.gateway.lights[0].kind = 'xy'
+        self.tradfri.gateway.lights[1].kind = 'mireds'
+        self.tradfri.set_all("bababa", 150, xy=(0.5, 0.4), mireds=500)
+        self.tradfri.flush()
+        self.assertEqual((32768, 26214), self.tradfri.gateway.lights[0].xy)
+        self.assertIsNone(self.tradfri.gateway.lights[0].color)
+        # clamped to what white spectrum bulbs take
+        self.assertEqual(454, self.tradfri.gateway.lights[1].mireds)
+        self.assertIsNone(self.tradfri.gateway.lights[1].color)
+        self.assertEqual("bababa", self.tradfri.gateway.lights[2].color)
+
+        # a group of different bulbs gets what they all take
+        self.tradfri.gateway.add_group([0, 1, 2])
+        self.tradfri.discover_group()
+        self.tradfri.set_all("caffee", 100, xy=(0.5, 0.4), mireds=300)
+        self.tradfri.flush()
+        for l in range(0, 3):
+            self.assertEqual("caffee", self.tradfri.gateway.lights[l].color)
+
+    def test_update_xy(self):
+        self.tradfri.hue = dummy.DummyHub()
+        light = self.tradfri.gateway.lights[0]
+        light.kind = 'xy'
+        self.tradfri.update()
+
+        # color bulbs are synced by their xy color
+        light.apply({ATTR_LIGHT_COLOR_X: 32768, ATTR_LIGHT_COLOR_Y: 26214,
+            ATTR_LIGHT_DIMMER: 100, ATTR_DEVICE_STATE: 1})
+        self.tradfri.update()
+        self.assertEqual({'on': True, 'xy': [0.5, 0.4], 'bri': 100}, self.tradfri.hue.hsb)
+
+        # white spectrum ones by their color temperature
+        light.kind = 'mireds'
+        light.apply({ATTR_LIGHT_MIREDS: 370})
+        self.tradfri.update()
+        self.assertEqual({'on': True, 'ct': 370, 'bri': 100}, self.tradfri.hue.hsb)
+
+    def test_echo_xy(self):
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.gateway.lights[0].kind = 'xy'
+        self.tradfri.changed()
+
+        # our own write of a color to the main light is not a change
+        self.tradfri.set_all("bababa", 150, xy=(0.5, 0.4))
+        self.tradfri.flush()
+        self.assertFalse(self.tradfri.changed())
+
+        self.tradfri.gateway.lights[0].apply({ATTR_LIGHT_COLOR_X: 20000,
+            ATTR_LIGHT_COLOR_Y: 20000})
+        self.assertTrue(self.tradfri.changed())
+
     def test_changed(self):
         # exception if we don't know about hue
         self.tradfri.hue = None
@@ -103,36 +173,244 @@ class TestTradfri(unittest.TestCase):
             self.tradfri.changed()
 
         # set up
-        self.tradfri.set_all("bababa", 150)
+        light = self.tradfri.gateway.lights[0]
+        light.set_hex_color("bababa")
+        light.set_dimmer(150)
+        light.set_state(True)
         self.tradfri.hue = dummy.DummyHub()
 
-        # save current state
-        self.tradfri.hue.set_time_to_now()
+        # save current state, the first look is not a change
         self.assertFalse(self.tradfri.changed())
-        # move time, test if it remembers state
-        self.tradfri.hue.set_time_to_past()
+        # test if it remembers state
         self.assertFalse(self.tradfri.changed())
 
         # change state
-        self.tradfri.set_all("caffee", 100)
+        light.set_hex_color("caffee")
+        light.set_dimmer(100)
+        self.assertTrue(self.tradfri.changed())
+        # test if it remembers state
+        self.assertFalse(self.tradfri.changed())
+
+    def test_echo(self):
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.changed()
+
+        # our own write to the main light is not a change
+        self.tradfri.set_all("bababa", 150)
+        self.tradfri.flush()
+        self.assertFalse(self.tradfri.changed())
+
+        # but a second press of the remote right after is
+        self.tradfri.gateway.lights[0].set_dimmer(100)
         self.assertTrue(self.tradfri.changed())
-        # move time, test if it remembers state
-        self.tradfri.hue.set_time_to_past()
+
+        # turning the lights off is recognized too
+        self.tradfri.set_all("bababa", 0)
+        self.tradfri.flush()
+        self.assertFalse(self.tradfri.changed())
+
+    def test_echo_same_state(self):
+        self.tradfri.hue = dummy.DummyHub()
+        light = self.tradfri.gateway.lights[0]
+        light.apply({ATTR_LIGHT_COLOR_HEX: "f1e0b5", ATTR_LIGHT_DIMMER: 100, ATTR_DEVICE_STATE: 1})
+        self.tradfri.changed()
+
+        # the sync writes the state the main light already is in
+        self.tradfri.set_all("f1e0b5", 100)
+        self.tradfri.flush()
         self.assertFalse(self.tradfri.changed())
 
+        # so no echo of it can swallow the user going back to it
+        light.set_dimmer(50)
+        self.assertTrue(self.tradfri.changed())
+        light.set_dimmer(100)
+        self.assertTrue(self.tradfri.changed())
+
+    def test_echo_expiry(self):
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.changed()
+        light = self.tradfri.gateway.lights[0]
+
+        # a write which never shows up on the main light
+        with mock.patch.object(light, 'set_values', lambda values: None) as m:
+            self.tradfri.set_all("bababa", 150)
+            self.tradfri.flush()
+        with mock.patch('huefri.common.ECHO_EXPIRY', 0) as m:
+            # the poll after the write doesn't see it, it is forgotten
+            self.assertFalse(self.tradfri.changed())
+        light.apply({ATTR_LIGHT_COLOR_HEX: "bababa", ATTR_LIGHT_DIMMER: 150, ATTR_DEVICE_STATE: 1})
+        self.assertTrue(self.tradfri.changed())
+
 
     def test_update(self):
         self.tradfri.hue = dummy.DummyHub()
 
         # the colors of tradfri should change
-        with mock.patch('huefri.tradfri.Tradfri.changed', lambda x: True) as m:
+        changed = lambda x: x.observe(x._lights[x.main_light]) or True
+        with mock.patch('huefri.tradfri.Tradfri.changed', changed) as m:
             self.tradfri.set_all("efd275", 100)
+            self.tradfri.flush()
             self.tradfri.update()
             self.assertEqual({'on': True, 'hue':  6188, 'sat': 249, 'bri': 100}, self.tradfri.hue.hsb)
 
         # the colors of tradfri should stay same as in the previous case
         with mock.patch('huefri.tradfri.Tradfri.changed', lambda x: False) as m:
             self.tradfri.set_all("f5faf6", 150)
+            self.tradfri.flush()
             self.tradfri.update()
             self.assertEqual({'on': True, 'hue':  6188, 'sat': 249, 'bri': 100}, self.tradfri.hue.hsb)
 
+    def test_observe(self):
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.update()
+        light = self.tradfri.gateway.lights[0]
+
+        # don't run the observing thread, subscribe the way it would
+        with mock.patch('huefri.tradfri.Tradfri._observe_loop', lambda x: None) as m:
+            self.tradfri.start_observing()
+        self.assertTrue(self.tradfri.observing)
+        device = self.tradfri._lights[0]
+        device.observe(self.tradfri._observed, self.tradfri._observe_failed, 60)
+
+        # a pushed change is propagated immediately
+        light.set_hex_color("efd275")
+        light.set_dimmer(100)
+        light.set_state(True)
+        light.push()
+        self.assertEqual({'on': True, 'hue':  6188, 'sat': 249, 'bri': 100}, self.tradfri.hue.hsb)
+
+        # the main light is not fetched while observing
+        with mock.patch('huefri.tradfri.Tradfri.observe') as m:
+            self.tradfri.update()
+            m.assert_not_called()
+
+        # a broken observation falls back to polling
+        light.fail(Exception("timeout"))
+        self.assertFalse(self.tradfri.observing)
+        with mock.patch('huefri.tradfri.Tradfri.observe') as m:
+            self.tradfri.update()
+            m.assert_called_once_with(device)
+
+    def test_observe_rescan(self):
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.update()
+        light = self.tradfri.gateway.lights[0]
+        with mock.patch('huefri.tradfri.Tradfri._observe_loop', lambda x: None) as m:
+            self.tradfri.start_observing()
+        self.tradfri._lights[0].observe(self.tradfri._observed, self.tradfri._observe_failed, 60)
+
+        # the devices are read again, the observed one is still used
+        self.tradfri.rescan()
+        light.apply({ATTR_LIGHT_COLOR_HEX: "efd275", ATTR_LIGHT_DIMMER: 100, ATTR_DEVICE_STATE: 1})
+        light.push()
+        self.assertEqual({'on': True, 'hue':  6188, 'sat': 249, 'bri': 100}, self.tradfri.hue.hsb)
+
+    def test_observe_session(self):
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.update()
+        self.tradfri.transport = AIOCOAP
+        light = self.tradfri.gateway.lights[0]
+        self.tradfri.start_observing()
+        deadline = time.monotonic() + 5
+        while not light.observers and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+        # a session pushes from its event loop, which doesn't wait for an
+        # update running meanwhile
+        light.apply({ATTR_LIGHT_COLOR_HEX: "efd275", ATTR_LIGHT_DIMMER: 100, ATTR_DEVICE_STATE: 1})
+        with self.tradfri.lock:
+            loop = threading.Thread(target=light.push, daemon=True)
+            loop.start()
+            loop.join(1)
+            self.assertFalse(loop.is_alive())
+
+        # the change is propagated by the observer thread
+        deadline = time.monotonic() + 5
+        while self.tradfri.hue.hsb is None and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual({'on': True, 'hue':  6188, 'sat': 249, 'bri': 100}, self.tradfri.hue.hsb)
+
+        # a broken observation stops the propagation
+        light.fail(Exception("timeout"))
+        self.assertFalse(self.tradfri.observing)
+
+    def test_set_all_group(self):
+        # a group which doesn't match the controlled lights is not used
+        self.tradfri.gateway.add_group([0, 1])
+        self.tradfri.discover_group()
+        self.assertIsNone(self.tradfri.group)
+
+        group = self.tradfri.gateway.add_group([2, 1, 0])
+        self.tradfri.discover_group()
+        self.assertIs(group, self.tradfri.group)
+
+        # one group request changes all the lights
+        self.tradfri.set_all("bababa", 150)
+        self.tradfri.flush()
+        self.assertEqual(1, group.requests)
+        for l in range(0, 3):
+            self.assertEqual("bababa", self.tradfri.gateway.lights[l].color)
+            self.assertEqual(150, self.tradfri.gateway.lights[l].dimmer)
+            self.assertEqual(0, self.tradfri.gateway.lights[l].requests)
+        self.assertIsNone(self.tradfri.gateway.lights[3].color)
+
+        self.tradfri.set_all("bababa", 0)
+        self.tradfri.flush()
+        self.assertEqual(2, group.requests)
+        self.assertFalse(self.tradfri.gateway.lights[1].state)
+
+    def test_rescan(self):
+        lights = self.tradfri._lights
+        self.assertIs(lights, self.tradfri._lights)
+
+        # new devices are not seen until rescan
+        self.tradfri.gateway.add_remote()
+        self.assertEqual(10, len(self.tradfri.inventory.entries))
+        self.tradfri.rescan()
+        self.assertEqual(11, len(self.tradfri.inventory.entries))
+        self.assertEqual(lights, self.tradfri._lights)
+
+
+    def test_skip_redundant(self):
+        self.tradfri.set_all("bababa", 150)
+        self.tradfri.flush()
+        self.tradfri.set_all("bababa", 150)
+        self.tradfri.flush()
+        # the second time, the lights already were in this state
+        self.assertEqual(1, self.tradfri.gateway.lights[0].requests)
+        self.assertEqual(3, self.tradfri.cache.saved)
+
+        # turning the lights off and on again is sent
+        self.tradfri._set(0, "bababa", 0)
+        self.assertFalse(self.tradfri.gateway.lights[0].state)
+        self.tradfri._set(0, "bababa", 150)
+        self.assertTrue(self.tradfri.gateway.lights[0].state)
+        self.assertEqual(3, self.tradfri.gateway.lights[0].requests)
+
+        # a rescan forgets what was written
+        self.tradfri.rescan()
+        self.tradfri._set(0, "bababa", 150)
+        self.assertEqual(4, self.tradfri.gateway.lights[0].requests)
+
+    def test_metrics(self):
+        METRICS.reset()
+        self.tradfri.hue = dummy.DummyHub()
+        self.tradfri.update()
+        light = self.tradfri.gateway.lights[0]
+        light.set_hex_color("efd275")
+        light.set_dimmer(100)
+        light.set_state(True)
+        self.tradfri.update()
+
+        self.assertEqual(2, METRICS.get("polls", hub="tradfri"))
+        self.assertEqual(1, METRICS.get("changes", hub="tradfri"))
+        self.assertEqual(2, METRICS.get("read", hub="tradfri").count)
+        self.assertEqual(1, METRICS.get("translate", hub="tradfri").count)
+
+        # the echo of our own write
+        self.tradfri.set_all("bababa", 150, 0)
+        self.tradfri.flush()
+        self.tradfri.update()
+        self.assertEqual(1, METRICS.get("echoes", hub="tradfri"))
+        self.assertEqual(3, METRICS.get("write", hub="tradfri").count)
+        self.assertEqual(3, METRICS.get("sync", hub="tradfri").count)
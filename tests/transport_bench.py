@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Measure the latency of one Tradfri request with each transport.
+
+    This talks to the real gateway from config.json, so it is skipped when
+    there is none.
+"""
+
+import statistics
+import time
+
+from pytradfri import Gateway
+from pytradfri.api.libcoap_api import APIFactory
+
+import huefri
+import huefri.common
+from huefri.common import Config as Config
+from huefri.transport import Session as Session
+
+REQUESTS = 20
+
+
+def latencies(api) -> list:
+    """ Time REQUESTS reads of the gateway info, in milliseconds. """
+    gateway = Gateway()
+    times = []
+    for i in range(0, REQUESTS):
+        start = time.perf_counter()
+        api(gateway.get_gateway_info())
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def report(name: str, api):
+    try:
+        times = sorted(latencies(api))
+    except Exception as err:
+        print("  %-8s failed: %s" % (name, str(err)))
+        return
+    print("  %-8s mean %7.1f ms, median %7.1f ms, max %7.1f ms" % (name,
+        statistics.mean(times), statistics.median(times), times[-1]))
+
+
+def bench():
+    huefri.common.log = lambda x,y: None
+    try:
+        config = Config.get()['tradfri']
+    except Exception:
+        print("Tradfri transports: skipped, no gateway in config.json")
+        return
+
+    print("Tradfri request, %d requests:" % REQUESTS)
+    api_factory = APIFactory(config['addr'])
+    api_factory.psk = config['secret']
+    report("libcoap", api_factory.request)
+
+    try:
+        session = Session(config['addr'], config['secret'])
+    except Exception as err:
+        print("  %-8s failed: %s" % ("aiocoap", str(err)))
+        return
+    try:
+        report("aiocoap", session.request)
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    bench()
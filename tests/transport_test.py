@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2015 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from unittest import mock as mock
+import json
+import threading
+import http.server
+
+import dummy
+import huefri
+import huefri.common
+import huefri.transport
+from huefri.common import HuefriException as HuefriException
+from huefri.transport import Session
+from huefri.transport import hue_bridge
+from huefri.tradfri import Tradfri
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('huefri.transport.AsyncAPIFactory', dummy.AsyncTAPI) as m:
+            self.session = Session("tradfri", "KEY")
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_request(self):
+        self.assertEqual("KEY", self.session.factory.psk)
+        self.assertEqual("command", self.session.request("command"))
+
+    def test_multiplex(self):
+        # requests from many threads share the session at the same time
+        threads = [threading.Thread(target=self.session.request, args=(i,))
+                for i in range(0, 8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreater(self.session.factory.most, 1)
+
+    def test_close(self):
+        factory = self.session.factory
+        self.session.close()
+        self.assertTrue(factory.closed)
+        self.session.thread.join(5)
+        self.assertFalse(self.session.thread.is_alive())
+
+    def test_missing(self):
+        with mock.patch('huefri.transport.AsyncAPIFactory', None) as m:
+            with self.assertRaises(HuefriException):
+                Session("tradfri", "KEY")
+
+
+class TestTradfriTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.fnt_log = huefri.tradfri.log
+        huefri.tradfri.log = lambda x,y: None
+        huefri.common.Config._config = json.loads("""{
+            "tradfri":{
+                "addr": "tradfri",
+                "secret": "SECRET2",
+                "controlled": [0,1,2],
+                "main": 0,
+                "transport": "aiocoap",
+                "cache": null
+                }
+            }""")
+
+    def tearDown(self):
+        huefri.tradfri.log = self.fnt_log
+
+    def test_aiocoap(self):
+        with mock.patch('huefri.transport.AsyncAPIFactory', dummy.AsyncTAPI) as m:
+            with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as n:
+                tradfri = Tradfri.autoinit()
+        self.assertEqual("aiocoap", tradfri.transport)
+        self.assertTrue(isinstance(tradfri.api.__self__, Session))
+        self.assertEqual(10, len(tradfri._lights))
+        self.assertEqual(huefri.transport.TIMEOUT, tradfri.api.__self__.timeout)
+        tradfri.api.__self__.close()
+
+    def test_request_timeout(self):
+        # every request to the gateway is limited, with either transport
+        huefri.common.Config._config['tradfri']['request_timeout'] = 3
+        with mock.patch('huefri.transport.AsyncAPIFactory', dummy.AsyncTAPI) as m:
+            with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as n:
+                tradfri = Tradfri.autoinit()
+        self.assertEqual(3, tradfri.api.__self__.timeout)
+        tradfri.api.__self__.close()
+
+        huefri.common.Config._config['tradfri']['transport'] = "libcoap"
+        with mock.patch('huefri.tradfri.APIFactory', dummy.TAPI) as m:
+            with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as n:
+                tradfri = Tradfri.autoinit()
+        self.assertEqual(3, tradfri.api.timeout)
+
+    def test_unknown(self):
+        huefri.common.Config._config['tradfri']['transport'] = "carrier pigeon"
+        with mock.patch('huefri.tradfri.Gateway', dummy.Gateway) as n:
+            with self.assertRaises(HuefriException):
+                Tradfri.autoinit()
+
+
+class BridgeHandler(http.server.BaseHTTPRequestHandler):
+    """ a Hue bridge answering every request with success, keeping the
+        connections alive
+    """
+    protocol_version = "HTTP/1.1"
+
+    def answer(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        body = json.dumps([{"success": {}}]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = answer
+    do_PUT = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHueAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BridgeHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        address = "127.0.0.1:%d" % self.server.server_address[1]
+        self.bridge, self.adapter = hue_bridge(address, "user", 2, 1, 1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        def write(light):
+            for i in range(0, 10):
+                self.bridge.lights[light].state(bri=i)
+        threads = [threading.Thread(target=write, args=(l,)) for l in range(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.bridge.lights()
+
+        # 41 requests over at most two connections
+        stats = self.adapter.stats()
+        self.assertGreaterEqual(stats['reuse'], 39 / 41)
+        self.assertEqual(40, stats['latency']['PUT']['count'])
+        self.assertEqual(1, stats['latency']['GET']['count'])
+        self.assertEqual(40, sum(stats['latency']['PUT']['buckets'].values()))
+
+    def test_timeout(self):
+        self.assertEqual((1, 1), self.bridge.timeout)